@@ -0,0 +1,912 @@
+"""
+Offline benchmark and load test of Fauxpedia.
+
+Runs main.py against local stand-ins of every external API (Anthropic, imgBB, WaveSpeed
+and its CDN, the HF Space, S3 with --store s3), then simulates concurrent users who go through
+/submit -> /process -> progress stream -> page and media, like the browser does.
+Reports p50/p95/p99 latencies, requests per second, the event-loop lag and the RSS of the app.
+
+    python benchmark.py --users 20 --jobs 100
+    python benchmark.py --users 50 --jobs 200 --scale 0.1 --failure-rate 0.05 --json result.json
+    python benchmark.py fakes      # only the fake APIs, prints the environment to run main.py against them
+
+The latencies of the fakes are lognormal around their median (spread set by --jitter)
+and multiplied by --scale, so a run at --scale 0.1 takes a tenth of the real time.
+"""
+import os, re, sys, json, math, time, html, uuid, random, shutil, signal, asyncio, argparse, tempfile, subprocess, io
+import hmac, hashlib, calendar
+from email.utils import formatdate
+from urllib.parse import quote, unquote
+import httpx, uvicorn
+from PIL import Image, ImageDraw
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+API_KEY = "benchmark-key" # of every fake API, and the Authorization of /jobs/stats
+
+# Offsets from --port of the app and of every fake API
+PORTS = {"app": 0, "anthropic": 1, "imgbb": 2, "wavespeed": 3, "cdn": 4, "hf": 5, "s3": 6}
+
+opts = argparse.Namespace()
+
+
+## LATENCY MODEL ##
+def delay(median: float) -> float:
+    """Seconds of a simulated latency: lognormal around the median, scaled by --scale."""
+    if median <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(median * opts.scale), opts.jitter)
+
+
+def fails() -> bool:
+    return random.random() < opts.failure_rate
+
+
+def base_url(name: str) -> str:
+    return f"http://{opts.host}:{opts.port + PORTS[name]}"
+
+
+def fake_env() -> dict:
+    """Environment of main.py to call the fakes instead of the real APIs."""
+    return {
+        "ANTHROPIC_API_KEY": API_KEY,
+        "ANTHROPIC_BASE_URL": base_url("anthropic"),
+        "IMGBB_API_KEY": API_KEY,
+        "IMGBB_API_URL": f"{base_url('imgbb')}/1/upload",
+        "WAVESPEED_API_KEY": API_KEY,
+        "WAVESPEED_API_URL": f"{base_url('wavespeed')}/api/v3",
+        "HFACE_API_KEY": API_KEY,
+        "HF_SPACE_URL": base_url("hf"),
+        "HF_HUB_DISABLE_TELEMETRY": "1",
+        # Used with STORE_BACKEND=s3
+        "S3_ENDPOINT_URL": base_url("s3"),
+        "S3_BUCKET": S3_BUCKET,
+        "S3_REGION": S3_REGION,
+        "S3_ACCESS_KEY_ID": S3_ACCESS_KEY_ID,
+        "S3_SECRET_ACCESS_KEY": S3_SECRET_ACCESS_KEY,
+    }
+
+
+## FAKE ANTHROPIC ##
+BIOGRAPHY_SECTIONS = ["Early life", "Career", "Personal life", "My typical work day", "Awards and Achievements",
+                      "Wealth", "Scandals", "References", "Further reading"]
+WORDS = ("the of and in a to was he is for as on with by his that at from an were which their also has "
+         "career award village bakery mayor scandal famous local council annual festival reportedly").split()
+
+
+def fake_text(prompt: str) -> str:
+    """A biography page for the biography prompt, plain text for the caption and video prompts."""
+    tokens = opts.llm_output_tokens
+    if "wikipedia" not in prompt:
+        return " ".join(random.choices(WORDS, k=tokens // 8))
+    per_section = tokens // len(BIOGRAPHY_SECTIONS)
+    sections = []
+    for title in BIOGRAPHY_SECTIONS:
+        sections.append(f"<h2>{title}</h2>\n<p>{' '.join(random.choices(WORDS, k=per_section))}</p>\n")
+        if title == "My typical work day":
+            sections.append('<video id="portrait-video" src="/static/portrait.mp4" controls></video>\n')
+    return ("<!DOCTYPE html>\n<html><head><title>Biography</title><style>body { font-family: sans-serif; }</style></head>\n"
+            '<body><img id="portrait-image" src="/static/portrait.jpg">\n' + "".join(sections) + "</body></html>")
+
+
+def sse_event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def anthropic_messages(request):
+    if request.headers.get("x-api-key") != API_KEY:
+        return JSONResponse({"type": "error", "error": {"type": "authentication_error", "message": "invalid x-api-key"}}, 401)
+    body = await request.json()
+    if fails():
+        return JSONResponse({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}, 529)
+    content = body["messages"][-1]["content"]
+    parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+    prompt = " ".join(part.get("text", "") for part in parts)
+    input_tokens = len(prompt) // 4 + sum(1600 for part in parts if part["type"] == "image")
+    text = fake_text(prompt)
+    chunks = re.findall(r"\S*\s*", text)[:-1]
+    output_tokens = len(chunks)
+    message = {"id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "model": body["model"],
+               "content": [], "stop_reason": None, "stop_sequence": None,
+               "usage": {"input_tokens": input_tokens, "output_tokens": 1}}
+    await asyncio.sleep(delay(opts.llm_first_token))
+
+    if not body.get("stream"):
+        await asyncio.sleep(output_tokens / opts.llm_tokens_per_second * opts.scale)
+        message.update(content=[{"type": "text", "text": text}], stop_reason="end_turn",
+                       usage={"input_tokens": input_tokens, "output_tokens": output_tokens})
+        return JSONResponse(message)
+
+    async def events():
+        yield sse_event("message_start", {"type": "message_start", "message": message})
+        yield sse_event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        # Tokens come in chunks of about 10, at --llm-tokens-per-second
+        for i in range(0, len(chunks), 10):
+            yield sse_event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": "".join(chunks[i:i + 10])}})
+            await asyncio.sleep(10 / opts.llm_tokens_per_second * opts.scale)
+        yield sse_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        yield sse_event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                          "usage": {"output_tokens": output_tokens}})
+        yield sse_event("message_stop", {"type": "message_stop"})
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+message_batches: dict[str, dict] = {}
+
+
+def iso_time(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def message_batch_object(batch: dict) -> dict:
+    ended = time.time() >= batch["ends_at"]
+    count = len(batch["results"])
+    failed = sum(result["result"]["type"] != "succeeded" for result in batch["results"])
+    return {
+        "id": batch["id"], "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {"processing": 0 if ended else count, "succeeded": count - failed if ended else 0,
+                           "errored": failed if ended else 0, "canceled": 0, "expired": 0},
+        "created_at": iso_time(batch["created_at"]), "expires_at": iso_time(batch["created_at"] + 86400),
+        "ended_at": iso_time(batch["ends_at"]) if ended else None, "cancel_initiated_at": None, "archived_at": None,
+        "results_url": f"{base_url('anthropic')}/v1/messages/batches/{batch['id']}/results" if ended else None,
+    }
+
+
+async def anthropic_batch_create(request):
+    """Message Batches: the results of all requests show up together after --message-batch-latency."""
+    if request.headers.get("x-api-key") != API_KEY:
+        return JSONResponse({"type": "error", "error": {"type": "authentication_error", "message": "invalid x-api-key"}}, 401)
+    body = await request.json()
+    batch = {"id": f"msgbatch_{uuid.uuid4().hex}", "created_at": time.time(), "results": []}
+    batch["ends_at"] = batch["created_at"] + delay(opts.message_batch_latency)
+    for entry in body["requests"]:
+        if fails():
+            result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "Internal error"}}}
+        else:
+            prompt = entry["params"]["messages"][-1]["content"]
+            text = fake_text(prompt)
+            result = {"type": "succeeded", "message": {
+                "id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "model": entry["params"]["model"],
+                "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": len(prompt) // 4, "output_tokens": len(text.split())}}}
+        batch["results"].append({"custom_id": entry["custom_id"], "result": result})
+    message_batches[batch["id"]] = batch
+    return JSONResponse(message_batch_object(batch))
+
+
+async def anthropic_batch(request):
+    batch = message_batches.get(request.path_params["id"])
+    if batch is None:
+        return JSONResponse({"type": "error", "error": {"type": "not_found_error", "message": "Not found"}}, 404)
+    return JSONResponse(message_batch_object(batch))
+
+
+async def anthropic_batch_results(request):
+    batch = message_batches.get(request.path_params["id"])
+    if batch is None or time.time() < batch["ends_at"]:
+        return JSONResponse({"type": "error", "error": {"type": "not_found_error", "message": "Not found"}}, 404)
+    return Response("".join(json.dumps(result) + "\n" for result in batch["results"]), media_type="application/binary")
+
+
+## FAKE IMGBB, WAVESPEED AND CDN ##
+uploaded_photos: dict[str, bytes] = {} # served by the CDN, like i.ibb.co
+predictions: dict[str, dict] = {}
+PHOTO_CACHE_SIZE = 256
+
+
+async def imgbb_upload(request):
+    if request.query_params.get("key") != API_KEY:
+        return JSONResponse({"status_code": 400, "error": {"message": "Invalid API v1 key."}}, 400)
+    form = await request.form()
+    data = await form["image"].read()
+    await asyncio.sleep(delay(opts.upload_latency))
+    if fails():
+        return JSONResponse({"status_code": 500, "error": {"message": "Upload failed"}}, 500)
+    name = f"{uuid.uuid4().hex}.jpg"
+    uploaded_photos[name] = data
+    while len(uploaded_photos) > PHOTO_CACHE_SIZE:
+        uploaded_photos.pop(next(iter(uploaded_photos)))
+    return JSONResponse({"data": {"image": {"url": f"{base_url('cdn')}/photos/{name}"}}, "success": True, "status": 200})
+
+
+async def fetch_reference(url: str):
+    """WaveSpeed downloads the photo, from imgBB or from a signed url of the app."""
+    if url.startswith("data:"):
+        return
+    try:
+        async with httpx.AsyncClient(timeout=30) as client:
+            response = await client.get(url)
+            response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"fake wavespeed: fetching {url} failed: {e}", file=sys.stderr)
+
+
+async def wavespeed_edit(request):
+    if request.headers.get("authorization") != f"Bearer {API_KEY}":
+        return JSONResponse({"code": 401, "message": "Unauthorized"}, 401)
+    body = await request.json()
+    await asyncio.sleep(delay(opts.api_latency))
+    if fails():
+        return JSONResponse({"code": 500, "message": "Internal error"}, 500)
+    prediction_id = uuid.uuid4().hex
+    predictions[prediction_id] = {"ready_at": time.time() + delay(opts.image_latency), "failed": fails()}
+    asyncio.create_task(fetch_reference(body["images"][0]))
+    return JSONResponse({"code": 200, "data": {"id": prediction_id, "status": "created"}})
+
+
+async def wavespeed_result(request):
+    prediction = predictions.get(request.path_params["id"])
+    await asyncio.sleep(delay(opts.api_latency))
+    if prediction is None:
+        return JSONResponse({"code": 404, "message": "Prediction not found"}, 404)
+    if time.time() < prediction["ready_at"]:
+        return JSONResponse({"code": 200, "data": {"status": "processing", "outputs": []}})
+    if prediction["failed"]:
+        return JSONResponse({"code": 200, "data": {"status": "failed", "error": "fake generation failure", "outputs": []}})
+    url = f"{base_url('cdn')}/portraits/{request.path_params['id']}.jpeg"
+    return JSONResponse({"code": 200, "data": {"status": "completed", "outputs": [url]}})
+
+
+def render_portrait(name: str) -> bytes:
+    """A 1024x1536 JPEG that differs for every prediction, so the captions are not answered from the cache."""
+    rng = random.Random(name)
+    image = Image.new("RGB", (1024, 1536), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(1024), rng.randrange(1536)
+        draw.ellipse((x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 400)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    draw.text((40, 40), name, fill=(255, 255, 255))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def cdn_portrait(request):
+    content = await asyncio.to_thread(render_portrait, request.path_params["name"])
+    await asyncio.sleep(delay(opts.download_latency))
+    return Response(content, media_type="image/jpeg")
+
+
+async def cdn_photo(request):
+    content = uploaded_photos.get(request.path_params["name"])
+    if content is None:
+        return Response("Not found", 404)
+    return Response(content, media_type="image/jpeg")
+
+
+## FAKE HF SPACE ##
+# Just enough of the gradio API (protocol sse_v3) for gradio_client to submit /generate_video and download the video
+HF_PREFIX = "/gradio_api"
+HF_INPUTS = [("input_image", "image", None), ("prompt", "textbox", ""), ("steps", "slider", 6),
+             ("negative_prompt", "textbox", ""), ("duration_seconds", "slider", 5.0), ("guidance_scale", "slider", 1),
+             ("guidance_scale_2", "slider", 1), ("seed", "slider", 42), ("randomize_seed", "checkbox", True)]
+HF_OUTPUTS = [("video", "video"), ("seed", "number")]
+HEARTBEAT_INTERVAL = 15 # seconds
+
+hf_sessions: dict[str, asyncio.Queue] = {} # messages of the events of a session, until its stream reads them
+hf_events: dict[str, asyncio.Task] = {}
+hf_slots: asyncio.Semaphore | None = None
+hf_waiting = 0
+
+
+async def hf_config(request):
+    components = [{"id": i, "type": kind, "props": {"label": name}} for i, (name, kind, *_) in enumerate(HF_INPUTS + HF_OUTPUTS)]
+    return JSONResponse({
+        "version": "5.9.1",
+        "mode": "blocks",
+        "protocol": "sse_v3",
+        "api_prefix": HF_PREFIX,
+        "components": components,
+        "dependencies": [{
+            "id": 0,
+            "api_name": "generate_video",
+            "inputs": list(range(len(HF_INPUTS))),
+            "outputs": list(range(len(HF_INPUTS), len(HF_INPUTS) + len(HF_OUTPUTS))),
+            "backend_fn": True,
+            "queue": True,
+            "cancels": [],
+            "types": {"generator": False, "cancel": False},
+        }],
+    })
+
+
+async def hf_info(request):
+    parameters = [{"label": name, "parameter_name": name, "parameter_has_default": default is not None, "parameter_default": default,
+                   "type": {}, "python_type": {"type": "Any", "description": ""}, "component": kind}
+                  for name, kind, default in HF_INPUTS]
+    returns = [{"label": name, "type": {}, "python_type": {"type": "Any", "description": ""}, "component": kind}
+               for name, kind in HF_OUTPUTS]
+    return JSONResponse({"named_endpoints": {"/generate_video": {"parameters": parameters, "returns": returns}}, "unnamed_endpoints": {}})
+
+
+async def hf_upload(request):
+    form = await request.form()
+    return JSONResponse([f"uploads/{uuid.uuid4().hex}/{file.filename}" for file in form.getlist("files")])
+
+
+async def hf_join(request):
+    body = await request.json()
+    if fails():
+        return JSONResponse({"detail": "Queue is full"}, 503)
+    event_id = uuid.uuid4().hex
+    queue = hf_sessions.setdefault(body["session_hash"], asyncio.Queue())
+    hf_events[event_id] = asyncio.create_task(hf_generate(queue, event_id))
+    return JSONResponse({"event_id": event_id})
+
+
+async def hf_generate(queue: asyncio.Queue, event_id: str):
+    """Wait in the Space queue for one of --video-slots, then generate for --video-latency."""
+    global hf_waiting
+    hf_waiting += 1
+    queue.put_nowait({"msg": "estimation", "event_id": event_id, "rank": hf_waiting - 1, "queue_size": hf_waiting, "rank_eta": None})
+    try:
+        async with hf_slots:
+            hf_waiting -= 1
+            queue.put_nowait({"msg": "process_starts", "event_id": event_id, "eta": opts.video_latency})
+            await asyncio.sleep(delay(opts.video_latency))
+            if fails():
+                queue.put_nowait({"msg": "process_completed", "event_id": event_id, "success": False,
+                                  "output": {"error": "fake generation failure"}})
+                return
+            video = {"path": f"videos/{event_id}.mp4", "url": f"{base_url('hf')}{HF_PREFIX}/file=videos/{event_id}.mp4",
+                     "orig_name": "video.mp4", "meta": {"_type": "gradio.FileData"}}
+            queue.put_nowait({"msg": "process_completed", "event_id": event_id, "success": True,
+                              "output": {"data": [{"video": video, "subtitles": None}, random.randrange(2**31)]}})
+    except asyncio.CancelledError:
+        queue.put_nowait({"msg": "process_completed", "event_id": event_id, "success": False, "output": {"error": "cancelled"}})
+    finally:
+        hf_events.pop(event_id, None)
+
+
+async def hf_cancel(request):
+    body = await request.json()
+    task = hf_events.get(body.get("event_id"))
+    if task:
+        task.cancel()
+    return JSONResponse({"success": True})
+
+
+async def hf_queue_data(request):
+    """The stream of all events of a session, kept open with heartbeats like the real Space."""
+    queue = hf_sessions.setdefault(request.query_params["session_hash"], asyncio.Queue())
+
+    async def events():
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                message = {"msg": "heartbeat"}
+            yield f"data: {json.dumps(message)}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def hf_heartbeat(request):
+    async def events():
+        while True:
+            yield f"data: {json.dumps({'msg': 'heartbeat'})}\n\n"
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def hf_file(request):
+    await asyncio.sleep(delay(opts.download_latency))
+    content = b"\x00\x00\x00\x20ftypisom" + bytes(opts.video_bytes)
+    return Response(content, media_type="video/mp4")
+
+
+## FAKE S3 ##
+# Path-style buckets in memory. Every request has to carry a valid Signature Version 4, in its headers or
+# presigned in its query, checked from the request as it was received like S3 does.
+S3_BUCKET = "fauxpedia"
+S3_REGION = "us-east-1"
+S3_ACCESS_KEY_ID = "benchmark-access-key"
+S3_SECRET_ACCESS_KEY = "benchmark-secret-key"
+S3_LIST_PAGE = 100 # keys per page of a listing, S3 sends 1000
+
+s3_objects: dict[str, dict] = {} # "bucket/key" -> content, content type, etag and modification time
+
+
+def s3_error(code: str, status: int, message: str = "") -> Response:
+    return Response(f'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{code}</Code><Message>{html.escape(message)}</Message></Error>',
+                    status, media_type="application/xml")
+
+
+def s3_signature_error(request) -> Response | None:
+    """The error of a request whose signature is missing, wrong or expired, None if it is valid."""
+    query = dict(request.query_params)
+    if "X-Amz-Signature" in query:
+        signature = query.pop("X-Amz-Signature")
+        credential, amz_date = query.get("X-Amz-Credential", ""), query.get("X-Amz-Date", "")
+        signed_headers, payload = query.get("X-Amz-SignedHeaders", ""), "UNSIGNED-PAYLOAD"
+        try:
+            expires_at = calendar.timegm(time.strptime(amz_date, "%Y%m%dT%H%M%SZ")) + int(query.get("X-Amz-Expires", ""))
+        except ValueError:
+            return s3_error("AuthorizationQueryParametersError", 400, "X-Amz-Date or X-Amz-Expires is malformed")
+        if time.time() > expires_at:
+            return s3_error("AccessDenied", 403, "Request has expired")
+    else:
+        match = re.fullmatch(r"AWS4-HMAC-SHA256 Credential=(\S+), SignedHeaders=(\S+), Signature=(\w+)",
+                             request.headers.get("authorization", ""))
+        if not match:
+            return s3_error("AccessDenied", 403, "Missing or malformed Authorization header")
+        credential, signed_headers, signature = match.groups()
+        amz_date, payload = request.headers.get("x-amz-date", ""), request.headers.get("x-amz-content-sha256", "")
+    access_key_id, _, scope = credential.partition("/")
+    if access_key_id != S3_ACCESS_KEY_ID:
+        return s3_error("InvalidAccessKeyId", 403)
+    if scope != f"{amz_date[:8]}/{S3_REGION}/s3/aws4_request" or "host" not in signed_headers.split(";"):
+        return s3_error("AuthorizationHeaderMalformed", 400, f"Credential scope {scope}, signed headers {signed_headers}")
+
+    canonical_request = "\n".join([
+        request.method,
+        request.scope["raw_path"].decode(),
+        "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted(query.items())),
+        "".join(f"{name}:{request.headers.get(name, '').strip()}\n" for name in signed_headers.split(";")),
+        signed_headers,
+        payload,
+    ])
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+    signing_key = f"AWS4{S3_SECRET_ACCESS_KEY}".encode()
+    for part in scope.split("/"):
+        signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest(), signature):
+        return s3_error("SignatureDoesNotMatch", 403, f"Canonical request:\n{canonical_request}")
+    return None
+
+
+def s3_headers(item: dict) -> dict:
+    return {"etag": f'"{item["etag"]}"', "last-modified": formatdate(item["mtime"], usegmt=True)}
+
+
+async def s3_list(request):
+    """ListObjectsV2 of a bucket, S3_LIST_PAGE keys at a time."""
+    if error := s3_signature_error(request):
+        return error
+    if request.query_params.get("list-type") != "2":
+        return s3_error("NotImplemented", 501, "Only ListObjectsV2 is faked")
+    prefix = f"{request.path_params['bucket']}/"
+    after = request.query_params.get("continuation-token", "")
+    keys = sorted(name[len(prefix):] for name in s3_objects if name.startswith(prefix) and name[len(prefix):] > after)
+    page = keys[:S3_LIST_PAGE]
+    contents = "".join(
+        f"<Contents><Key>{html.escape(key)}</Key><LastModified>{iso_time(s3_objects[prefix + key]['mtime'])}</LastModified>"
+        f"<ETag>&quot;{s3_objects[prefix + key]['etag']}&quot;</ETag><Size>{len(s3_objects[prefix + key]['content'])}</Size></Contents>"
+        for key in page
+    )
+    truncated = len(keys) > len(page)
+    token = f"<NextContinuationToken>{html.escape(page[-1])}</NextContinuationToken>" if truncated else ""
+    return Response(f'<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                    f"<IsTruncated>{str(truncated).lower()}</IsTruncated>{contents}{token}</ListBucketResult>",
+                    media_type="application/xml")
+
+
+async def s3_object(request):
+    """PutObject, CopyObject (a PUT with x-amz-copy-source), GetObject, HeadObject and DeleteObject."""
+    if error := s3_signature_error(request):
+        return error
+    name = f"{request.path_params['bucket']}/{request.path_params['key']}"
+    if request.method == "PUT":
+        source = request.headers.get("x-amz-copy-source")
+        if source:
+            item = s3_objects.get(unquote(source).lstrip("/"))
+            if item is None:
+                return s3_error("NoSuchKey", 404, source)
+            item = s3_objects[name] = {**item, "mtime": time.time()}
+            return Response(f'<?xml version="1.0" encoding="UTF-8"?>\n<CopyObjectResult><LastModified>{iso_time(item["mtime"])}</LastModified>'
+                            f'<ETag>&quot;{item["etag"]}&quot;</ETag></CopyObjectResult>', media_type="application/xml")
+        content = await request.body()
+        item = s3_objects[name] = {"content": content, "content_type": request.headers.get("content-type", "application/octet-stream"),
+                                   "etag": hashlib.md5(content).hexdigest(), "mtime": time.time()}
+        return Response(b"", headers={"etag": f'"{item["etag"]}"'})
+    if request.method == "DELETE":
+        s3_objects.pop(name, None)
+        return Response(status_code=204)
+
+    item = s3_objects.get(name)
+    if item is None:
+        return s3_error("NoSuchKey", 404, name)
+    if request.method == "HEAD":
+        return Response(headers={**s3_headers(item), "content-length": str(len(item["content"])), "content-type": item["content_type"]})
+    return Response(item["content"], media_type=item["content_type"], headers=s3_headers(item))
+
+
+def fake_s3_app() -> Starlette:
+    return Starlette(routes=[
+        Route("/{bucket}", s3_list),
+        Route("/{bucket}/", s3_list),
+        Route("/{bucket}/{key:path}", s3_object, methods=["GET", "HEAD", "PUT", "DELETE"]),
+    ])
+
+
+def fake_apps() -> dict[str, Starlette]:
+    return {
+        "anthropic": Starlette(routes=[
+            Route("/v1/messages", anthropic_messages, methods=["POST"]),
+            Route("/v1/messages/batches", anthropic_batch_create, methods=["POST"]),
+            Route("/v1/messages/batches/{id}", anthropic_batch),
+            Route("/v1/messages/batches/{id}/results", anthropic_batch_results),
+        ]),
+        "imgbb": Starlette(routes=[Route("/1/upload", imgbb_upload, methods=["POST"])]),
+        "wavespeed": Starlette(routes=[
+            Route("/api/v3/bytedance/seedream-v4/edit", wavespeed_edit, methods=["POST"]),
+            Route("/api/v3/predictions/{id}/result", wavespeed_result),
+        ]),
+        "cdn": Starlette(routes=[
+            Route("/portraits/{name}", cdn_portrait),
+            Route("/photos/{name}", cdn_photo),
+        ]),
+        "hf": Starlette(routes=[
+            Route("/config", hf_config),
+            Route(f"{HF_PREFIX}/info", hf_info),
+            Route(f"{HF_PREFIX}/upload", hf_upload, methods=["POST"]),
+            Route(f"{HF_PREFIX}/queue/join", hf_join, methods=["POST"]),
+            Route(f"{HF_PREFIX}/queue/data", hf_queue_data),
+            Route(f"{HF_PREFIX}/cancel", hf_cancel, methods=["POST"]),
+            Route(f"{HF_PREFIX}/heartbeat/{{session_hash}}", hf_heartbeat),
+            Route(f"{HF_PREFIX}/file={{path:path}}", hf_file),
+        ]),
+        "s3": fake_s3_app(),
+    }
+
+
+async def serve_fakes():
+    global hf_slots
+    hf_slots = asyncio.Semaphore(opts.video_slots)
+    servers = [uvicorn.Server(uvicorn.Config(app, host=opts.host, port=opts.port + PORTS[name], log_level="warning"))
+               for name, app in fake_apps().items()]
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+## APP UNDER TEST ##
+def run_app():
+    """Run main.py in this process, with a probe of its event-loop lag and RSS at /benchmark/probe."""
+    sys.path.insert(0, REPO_FOLDER)
+    import main
+
+    probe = {"task": None, "lag": [], "rss": []}
+
+    def rss() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # peak, where /proc is missing
+
+    async def sample(interval: float = 0.05):
+        loop = asyncio.get_running_loop()
+        next_rss = 0.0
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            probe["lag"].append(max(loop.time() - started - interval, 0.0))
+            if loop.time() >= next_rss:
+                probe["rss"].append(rss())
+                next_rss = loop.time() + 0.5
+
+    @main.rt("/benchmark/probe/start")
+    async def post():
+        """Start, or start over, the sampling of the event loop lag and the RSS."""
+        if probe["task"] is None:
+            probe["task"] = asyncio.create_task(sample())
+        probe["lag"], probe["rss"] = [], [rss()]
+        return {"status": "success"}
+
+    @main.rt("/benchmark/probe")
+    async def get():
+        return {"lag": probe["lag"], "rss": probe["rss"] + [rss()]}
+
+    uvicorn.run(main.app, host=opts.host, port=opts.port + PORTS["app"], log_level="warning")
+
+
+## LOAD DRIVER ##
+def make_photo(index: int) -> bytes:
+    """A distinct 900x1200 photo per job, so neither the portrait cache nor the LLM cache answers."""
+    rng = random.Random(f"photo-{index}")
+    image = Image.new("RGB", (900, 1200), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(900), rng.randrange(1200)
+        draw.rectangle((x, y, x + rng.randrange(20, 300), y + rng.randrange(20, 300)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class Recorder:
+    """Latencies and errors of the requests, per kind, and the submissions shed by the admission control."""
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.shed = 0
+
+    def add(self, kind: str, seconds: float):
+        self.latencies.setdefault(kind, []).append(seconds)
+
+    def error(self, kind: str, message: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        if opts.verbose:
+            print(f"{kind} failed: {message}", file=sys.stderr)
+
+    def requests(self) -> int:
+        # The job latency is a whole visit, not a request
+        return sum(len(values) for kind, values in self.latencies.items() if kind not in ("job", "first_byte")) + \
+            sum(count for kind, count in self.errors.items() if kind != "job") + self.shed
+
+
+async def timed(recorder: Recorder, kind: str, request) -> httpx.Response | None:
+    started = time.monotonic()
+    try:
+        response = await request
+        if response.status_code == 503 and kind in ("submit", "process"):
+            recorder.shed += 1 # the app is busy, the user would try again later
+            return response
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        recorder.error(kind, str(e))
+        return None
+    recorder.add(kind, time.monotonic() - started)
+    return response
+
+
+async def load_page(client: httpx.AsyncClient, recorder: Recorder, job_id: str, kind: str = "page"):
+    """The job page, streamed while the biography is written, then its media."""
+    started = time.monotonic()
+    try:
+        async with client.stream("GET", f"/output_file/{job_id}") as response:
+            response.raise_for_status()
+            chunks = []
+            async for chunk in response.aiter_text():
+                if not chunks:
+                    recorder.add("first_byte", time.monotonic() - started)
+                chunks.append(chunk)
+    except httpx.HTTPError as e:
+        recorder.error(kind, str(e))
+        return
+    recorder.add(kind, time.monotonic() - started)
+    for src in set(re.findall(r'src="(/media/[^"]+)"', "".join(chunks))):
+        # Assets in S3 are redirected to a presigned url
+        await timed(recorder, "media", client.get(src, follow_redirects=True))
+
+
+async def follow_progress(client: httpx.AsyncClient, recorder: Recorder, job_id: str) -> bool:
+    """Read the progress stream until it closes, reloading the page when the stream asks to. True if the job is done."""
+    pages, failed, event, data = [], True, "", ""
+    try:
+        async with client.stream("GET", f"/jobs/{job_id}/events", timeout=httpx.Timeout(60, read=None)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data += line[5:]
+                elif not line and event == "close":
+                    break
+                elif not line and event == "progress":
+                    failed = "Generation failed" in data or "Job not found" in data
+                    if "content-iframe" in data:
+                        pages.append(asyncio.create_task(load_page(client, recorder, job_id)))
+                if not line:
+                    event, data = "", ""
+    except httpx.HTTPError as e:
+        recorder.error("events", str(e))
+        failed = True
+    await asyncio.gather(*pages)
+    return not failed
+
+
+async def visit(client: httpx.AsyncClient, recorder: Recorder, index: int, photo: bytes) -> bool | None:
+    """One user generating one biography, as the browser does it. None if the app was too busy to take it."""
+    fields = {"name": f"Benchmark User {index}", "job": random.choice(["baker", "pilot", "mayor", "plumber"]), "place": f"Town {index}"}
+    response = await timed(recorder, "submit", client.post("/submit", data=fields, files={"photo": ("photo.jpg", photo, "image/jpeg")}))
+    if response is not None and response.status_code == 503:
+        return None
+    found = response is not None and re.search(r"hx-vals='([^']*)'", response.text)
+    if not found:
+        return False
+    values = json.loads(html.unescape(found.group(1)))
+    response = await timed(recorder, "process", client.post("/process", data=values))
+    if response is None:
+        return False
+    if response.status_code == 503:
+        return None
+    # The iframe loads while the progress stream is followed. A queued job gets it from the stream once admitted.
+    queued = "in the queue" in response.text
+    biography = None if queued else asyncio.create_task(load_page(client, recorder, values["job_id"], kind="biography"))
+    try:
+        return await asyncio.wait_for(follow_progress(client, recorder, values["job_id"]), opts.job_timeout)
+    finally:
+        if biography:
+            await biography
+
+
+async def user(recorder: Recorder, jobs: asyncio.Queue, photos: list[bytes]):
+    # Every user is a browser, with its own session cookie and connections
+    async with httpx.AsyncClient(base_url=base_url("app"), timeout=60) as client:
+        while not jobs.empty():
+            index = jobs.get_nowait()
+            started = time.monotonic()
+            try:
+                done = await visit(client, recorder, index, photos[index])
+            except (TimeoutError, httpx.HTTPError) as e:
+                recorder.error("job", f"job {index}: {e!r}")
+                continue
+            if done:
+                recorder.add("job", time.monotonic() - started)
+            elif done is None:
+                continue
+            else:
+                recorder.error("job", f"job {index} failed")
+
+
+async def wait_until_up(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up in {timeout} seconds")
+                await asyncio.sleep(0.2)
+
+
+async def drive() -> dict:
+    photos = await asyncio.gather(*(asyncio.to_thread(make_photo, index) for index in range(opts.jobs)))
+    await wait_until_up(f"{base_url('hf')}/config")
+    await wait_until_up(f"{base_url('app')}/health")
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    async with httpx.AsyncClient(base_url=base_url("app"), timeout=60, headers=headers) as client:
+        (await client.post("/benchmark/probe/start")).raise_for_status()
+        recorder, jobs = Recorder(), asyncio.Queue()
+        for index in range(opts.jobs):
+            jobs.put_nowait(index)
+        started = time.monotonic()
+        await asyncio.gather(*(user(recorder, jobs, photos) for _ in range(opts.users)))
+        wall = time.monotonic() - started
+        probe = (await client.get("/benchmark/probe")).json()
+        stats = (await client.get("/jobs/stats", params={"window": int(wall) + 60})).json()
+    return summarize(recorder, wall, probe, stats)
+
+
+## REPORT ##
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] if ordered else 0.0
+
+
+def distribution(values: list[float]) -> dict:
+    return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99), "max": max(values, default=0.0)}
+
+
+def summarize(recorder: Recorder, wall: float, probe: dict, stats: dict) -> dict:
+    kinds = ["submit", "process", "first_byte", "biography", "events", "page", "media", "job"]
+    return {
+        "users": opts.users,
+        "jobs": opts.jobs,
+        "scale": opts.scale,
+        "failure_rate": opts.failure_rate,
+        "seconds": wall,
+        "jobs_done": len(recorder.latencies.get("job", [])),
+        "jobs_shed": recorder.shed,
+        "requests": recorder.requests(),
+        "requests_per_second": recorder.requests() / wall,
+        "jobs_per_minute": len(recorder.latencies.get("job", [])) / wall * 60,
+        "latency": {kind: {**distribution(recorder.latencies.get(kind, [])), "errors": recorder.errors.get(kind, 0)}
+                    for kind in kinds if kind in recorder.latencies or kind in recorder.errors},
+        "event_loop_lag": distribution(probe["lag"]),
+        "rss": {"start": probe["rss"][0], "peak": max(probe["rss"]), "end": probe["rss"][-1]},
+        "stages": stats.get("stages", {}),
+    }
+
+
+def print_report(result: dict):
+    print(f"\n{result['users']} users, {result['jobs']} jobs: {result['jobs_done']} done, {result['jobs_shed']} shed as busy "
+          f"in {result['seconds']:.1f} s "
+          f"(scale {result['scale']}, failure rate {result['failure_rate']})")
+    print(f"{result['requests']} requests, {result['requests_per_second']:.1f}/s, {result['jobs_per_minute']:.1f} jobs/min\n")
+    print(f"{'seconds':<12}{'count':>7}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for kind, row in result["latency"].items():
+        print(f"{kind:<12}{row['count']:>7}{row['errors']:>8}{row['p50']:>9.3f}{row['p95']:>9.3f}{row['p99']:>9.3f}{row['max']:>9.3f}")
+    lag = result["event_loop_lag"]
+    print(f"\nevent loop lag (ms): p50 {lag['p50'] * 1000:.1f}, p95 {lag['p95'] * 1000:.1f}, "
+          f"p99 {lag['p99'] * 1000:.1f}, max {lag['max'] * 1000:.1f} over {lag['count']} samples")
+    rss = result["rss"]
+    print(f"RSS (MB): start {rss['start'] / 2**20:.0f}, peak {rss['peak'] / 2**20:.0f}, end {rss['end'] / 2**20:.0f}")
+    if result["stages"]:
+        print(f"\n{'stage':<14}{'runs':>6}{'failures':>10}{'avg':>9}{'max':>9}")
+        for stage, row in result["stages"].items():
+            print(f"{stage:<14}{row['runs']:>6}{row['failures']:>10}{row['avg_seconds']:>9.2f}{row['max_seconds']:>9.2f}")
+
+
+## COMMAND LINE ##
+FAKE_OPTIONS = {
+    # name: (default, help)
+    "scale": (1.0, "multiplier of every simulated latency"),
+    "jitter": (0.3, "sigma of the lognormal latencies, 0 for fixed ones"),
+    "failure_rate": (0.0, "share of the fake API calls that fail"),
+    "llm_first_token": (1.0, "median seconds to the first token"),
+    "llm_tokens_per_second": (80.0, "output speed of the fake LLM"),
+    "llm_output_tokens": (1500, "tokens of a biography, captions get an eighth"),
+    "message_batch_latency": (120.0, "median seconds until a Message Batch has ended"),
+    "api_latency": (0.15, "median seconds of a WaveSpeed API call"),
+    "upload_latency": (0.5, "median seconds of an imgBB upload"),
+    "image_latency": (10.0, "median seconds until a portrait is completed"),
+    "download_latency": (0.3, "median seconds of a CDN or Space download"),
+    "video_latency": (40.0, "median seconds of a video generation"),
+    "video_slots": (1, "videos the Space generates at once, the others queue"),
+    "video_bytes": (1024**2, "size of the generated videos"),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "fakes", "app"],
+                        help="run the benchmark (default), only the fake APIs, or only the app against them")
+    parser.add_argument("--users", type=int, default=10, help="concurrent users")
+    parser.add_argument("--jobs", type=int, default=30, help="biographies generated in total")
+    parser.add_argument("--job-timeout", type=float, default=900, help="seconds before a job counts as failed")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900, help=f"port of the app, the fake APIs use the next {len(PORTS) - 1}")
+    parser.add_argument("--photo-transport", default="imgbb", choices=["imgbb", "signed", "base64"])
+    parser.add_argument("--store", default="local", choices=["local", "s3"], help="artifact store of the app, s3 is the fake one")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra environment of the app, e.g. VIDEO_WORKERS=8")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="print every failed request")
+    for name, (default, help) in FAKE_OPTIONS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default, help=f"{help} (default {default})")
+    return parser.parse_args()
+
+
+def child_args(command: str) -> list[str]:
+    args = [sys.executable, os.path.abspath(__file__), command, f"--host={opts.host}", f"--port={opts.port}"]
+    return args + [f"--{name.replace('_', '-')}={getattr(opts, name)}" for name in FAKE_OPTIONS]
+
+
+def run_benchmark():
+    """Start the fakes and the app in their own processes, in a scratch folder, then drive the load."""
+    workdir = tempfile.mkdtemp(prefix="fauxpedia-benchmark-")
+    shutil.copytree(os.path.join(REPO_FOLDER, "static"), os.path.join(workdir, "static"))
+    env = {**os.environ, **fake_env(), "PHOTO_TRANSPORT": opts.photo_transport, "PUBLIC_BASE_URL": base_url("app"),
+           "STORE_BACKEND": opts.store, **dict(item.split("=", 1) for item in opts.env)}
+    processes = [
+        subprocess.Popen(child_args("fakes"), env=env),
+        subprocess.Popen(child_args("app"), env=env, cwd=workdir),
+    ]
+    try:
+        result = asyncio.run(drive())
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result)
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    opts = parse_args()
+    if opts.command == "fakes":
+        print("Run main.py against the fake APIs with:")
+        print(" ".join(f"{name}={value}" for name, value in fake_env().items()) + " python main.py")
+        try:
+            asyncio.run(serve_fakes())
+        except KeyboardInterrupt:
+            pass
+    elif opts.command == "app":
+        run_app()
+    else:
+        run_benchmark()
@@ -1,14 +1,21 @@
-import os, json, time, base64, tempfile, logging, time, httpx, asyncio
+import io, os, re, csv, hmac, json, time, uuid, base64, shutil, sqlite3, hashlib, secrets, logging, time, httpx, asyncio, functools, mimetypes, threading, contextvars, sys, traceback
+from collections import Counter, deque
+from contextlib import closing, contextmanager
+from urllib.parse import urlencode, urlsplit, quote
+from email.utils import parsedate_to_datetime
+from xml.etree import ElementTree
 import datetime as dt
 from dotenv import load_dotenv, find_dotenv
 from anthropic import AsyncAnthropic
 from bs4 import BeautifulSoup
 from fasthtml.common import *
-from starlette.background import BackgroundTask
 from gradio_client import Client, handle_file
+from PIL import Image, ImageOps, UnidentifiedImageError
+from pillow_heif import register_heif_opener
 from gradio_client.client import Job
 
-video_gen_job: Job
+# HEIC photos of iPhones
+register_heif_opener()
 
 # Environment variables
 load_dotenv(find_dotenv())
@@ -19,16 +26,1007 @@ hf_space_url = os.environ.get("HF_SPACE_URL")
 img_service_key = os.environ.get("IMGBB_API_KEY")
 
 # folder for generated assets
-GEN_FOLDER = "./generated"
+GEN_FOLDER = os.environ.get("GEN_FOLDER", "./generated")
 os.makedirs(GEN_FOLDER, exist_ok=True)
 
+# folder for per-job workspaces, one sub-folder per generation request
+JOBS_FOLDER = os.environ.get("JOBS_FOLDER", "./jobs")
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+
+
+def shared_secret(name: str) -> str:
+    """A random secret of this host, created by whichever worker process starts first."""
+    path = os.path.join(JOBS_FOLDER, f".{name}")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(secrets.token_hex(32))
+    try:
+        os.link(tmp_path, path) # fails if another worker was first
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path) as file:
+        return file.read()
+
+
+# WaveSpeed API and polling of its predictions
+WAVESPEED_API_URL = os.environ.get("WAVESPEED_API_URL", "https://api.wavespeed.ai/api/v3").rstrip("/")
+WAVESPEED_MAX_JOBS = int(os.environ.get("WAVESPEED_MAX_JOBS", 32)) # image generations in flight
+POLL_INTERVAL = 1.0       # seconds before the first re-poll
+POLL_MAX_INTERVAL = 5.0   # upper bound of the poll backoff
+POLL_TIMEOUT = 600        # give up on a prediction after 10 minutes
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# imgBB, where the photo is uploaded for WaveSpeed to fetch it (PHOTO_TRANSPORT=imgbb)
+IMGBB_API_URL = os.environ.get("IMGBB_API_URL", "https://api.imgbb.com/1/upload")
+
+# HF Space video generation
+HF_SPACE_MAX_JOBS = int(os.environ.get("HF_SPACE_MAX_JOBS", 2)) # videos submitted to the Space at once
+VIDEO_POLL_INTERVAL = 5  # seconds between status checks of a video job
+VIDEO_TIMEOUT = 1800     # cancel a video job after 30 minutes
+
+# Anthropic API, calls beyond these limits queue instead of running into 429s
+LLM_MODEL = "claude-sonnet-4-5-20250929"
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+LLM_INPUT_TOKENS_PER_MINUTE = int(os.environ.get("LLM_INPUT_TOKENS_PER_MINUTE", 400000))
+LLM_OUTPUT_TOKENS_PER_MINUTE = int(os.environ.get("LLM_OUTPUT_TOKENS_PER_MINUTE", 80000))
+BIOGRAPHY_MAX_TOKENS = 8192
+
+# Batches of submissions (/batches). At most BATCH_MAX_JOBS jobs of a batch are in the engine at once,
+# the interactive submissions get the rest of the worker pools and rate limits
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", 8))
+BATCH_MAX_RECORDS = int(os.environ.get("BATCH_MAX_RECORDS", 1000))
+MESSAGE_BATCH_POLL_INTERVAL = 30 # seconds between status checks of an Anthropic Message Batch
+
+# Admission control of /process: a job starts only while every stage has room for it, see STAGE_CAPACITY.
+# The others wait in a queue that takes the clients in turn, submissions beyond it get a "busy" answer.
+ADMISSION_STAGE_FACTOR = float(os.environ.get("ADMISSION_STAGE_FACTOR", 2)) # capacity of a stage, in worker pools
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 50)) # queued jobs of a worker process
+ADMISSION_MAX_PER_CLIENT = int(os.environ.get("ADMISSION_MAX_PER_CLIENT", 2)) # queued jobs of one browser
+ADMISSION_QUEUE_TIMEOUT = int(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 600)) # seconds in the queue before giving up
+ADMISSION_RETRY_AFTER = 60 # seconds, Retry-After of the "busy" answer
+
+# Cache of LLM results, identical submissions are answered without calling the API
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 7 * 24 * 3600)) # seconds
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+
+# Cache of generated portraits, a photo resubmitted by the same browser with the same prompt reuses its portrait
+PORTRAIT_CACHE_MAX_BYTES = int(os.environ.get("PORTRAIT_CACHE_MAX_BYTES", 1024**3))
+PORTRAIT_HASH_DISTANCE = 2 # max differing bits of the photo hashes of a candidate, its digest must match too
+
+# Uploaded photos are written to the job workspace in chunks and refused beyond this size
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024**2))
+SUBMIT_MAX_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + 1024**2 # a photo as a base64 webcam capture, plus the form fields
+UPLOAD_CHUNK_SIZE = 64 * 1024 # a multiple of 4, so base64 decodes chunk by chunk
+PHOTO_MAX_SIZE = 1536 # px, long edge of the photo handed to the image model
+CAPTION_MAX_SIZE = 768 # px, long edge of the portrait sent to the LLM for its caption
+JPEG_QUALITY = 90
+ORPHAN_PHOTO_TTL = 3600 # seconds before the photo of a submission that never became a job is removed
+ORPHAN_SWEEP_INTERVAL = ORPHAN_PHOTO_TTL // 4 # seconds between the leader's sweeps of these photos
+
+# How the photo reaches WaveSpeed: "signed" (a short-lived signed URL served by this app,
+# needs the public URL of the app), "base64" (inline in the request) or "imgbb" (uploaded first)
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+PHOTO_TRANSPORT = os.environ.get("PHOTO_TRANSPORT", "signed" if PUBLIC_BASE_URL else "imgbb")
+SIGNED_URL_TTL = 600 # seconds
+URL_SIGNING_KEY = os.environ.get("URL_SIGNING_KEY") or shared_secret("url_signing_key")
+# Signs the session cookies, the same in every worker process
+SESSION_SECRET = os.environ.get("SESSION_SECRET") or shared_secret("session_secret")
+
+# Where the generated portraits and videos are kept: "local" (sharded folders of GEN_FOLDER) or
+# "s3" (a bucket of S3-compatible object storage, e.g. MinIO). Assets are evicted in the background
+# once older than ASSET_TTL, and the least recently used first beyond STORE_MAX_BYTES.
+STORE_BACKEND = os.environ.get("STORE_BACKEND", "local")
+STORE_MAX_BYTES = int(os.environ.get("STORE_MAX_BYTES", 10 * 1024**3))
+ASSET_TTL = int(os.environ.get("ASSET_TTL", 30 * 24 * 3600)) # seconds
+STORE_SWEEP_INTERVAL = 600 # seconds between eviction runs
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", "https://s3.amazonaws.com").rstrip("/")
+S3_BUCKET = os.environ.get("S3_BUCKET", "fauxpedia")
+S3_REGION = os.environ.get("S3_REGION", "us-east-1")
+S3_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY")
+
 # Configure basic logging for this module
-# Delete log file on each run
-if os.path.exists("main.log"):
-    os.remove("main.log")
-logging.basicConfig(filename=os.path.join(os.curdir, "main.log"), level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Appended to by every worker process, each line names its process
+LOG_FILE = os.environ.get("LOG_FILE", os.path.join(os.curdir, "main.log"))
+logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(process)d - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# One pooled HTTP client for all outgoing API calls, connections are kept alive between jobs
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(60, connect=10),
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30),
+)
+
+
+# One Anthropic client for the app lifetime, it keeps its own connection pool
+llm_client = AsyncAnthropic(api_key=llm_api_key, max_retries=4)
+
+
+async def close_http_client():
+    """Close the pooled HTTP clients when the app shuts down."""
+    await http_client.aclose()
+    await llm_client.close()
+
+
+## METRICS ##
+# Prometheus metrics of this worker process. Every worker stores a snapshot of them with its heartbeat,
+# /metrics adds up the snapshots of all live workers.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800) # seconds
+# By host and port, any other host is a download
+API_NAMES = {urlsplit(IMGBB_API_URL).netloc: "imgbb", urlsplit(WAVESPEED_API_URL).netloc: "wavespeed"}
+
+metrics: dict[str, "Metric"] = {}
+metrics_lock = threading.Lock() # metrics are also updated from threads
+# Id of the job whose stage is running, tasks and threads started by the stage inherit it
+current_job_id = contextvars.ContextVar("current_job_id", default="")
+
+
+class Metric:
+    """A counter, gauge or histogram with one value per combination of label values."""
+    def __init__(self, name: str, kind: str, help: str, labels: tuple = (), buckets: tuple = ()):
+        self.name, self.kind, self.help, self.labels, self.buckets = name, kind, help, labels, buckets
+        self.values: dict[tuple, float | list] = {}
+        metrics[name] = self
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with metrics_lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        with metrics_lock:
+            self.values[tuple(labels[name] for name in self.labels)] = value
+
+    def observe(self, value: float, **labels):
+        """Count a value into the histogram: cumulative bucket counts, then the count and the sum."""
+        key = tuple(labels[name] for name in self.labels)
+        with metrics_lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+
+stage_seconds = Metric("fauxpedia_stage_seconds", "histogram", "Run time of the job stages.", ("stage", "outcome"), LATENCY_BUCKETS)
+stages_in_flight = Metric("fauxpedia_stages_in_flight", "gauge", "Job stages running.", ("stage",))
+stages_queued = Metric("fauxpedia_stages_queued", "gauge", "Job stages waiting for a worker of their pool.", ("stage",))
+span_seconds = Metric("fauxpedia_span_seconds", "histogram", "Duration of the external calls made by the job stages.", ("span", "outcome"), LATENCY_BUCKETS)
+spans_in_flight = Metric("fauxpedia_spans_in_flight", "gauge", "External calls in progress.", ("span",))
+llm_queue_seconds = Metric("fauxpedia_llm_queue_seconds", "histogram", "Wait of the LLM calls for a slot and the token budget.", ("purpose",), LATENCY_BUCKETS)
+llm_first_token_seconds = Metric("fauxpedia_llm_first_token_seconds", "histogram", "Time to the first token of the LLM calls.", ("purpose",), LATENCY_BUCKETS)
+llm_tokens = Metric("fauxpedia_llm_tokens_total", "counter", "Tokens used by the LLM calls.", ("purpose", "direction"))
+cache_lookups = Metric("fauxpedia_cache_lookups_total", "counter", "Lookups of the result and portrait caches.", ("cache", "result"))
+cache_hit_ratio = Metric("fauxpedia_cache_hit_ratio", "gauge", "Share of the cache lookups that were hits.", ("cache",))
+api_responses = Metric("fauxpedia_api_responses_total", "counter", "Responses of the HTTP APIs by status code.", ("api", "code"))
+jobs_gauge = Metric("fauxpedia_jobs", "gauge", "Jobs by status.", ("status",))
+workers_gauge = Metric("fauxpedia_workers", "gauge", "Live worker processes.")
+store_bytes = Metric("fauxpedia_store_bytes", "gauge", "Size of the assets in the artifact store.")
+store_assets = Metric("fauxpedia_store_assets", "gauge", "Assets in the artifact store.")
+
+
+def metrics_snapshot() -> dict:
+    """The metrics of this process, as stored with its heartbeat."""
+    for stage, queue in stage_queues.items():
+        stages_queued.set(queue.qsize(), stage=stage)
+    admission_queued.set(sum(map(len, admission_queue.values())))
+    admission_admitted.set(len(admitted_jobs))
+    with metrics_lock:
+        return {name: [[list(key), value] for key, value in metric.values.items()] for name, metric in metrics.items()}
+
+
+def merge_metrics(snapshots: list[dict]) -> dict[str, dict]:
+    """Add up the snapshots of several processes, values with the same labels are summed."""
+    merged = {name: {} for name in metrics}
+    for snapshot in snapshots:
+        for name, entries in snapshot.items():
+            if name not in merged:
+                continue # renamed since the other worker started
+            for key, value in entries:
+                key = tuple(key)
+                if isinstance(value, list):
+                    total = merged[name].get(key, [0] * len(value))
+                    merged[name][key] = [a + b for a, b in zip(total, value)]
+                else:
+                    merged[name][key] = merged[name].get(key, 0) + value
+    return merged
+
+
+def collect_metrics() -> str:
+    """The metrics of all live workers, this one up to date and the others as of their last heartbeat."""
+    with closing(db_connect()) as con:
+        rows = con.execute("SELECT id, metrics FROM workers WHERE id != ? AND heartbeat >= ?",
+                           (WORKER_ID, time.time() - WORKER_TIMEOUT)).fetchall()
+        jobs = con.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+    merged = merge_metrics([metrics_snapshot()] + [json.loads(row["metrics"]) for row in rows])
+
+    # Shared by all workers, not added up
+    merged["fauxpedia_jobs"] = {(row["status"],): row["count"] for row in jobs}
+    merged["fauxpedia_workers"] = {(): len(rows) + 1}
+    merged["fauxpedia_store_bytes"] = {(): artifact_store.total_bytes()}
+    merged["fauxpedia_store_assets"] = {(): len(artifact_store.index)}
+
+    lookups = merged["fauxpedia_cache_lookups_total"]
+    for cache in {key[0] for key in lookups}:
+        hits, misses = lookups.get((cache, "hit"), 0), lookups.get((cache, "miss"), 0)
+        merged["fauxpedia_cache_hit_ratio"][(cache,)] = hits / (hits + misses) if hits + misses else 0.0
+    return render_metrics(merged)
+
+
+def metric_labels(names: tuple, key: tuple, **extra) -> str:
+    pairs = list(zip(names, key)) + list(extra.items())
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}" if pairs else ""
+
+
+def render_metrics(merged: dict[str, dict]) -> str:
+    """Prometheus text exposition format."""
+    lines = []
+    for name, metric in metrics.items():
+        lines += [f"# HELP {name} {metric.help}", f"# TYPE {name} {metric.kind}"]
+        for key, value in sorted(merged.get(name, {}).items()):
+            labels = metric_labels(metric.labels, key)
+            if metric.kind != "histogram":
+                lines.append(f"{name}{labels} {value:g}")
+                continue
+            for bound, count in zip([*metric.buckets, "+Inf"], value):
+                lines.append(f"{name}_bucket{metric_labels(metric.labels, key, le=bound)} {count:g}")
+            lines.append(f"{name}_sum{labels} {value[-1]:g}")
+            lines.append(f"{name}_count{labels} {value[-2]:g}")
+    return "\n".join(lines) + "\n"
+
+
+def record_span(name: str, started_at: float, ok: bool):
+    """Observe a finished external call and store it as a span of the current job, see /jobs/{id}/trace."""
+    finished_at = time.time()
+    span_seconds.observe(finished_at - started_at, span=name, outcome="ok" if ok else "error")
+    job_id = current_job_id.get()
+    if not job_id:
+        return
+    try:
+        # Stored in a thread, the insert waits for the write lock while another worker holds it
+        asyncio.get_running_loop().run_in_executor(None, store_span, job_id, name, started_at, finished_at, ok)
+    except RuntimeError:
+        store_span(job_id, name, started_at, finished_at, ok) # called from a thread
+    logger.info(f"Job {job_id} span {name}: {finished_at - started_at:.2f}s{'' if ok else ', failed'}")
+
+
+def store_span(job_id: str, name: str, started_at: float, finished_at: float, ok: bool):
+    try:
+        with closing(db_connect()) as con, con:
+            con.execute(
+                "INSERT INTO spans (job_id, name, started_at, finished_at, ok, worker) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, name, started_at, finished_at, int(ok), WORKER_ID),
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"Could not store span {name} of job {job_id}: {str(e)}")
+
+
+@contextmanager
+def span(name: str):
+    """Time the block as a span of the current job, it failed if it raises."""
+    started_at, ok = time.time(), False
+    spans_in_flight.inc(span=name)
+    try:
+        yield
+        ok = True
+    finally:
+        spans_in_flight.inc(-1, span=name)
+        record_span(name, started_at, ok)
+
+
+async def count_api_response(response: httpx.Response):
+    api_responses.inc(api=API_NAMES.get(response.request.url.netloc.decode(), "download"), code=str(response.status_code))
+
+
+http_client.event_hooks["response"].append(count_api_response)
+
+
+## PROFILING ##
+# The lag of the event loop is measured all the time. With LOOP_DEBUG=1 a watchdog thread also logs
+# the stack of the loop whenever it is blocked beyond BLOCKING_THRESHOLD, and asyncio names the slow callbacks.
+LOOP_DEBUG = os.environ.get("LOOP_DEBUG", "") not in ("", "0")
+BLOCKING_THRESHOLD = float(os.environ.get("BLOCKING_THRESHOLD", 0.1)) # seconds
+LOOP_LAG_INTERVAL = 0.1 # seconds between two lag measurements
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # seconds
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.005 # seconds between two stack samples
+
+loop_lag = Metric("fauxpedia_event_loop_lag_seconds", "histogram", "Delay of the event loop in waking up a sleeping task.", (), LAG_BUCKETS)
+loop_stalls = Metric("fauxpedia_event_loop_stalls_total", "counter", "Event loop lags beyond BLOCKING_THRESHOLD.")
+
+# State of the loop shared with the watchdog thread: its thread id and the last time it ran the lag monitor
+loop_watch = {"thread": None, "tick": 0.0}
+recent_lags: deque = deque(maxlen=600) # a minute of lag measurements
+recent_stalls: deque = deque(maxlen=50) # stalls caught by the watchdog, with their stack
+loop_watch_tasks: list[asyncio.Task] = []
+watchdog_stop = threading.Event()
+
+
+async def watch_event_loop():
+    """Sleep LOOP_LAG_INTERVAL over and over, whatever it oversleeps is the lag of the loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        loop_watch["tick"] = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(loop.time() - started - LOOP_LAG_INTERVAL, 0.0)
+        recent_lags.append(lag)
+        loop_lag.observe(lag)
+        if lag > BLOCKING_THRESHOLD:
+            loop_stalls.inc()
+
+
+def loop_stack() -> str:
+    """Innermost frames of what the event loop thread is running right now."""
+    frame = sys._current_frames().get(loop_watch["thread"])
+    return "".join(traceback.format_stack(frame, limit=20)) if frame else ""
+
+
+def loop_watchdog():
+    """Thread that catches the loop in the act: the stack of the loop thread while the lag monitor is overdue."""
+    stall = None
+    while not watchdog_stop.wait(BLOCKING_THRESHOLD / 4):
+        overdue = time.monotonic() - loop_watch["tick"] - LOOP_LAG_INTERVAL
+        if stall is None and overdue > BLOCKING_THRESHOLD:
+            stall = {"started_at": time.time() - overdue, "seconds": None, "stack": loop_stack()}
+            logger.warning(f"Event loop blocked for more than {BLOCKING_THRESHOLD}s, in:\n{stall['stack']}")
+        elif stall is not None and overdue <= BLOCKING_THRESHOLD:
+            stall["seconds"] = round(time.time() - stall["started_at"], 3)
+            recent_stalls.append(stall)
+            logger.warning(f"Event loop was blocked for {stall['seconds']}s")
+            stall = None
+
+
+async def start_loop_watch():
+    loop = asyncio.get_running_loop()
+    loop_watch["thread"] = threading.get_ident()
+    loop_watch_tasks.append(asyncio.create_task(watch_event_loop()))
+    if LOOP_DEBUG:
+        # asyncio logs every callback that runs longer than the threshold, with the name of its task
+        loop.set_debug(True)
+        loop.slow_callback_duration = BLOCKING_THRESHOLD
+        watchdog_stop.clear()
+        threading.Thread(target=loop_watchdog, name="loop-watchdog", daemon=True).start()
+        logger.info(f"Event loop debug mode, reporting stalls over {BLOCKING_THRESHOLD}s")
+
+
+async def stop_loop_watch():
+    watchdog_stop.set()
+    for task in loop_watch_tasks:
+        task.cancel()
+    await asyncio.gather(*loop_watch_tasks, return_exceptions=True)
+    loop_watch_tasks.clear()
+
+
+def sample_profile(seconds: float, all_threads: bool) -> dict[str, int]:
+    """
+    Sample the stacks of the event loop thread, or of all threads, for `seconds`.
+    Returns the sample counts per stack, folded outermost frame first as flamegraph.pl and speedscope read them.
+    """
+    counts = {}
+    own_thread = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread or (not all_threads and thread_id != loop_watch["thread"]):
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack = ";".join(reversed(frames))
+            counts[stack] = counts.get(stack, 0) + 1
+        time.sleep(PROFILE_INTERVAL)
+    return counts
+
+## JOB WORKSPACE ##
+def new_job_id() -> str:
+    """Returns a fresh, unguessable id for a generation request."""
+    return uuid.uuid4().hex
+
+
+def is_valid_job_id(job_id: str) -> bool:
+    """Job ids come from URLs, only accept the format produced by new_job_id()."""
+    return re.fullmatch(r"[0-9a-f]{32}", job_id or "") is not None
+
+
+def job_file(job_id: str, name: str = "output.html") -> str:
+    """Returns the path of a file inside the workspace folder of a job."""
+    return os.path.join(JOBS_FOLDER, job_id, name)
+
+
+def write_job_file(job_id: str, name: str, content: str):
+    """Atomically write a file in the job workspace.
+    Readers (possibly in another worker) never see a half written file.
+    """
+    path = job_file(job_id, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# The uploaded photo lives in the job workspace until the portrait is generated
+PHOTO_FILE = "photo.jpg"
+
+
+async def save_upload(upload: UploadFile, path: str):
+    """Copy an uploaded file to disk chunk by chunk, giving up beyond MAX_UPLOAD_BYTES."""
+    size = 0
+    with open(path, "wb") as file:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise ValueError(f"photo is larger than {MAX_UPLOAD_BYTES // 1024**2} MB")
+            file.write(chunk)
+
+
+def save_base64_image(data: str, path: str):
+    """Decode a base64 image, optionally a data url, to disk chunk by chunk."""
+    start = data.index(",") + 1 if data.startswith("data:image") else 0
+    if (len(data) - start) * 3 // 4 > MAX_UPLOAD_BYTES:
+        raise ValueError(f"photo is larger than {MAX_UPLOAD_BYTES // 1024**2} MB")
+    with open(path, "wb") as file:
+        for offset in range(start, len(data), UPLOAD_CHUNK_SIZE):
+            file.write(base64.b64decode(data[offset:offset + UPLOAD_CHUNK_SIZE]))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadLimit:
+    """
+    ASGI middleware that answers the requests to `paths` with a body beyond `max_bytes` with `response`,
+    by their Content-Length or while the body is received, before Starlette has spooled all of it to disk.
+    """
+    def __init__(self, app, paths: tuple[str, ...], max_bytes: int, response: Response):
+        self.app, self.paths, self.max_bytes, self.response = app, paths, max_bytes, response
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_bytes:
+            return await self.response(scope, receive, send)
+
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                raise UploadTooLarge()
+            return message
+        try:
+            await self.app(scope, limited_receive, send)
+        except UploadTooLarge:
+            # The route was still parsing the form, nothing was sent yet
+            logger.warning(f"Refused a request to {scope['path']} larger than {self.max_bytes} bytes")
+            await self.response(scope, receive, send)
+
+
+def normalize_image(src: str, dst: str, max_size: int):
+    """
+    EXIF-orient an image, downscale it to `max_size` on its long edge and re-encode it
+    as JPEG without metadata. CPU bound, run it in a thread.
+    """
+    with Image.open(src) as img:
+        # Let the JPEG decoder skip the resolution we are going to throw away
+        img.draft("RGB", (max_size, max_size))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    img.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmp_path, dst)
+
+
+def remove_job_photo(job_id: str):
+    """The photo is not needed anymore once the portrait exists or the job failed."""
+    path = job_file(job_id, PHOTO_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+        logger.info(f"Removed the photo of job {job_id}")
+
+
+## MEDIA ##
+MEDIA_MAX_AGE = 365 * 24 * 3600 # seconds, media urls never change their content
+
+
+@functools.lru_cache(maxsize=4096)
+def file_digest(path: str, mtime_ns: int, size: int) -> str:
+    """Content hash of one version of a file, computed once per version."""
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()[:16]
+
+
+def media_digest(path: str) -> str:
+    stat = os.stat(path)
+    return file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def etag_matches(request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+
+def cached_file_response(request, path: str, etag: str, cache_control: str):
+    """A file with validators: 304 when the client has it, Range requests are handled by FileResponse."""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers)
+
+## SIGNED URLS ##
+# Short-lived links to local files for the model APIs, served by /signed
+SIGNED_ROOTS = [os.path.abspath(folder) for folder in (GEN_FOLDER, JOBS_FOLDER)]
+
+
+def url_signature(path: str, expires: int) -> str:
+    return hmac.new(URL_SIGNING_KEY.encode(), f"{path}\n{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def signed_url(path: str) -> str:
+    """Public url of a local file, valid for SIGNED_URL_TTL seconds."""
+    path = os.path.abspath(path)
+    expires = int(time.time()) + SIGNED_URL_TTL
+    query = urlencode({"path": path, "expires": expires, "sig": url_signature(path, expires)})
+    return f"{PUBLIC_BASE_URL}/signed?{query}"
+
+
+def verify_signed_path(path: str, expires: int, sig: str) -> bool:
+    """A signed path is served until it expires, and only from SIGNED_ROOTS."""
+    if expires < time.time() or not hmac.compare_digest(url_signature(path, expires), sig):
+        return False
+    real_path = os.path.realpath(path)
+    return any(os.path.commonpath([real_path, root]) == root for root in SIGNED_ROOTS)
+
+
+def data_uri(path: str) -> str:
+    """Inline base64 payload of a photo."""
+    with open(path, "rb") as file:
+        return "data:image/jpeg;base64," + base64.b64encode(file.read()).decode()
+
+## ARTIFACT STORE ##
+# Generated assets are addressed by key, their file name. Every worker process keeps an index of the
+# stored assets for listing and eviction, updated by its own writes. Every STORE_SWEEP_INTERVAL the
+# leader rescans the store and publishes its index in the cache DB, with the access times of all the
+# workers, and the other workers take that index instead of scanning the store themselves.
+STAGING_FOLDER = os.path.join(GEN_FOLDER, ".staging") # downloads in progress, next to the local store
+os.makedirs(STAGING_FOLDER, exist_ok=True)
+
+
+class ArtifactStore:
+    """
+    Index, listing and eviction of the stored assets. Subclasses store the files:
+    scan, lookup, put_file, copy, fetch, remove, digest, source and file_path.
+    """
+    backend = ""
+
+    def __init__(self):
+        self.index: dict[str, dict] = {}
+        # The index is changed on the event loop and in the worker threads of asyncio.to_thread, e.g. by evict()
+        self.lock = threading.Lock()
+        # Assets used and removed by this worker since it last wrote them to the shared index, see share()
+        self.touched: dict[str, float] = {}
+        self.forgotten: set[str] = set()
+        self.evicted = 0
+
+    def load(self):
+        """
+        Index the stored assets. Access times are those seen by this worker,
+        they start at the modification time, see merge_access_times() for those of the others.
+        """
+        index = {}
+        for key, size, mtime, etag in self.scan():
+            known = self.index.get(key)
+            index[key] = {"size": size, "mtime": mtime, "accessed": known["accessed"] if known else mtime, "etag": etag}
+        with self.lock:
+            self.index = index
+
+    def record(self, key: str, size: int, mtime: float, etag: str = ""):
+        now = time.time()
+        with self.lock:
+            self.index[key] = {"size": size, "mtime": mtime, "accessed": now, "etag": etag}
+            self.touched[key] = now
+            self.forgotten.discard(key)
+
+    def snapshot(self) -> list[tuple[str, dict]]:
+        """The indexed assets, to iterate while the index changes."""
+        with self.lock:
+            return list(self.index.items())
+
+    def exists(self, key: str) -> bool:
+        """In the index, or stored by another worker since the index was built."""
+        if key in self.index:
+            return True
+        return bool(key) and key == os.path.basename(key) and not key.startswith(".") and self.lookup(key)
+
+    def forget(self, key: str):
+        """Drop an asset from the index, e.g. one evicted by another worker."""
+        with self.lock:
+            self.index.pop(key, None)
+            self.touched.pop(key, None)
+            self.forgotten.add(key)
+
+    def touch(self, key: str):
+        """Mark an asset as used, the least recently used are evicted first."""
+        now = time.time()
+        with self.lock:
+            entry = self.index.get(key)
+            if entry:
+                entry["accessed"] = now
+                self.touched[key] = now
+
+    def share(self) -> dict[str, dict]:
+        """Write the assets used and removed by this worker to the shared index, and return that index."""
+        with self.lock:
+            touched = [(key, self.index[key]["size"], self.index[key]["mtime"], self.index[key]["etag"], accessed)
+                       for key, accessed in self.touched.items() if key in self.index]
+            forgotten = [(key,) for key in self.forgotten]
+            self.touched, self.forgotten = {}, set()
+        with closing(cache_connect()) as con, con:
+            con.executemany("INSERT INTO assets (key, size, mtime, etag, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT (key) DO UPDATE SET accessed_at = MAX(accessed_at, excluded.accessed_at)", touched)
+            con.executemany("DELETE FROM assets WHERE key = ?", forgotten)
+            rows = con.execute("SELECT key, size, mtime, etag, accessed_at FROM assets").fetchall()
+        return {row[0]: {"size": row[1], "mtime": row[2], "accessed": row[4], "etag": row[3]} for row in rows}
+
+    def merge_access_times(self, shared: dict[str, dict]):
+        """Take the later access times of the other workers, before the leader evicts."""
+        with self.lock:
+            for key, entry in self.index.items():
+                if key in shared:
+                    entry["accessed"] = max(entry["accessed"], shared[key]["accessed"])
+
+    def publish(self, shared: dict[str, dict], scanned_at: float = 0.0):
+        """
+        Replace the shared index by the rescanned and evicted index of the leader.
+        Assets stored since the rescan started, by other workers, are kept.
+        """
+        rows = [(key, entry["size"], entry["mtime"], entry["etag"], entry["accessed"]) for key, entry in self.snapshot()]
+        with closing(cache_connect()) as con, con:
+            con.executemany("INSERT INTO assets (key, size, mtime, etag, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT (key) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, etag = excluded.etag, "
+                            "accessed_at = MAX(accessed_at, excluded.accessed_at)", rows)
+            indexed = {row[0] for row in rows}
+            con.executemany("DELETE FROM assets WHERE key = ?",
+                            [(key,) for key, entry in shared.items() if key not in indexed and entry["mtime"] < scanned_at])
+
+    def adopt(self, shared: dict[str, dict]):
+        """Take the index published by the leader instead of scanning the store, keeping the later access times of this worker."""
+        with self.lock:
+            for key, entry in shared.items():
+                known = self.index.get(key)
+                if known:
+                    entry["accessed"] = max(entry["accessed"], known["accessed"])
+            self.index = shared
+
+    def sweep(self, leader: bool) -> int:
+        """
+        Share the access times of this worker. The leader rescans the store, evicts by the access times
+        of all workers and publishes its index, the others take it. Returns how many assets were evicted.
+        """
+        if not leader:
+            self.adopt(self.share())
+            return 0
+        scanned_at = time.time()
+        self.load()
+        shared = self.share()
+        self.merge_access_times(shared)
+        evicted = self.evict()
+        self.publish(shared, scanned_at)
+        return evicted
+
+    def total_bytes(self) -> int:
+        return sum(entry["size"] for _, entry in self.snapshot())
+
+    def evict(self) -> int:
+        """Remove the assets older than ASSET_TTL, then the least recently used beyond STORE_MAX_BYTES."""
+        expired_before = time.time() - ASSET_TTL
+        entries = sorted(self.snapshot(), key=lambda item: item[1]["accessed"])
+        total = sum(entry["size"] for _, entry in entries)
+        evicted = 0
+        for key, entry in entries:
+            if total <= STORE_MAX_BYTES and entry["mtime"] > expired_before:
+                continue
+            try:
+                self.remove(key)
+            except Exception as e:
+                logger.warning(f"Could not evict asset {key}: {str(e)}")
+                continue
+            total -= entry["size"]
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def clear(self) -> int:
+        """Remove every stored asset, including those written by other processes. Returns how many."""
+        self.load()
+        keys = [key for key, _ in self.snapshot()]
+        for key in keys:
+            self.remove(key)
+        return len(keys)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "files": len(self.index),
+            "bytes": self.total_bytes(),
+            "max_bytes": STORE_MAX_BYTES,
+            "evicted": self.evicted,
+        }
+
+    def close(self):
+        pass
+
+
+class LocalStore(ArtifactStore):
+    """Files in GEN_FOLDER, spread over 256 sub-folders so none of them grows too large to list."""
+    backend = "local"
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+
+    def file_path(self, key: str) -> str:
+        shard = hashlib.sha1(key.encode()).hexdigest()[:2]
+        return os.path.join(self.root, shard, key)
+
+    def load(self):
+        # Assets used to be stored in GEN_FOLDER itself, move them into their shard
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith((".tmp", ".part")):
+                path = self.file_path(entry.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(entry.path, path)
+        super().load()
+
+    def scan(self):
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or not re.fullmatch(r"[0-9a-f]{2}", shard.name):
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and not entry.name.endswith((".tmp", ".part")):
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime, ""
+
+    def lookup(self, key: str) -> bool:
+        try:
+            stat = os.stat(self.file_path(key))
+        except OSError:
+            return False
+        self.record(key, stat.st_size, stat.st_mtime)
+        return True
+
+    def record_file(self, key: str):
+        stat = os.stat(self.file_path(key))
+        self.record(key, stat.st_size, stat.st_mtime)
+
+    def put_file(self, src: str, key: str):
+        """Move a local file into the store."""
+        path = self.file_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        move_file(src, path)
+        self.record_file(key)
+
+    def copy(self, src_key: str, dst_key: str):
+        """A hard link, its modification time is reset so the copy gets its full ASSET_TTL."""
+        path = self.file_path(dst_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(self.file_path(src_key), path)
+        os.utime(path)
+        self.touch(src_key)
+        self.record_file(dst_key)
+
+    def fetch(self, key: str, path: str):
+        """Put a local copy of an asset at `path`, a hard link that outlives the eviction of the asset."""
+        link_file(self.file_path(key), path)
+        self.touch(key)
+
+    def remove(self, key: str):
+        self.forget(key)
+        try:
+            os.remove(self.file_path(key))
+        except FileNotFoundError:
+            pass
+
+    def digest(self, key: str) -> str:
+        return media_digest(self.file_path(key))
+
+    def source(self, key: str) -> str:
+        """What a model API reads the asset from: a signed url if the app is public, else the path for gradio to upload."""
+        path = self.file_path(key)
+        return signed_url(path) if PUBLIC_BASE_URL else path
+
+
+class S3Store(ArtifactStore):
+    """
+    Objects in a bucket of S3-compatible storage, addressed path-style so MinIO works without DNS setup.
+    Requests are signed with AWS Signature Version 4; browsers and model APIs get presigned urls.
+    """
+    backend = "s3"
+
+    def __init__(self, endpoint_url: str, bucket: str, region: str, access_key_id: str, secret_access_key: str):
+        super().__init__()
+        self.endpoint_url = endpoint_url
+        self.host = urlsplit(endpoint_url).netloc
+        self.bucket = bucket
+        self.region = region
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        # Called from worker threads (asyncio.to_thread), like the other blocking file operations
+        self.client = httpx.Client(timeout=httpx.Timeout(60, connect=10))
+
+    def object_path(self, key: str) -> str:
+        return quote(f"/{self.bucket}/{key}")
+
+    def url(self, key: str, query: dict) -> str:
+        return f"{self.endpoint_url}{self.object_path(key)}?{self.canonical_query(query)}"
+
+    @staticmethod
+    def canonical_query(query: dict) -> str:
+        return "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted(query.items()))
+
+    def signature(self, method: str, key: str, query: dict, headers: dict, amz_date: str) -> str:
+        """Signature of a request whose payload is not signed, headers have lower case names."""
+        canonical_request = "\n".join([
+            method,
+            self.object_path(key),
+            self.canonical_query(query),
+            "".join(f"{name}:{headers[name].strip()}\n" for name in sorted(headers)),
+            ";".join(sorted(headers)),
+            "UNSIGNED-PAYLOAD",
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, self.scope(amz_date), hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+        signing_key = f"AWS4{self.secret_access_key}".encode()
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        return hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    def scope(self, amz_date: str) -> str:
+        return f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+
+    def request(self, method: str, key: str = "", query: dict | None = None, headers: dict | None = None,
+                stream: bool = False, **kwargs) -> httpx.Response:
+        query = query or {}
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        headers = {**(headers or {}), "host": self.host, "x-amz-content-sha256": "UNSIGNED-PAYLOAD", "x-amz-date": amz_date}
+        signature = self.signature(method, key, query, headers, amz_date)
+        headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={self.access_key_id}/{self.scope(amz_date)}, "
+                                    f"SignedHeaders={';'.join(sorted(headers))}, Signature={signature}")
+        request = self.client.build_request(method, self.url(key, query), headers=headers, **kwargs)
+        response = self.client.send(request, stream=stream)
+        if response.status_code >= 400:
+            response.read()
+            response.close()
+        response.raise_for_status()
+        return response
+
+    def scan(self):
+        query = {"list-type": "2"}
+        while True:
+            listing = ElementTree.fromstring(self.request("GET", query=query).content)
+            for item in listing.iterfind("{*}Contents"):
+                mtime = dt.datetime.fromisoformat(item.findtext("{*}LastModified")).timestamp()
+                yield item.findtext("{*}Key"), int(item.findtext("{*}Size")), mtime, item.findtext("{*}ETag").strip('"')
+            if listing.findtext("{*}IsTruncated") != "true":
+                break
+            query["continuation-token"] = listing.findtext("{*}NextContinuationToken")
+
+    def lookup(self, key: str) -> bool:
+        try:
+            response = self.request("HEAD", key)
+        except httpx.HTTPError:
+            return False
+        mtime = parsedate_to_datetime(response.headers["last-modified"]).timestamp()
+        self.record(key, int(response.headers["content-length"]), mtime, response.headers.get("etag", "").strip('"'))
+        return True
+
+    def put_file(self, src: str, key: str):
+        """Upload a local file, which is removed afterwards."""
+        size = os.path.getsize(src)
+        with open(src, "rb") as file:
+            response = self.request("PUT", key, content=file,
+                                    headers={"content-type": mimetypes.guess_type(key)[0] or "application/octet-stream"})
+        self.record(key, size, time.time(), response.headers.get("etag", "").strip('"'))
+        os.remove(src)
+
+    def copy(self, src_key: str, dst_key: str):
+        response = self.request("PUT", dst_key, headers={"x-amz-copy-source": self.object_path(src_key)})
+        etag = ElementTree.fromstring(response.content).findtext("{*}ETag") or ""
+        self.touch(src_key)
+        self.record(dst_key, self.index.get(src_key, {}).get("size", 0), time.time(), etag.strip('"'))
+
+    def fetch(self, key: str, path: str):
+        """Download an asset to `path`."""
+        tmp_path = f"{path}.{os.getpid()}.part"
+        response = self.request("GET", key, stream=True)
+        try:
+            with open(tmp_path, "wb") as file:
+                for chunk in response.iter_bytes(64 * 1024):
+                    file.write(chunk)
+        finally:
+            response.close()
+        os.replace(tmp_path, path)
+        self.touch(key)
+
+    def remove(self, key: str):
+        self.forget(key)
+        self.request("DELETE", key)
+
+    def digest(self, key: str) -> str:
+        return self.index[key]["etag"][:16]
+
+    def source(self, key: str) -> str:
+        """Presigned url of an object, valid for SIGNED_URL_TTL seconds."""
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        query = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.access_key_id}/{self.scope(amz_date)}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(SIGNED_URL_TTL),
+            "X-Amz-SignedHeaders": "host",
+        }
+        query["X-Amz-Signature"] = self.signature("GET", key, query, {"host": self.host}, amz_date)
+        return self.url(key, query)
+
+    def file_path(self, key: str) -> None:
+        return None # not on local disk, see source()
+
+    def close(self):
+        self.client.close()
+
+
+if STORE_BACKEND == "s3":
+    artifact_store = S3Store(S3_ENDPOINT_URL, S3_BUCKET, S3_REGION, S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY)
+else:
+    artifact_store = LocalStore(GEN_FOLDER)
+store_tasks: list[asyncio.Task] = []
+
+
+def asset_url(key: str) -> str:
+    """Immutable url of a generated asset, served by /media. It changes with the content of the file."""
+    return f"/media/{key}/{artifact_store.digest(key)}"
+
+
+async def sweep_artifact_store():
+    """Every STORE_SWEEP_INTERVAL seconds, sync the index with the other workers. The oldest worker evicts."""
+    while True:
+        await asyncio.sleep(STORE_SWEEP_INTERVAL)
+        try:
+            evicted = await asyncio.to_thread(artifact_store.sweep, is_leader())
+            if evicted:
+                logger.info(f"Evicted {evicted} assets, the artifact store holds {artifact_store.total_bytes()} bytes")
+        except Exception as e:
+            logger.error(f"Eviction of the artifact store failed: {str(e)}")
+
+
+async def start_artifact_store():
+    """Index the stored assets and start evicting them in the background."""
+    await asyncio.to_thread(artifact_store.load)
+    # The shared index holds every asset before the leader's first sweep, the others may sync before it
+    await asyncio.to_thread(artifact_store.publish, {})
+    logger.info(f"Artifact store ({artifact_store.backend}) holds {len(artifact_store.index)} assets, "
+                f"{artifact_store.total_bytes()} bytes")
+    store_tasks.append(asyncio.create_task(sweep_artifact_store()))
+
+
+async def stop_artifact_store():
+    for task in store_tasks:
+        task.cancel()
+    await asyncio.gather(*store_tasks, return_exceptions=True)
+    store_tasks.clear()
+    artifact_store.close()
+
 ## MODEL CALLS ##
 def get_image_caption() -> str:
     llm_prompt = f"""Provide a detailed caption for the image provided. 
@@ -67,22 +1065,268 @@ Use the section headers below:
     return llm_prompt, image_prompt
 
 
+class HtmlStreamCleaner:
+    """
+    Incremental counterpart of cleanup_html_output for the streamed LLM output.
+    Drops anything before <!DOCTYPE html> and after </html>, e.g. markdown fences.
+    Missing closing tags are only fixed by cleanup_html_output on the complete text.
+    """
+    max_preamble = 2048 # give up looking for the doctype after this many characters
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.closed = False
+
+    def feed(self, text: str) -> str:
+        """Returns the part of the text that can be sent to the browser."""
+        if self.closed:
+            return ""
+        self.buffer += text
+        if not self.started:
+            doctype_pos = self.buffer.find("<!DOCTYPE html>")
+            if doctype_pos == -1 and len(self.buffer) < self.max_preamble:
+                return ""
+            self.started = True
+            self.buffer = self.buffer[max(doctype_pos, 0):]
+
+        end_pos = self.buffer.find("</html>")
+        if end_pos != -1:
+            self.closed = True
+            text, self.buffer = self.buffer[:end_pos + len("</html>")], ""
+            return text
+        # Hold back what could be the start of a </html> split across chunks
+        split = max(len(self.buffer) - len("</html>") + 1, 0)
+        text, self.buffer = self.buffer[:split], self.buffer[split:]
+        return text
+
+    def finish(self) -> str:
+        """Returns whatever was still held back once the LLM is done."""
+        text, self.buffer = self.buffer, ""
+        self.closed = True
+        return text
+
+
+# Slots of the page template, filled with the generated assets of the job whenever the page is served
+PORTRAIT_SLOT = "{{portrait_src}}"
+VIDEO_SLOT = "{{video_src}}"
+PORTRAIT_PLACEHOLDER = "/static/portrait.jpg"
+VIDEO_PLACEHOLDER = "/static/portrait.mp4"
+
+
 def cleanup_html_output(content: str) -> str:
-    """Cleans up the HTML output from the LLM by extracting the <!DOCTYPE html> to </html> block."""
+    """Cleans up the HTML output from the LLM by extracting the <!DOCTYPE html> to </html> block.
+    Finalizes the page after it was streamed through HtmlStreamCleaner, into a template
+    whose portrait and video sources are slots (see render_job_page).
+    """
     # Find the position of <!DOCTYPE html> and rmeove anything before it
     doctype_pos = content.find("<!DOCTYPE html>")
     if doctype_pos != -1:
         content = content[doctype_pos:]
     # Fill missing closing html tags automatically after parsing
     parsed_html = BeautifulSoup(content, 'html.parser')
+    for tag, element_id, slot in (("img", "portrait-image", PORTRAIT_SLOT), ("video", "portrait-video", VIDEO_SLOT)):
+        element = parsed_html.find(tag, id=element_id)
+        if element is None:
+            logger.warning(f"Element {element_id} not found in the generated page")
+            continue
+        element['src'] = slot
+        if tag == "video":
+            # Autoloop the video
+            element['loop'] = ""
     return parsed_html.prettify()
 
 
-async def call_anthropic(prompt: str, image: str="", is_url: bool=False) -> str:
-    """Call an Anthropic/Claude-style LLM endpoint."""
-    client = AsyncAnthropic(
-        api_key=llm_api_key
-    )
+class TokenBucket:
+    """
+    Tokens per minute budget shared by all LLM calls.
+    Callers wait in FIFO order until enough tokens have been refilled.
+    """
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.released = asyncio.Event()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    async def acquire(self, tokens: int) -> int:
+        """Take tokens from the budget, returns how many were taken."""
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.tokens < tokens:
+                # Sleep until refilled, or until a finished call gives back its unused tokens
+                self.released.clear()
+                try:
+                    await asyncio.wait_for(self.released.wait(), (tokens - self.tokens) * 60 / self.capacity)
+                except TimeoutError:
+                    pass
+                self.refill()
+            self.tokens -= tokens
+        return tokens
+
+    def release(self, tokens: int):
+        """Give back tokens that were reserved but not used, negative to take more."""
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + tokens)
+        if tokens > 0:
+            self.released.set()
+
+
+llm_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+llm_input_budget = TokenBucket(LLM_INPUT_TOKENS_PER_MINUTE)
+llm_output_budget = TokenBucket(LLM_OUTPUT_TOKENS_PER_MINUTE)
+
+# Calls, tokens and latency of the LLM calls of this process, per purpose
+llm_stats: dict[str, dict] = {}
+
+
+def record_llm_call(label: str, **values):
+    stats = llm_stats.setdefault(label, {
+        "calls": 0, "errors": 0, "input_tokens": 0, "output_tokens": 0,
+        "queue_seconds": 0.0, "first_token_seconds": 0.0, "seconds": 0.0,
+    })
+    for name, value in values.items():
+        stats[name] += value
+
+
+def llm_stats_summary() -> dict:
+    """Totals and average latencies per purpose, as reported by /jobs/stats."""
+    summary = {}
+    for label, stats in llm_stats.items():
+        calls = max(stats["calls"], 1)
+        summary[label] = {
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "input_tokens": stats["input_tokens"],
+            "output_tokens": stats["output_tokens"],
+            "avg_queue_seconds": round(stats["queue_seconds"] / calls, 2),
+            "avg_first_token_seconds": round(stats["first_token_seconds"] / calls, 2),
+            "avg_seconds": round(stats["seconds"] / calls, 2),
+        }
+    return summary
+
+
+## RESULT CACHE ##
+# LLM results keyed by a hash of everything that goes into the call
+CACHE_DB = os.path.join(JOBS_FOLDER, "cache.db")
+
+# Hits and misses of the result cache in this process, per purpose
+cache_stats: dict[str, dict] = {}
+
+
+def cache_connect() -> sqlite3.Connection:
+    return sqlite3.connect(CACHE_DB, timeout=30)
+
+
+def init_cache_db():
+    with closing(cache_connect()) as con, con:
+        # Shared by all worker processes, readers and the writer do not block each other
+        con.execute("PRAGMA journal_mode = WAL")
+        columns = [row[1] for row in con.execute("PRAGMA table_info(portraits)")]
+        if columns and "photo_digest" not in columns:
+            # Portraits cached by file path, before the artifact store, or shared by all clients.
+            # Their files age out of the store.
+            con.execute("DROP TABLE IF EXISTS portraits")
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed_at);
+            CREATE TABLE IF NOT EXISTS portraits (
+                key TEXT PRIMARY KEY,
+                prompt_key TEXT NOT NULL,
+                photo_hash TEXT NOT NULL,
+                photo_digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS portraits_prompt ON portraits (prompt_key);
+            CREATE TABLE IF NOT EXISTS assets (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                etag TEXT NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+        """)
+
+
+def result_cache_key(*parts: str | bytes) -> str:
+    """Content address of a call: sha256 over its length-prefixed parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode() if isinstance(part, str) else part
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def cache_get(key: str, label: str) -> str | None:
+    """Returns the cached result, None when missing or older than CACHE_TTL."""
+    now = time.time()
+    with closing(cache_connect()) as con, con:
+        row = con.execute("SELECT value FROM results WHERE key = ? AND created_at > ?", (key, now - CACHE_TTL)).fetchone()
+        if row is not None:
+            con.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+    count_cache_lookup(label, row is not None)
+    return row[0] if row is not None else None
+
+
+def count_cache_lookup(label: str, hit: bool):
+    stats = cache_stats.setdefault(label, {"hits": 0, "misses": 0})
+    stats["hits" if hit else "misses"] += 1
+    cache_lookups.inc(cache=label, result="hit" if hit else "miss")
+
+
+def cache_put(key: str, value: str):
+    """Store a result, then evict expired entries and the least recently used beyond CACHE_MAX_ENTRIES."""
+    now = time.time()
+    with closing(cache_connect()) as con, con:
+        con.execute("INSERT OR REPLACE INTO results (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now))
+        con.execute("DELETE FROM results WHERE created_at <= ?", (now - CACHE_TTL,))
+        con.execute("""
+            DELETE FROM results WHERE key IN (
+                SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (CACHE_MAX_ENTRIES,))
+
+
+def cache_stats_summary() -> dict:
+    summary = {}
+    for label, stats in cache_stats.items():
+        lookups = stats["hits"] + stats["misses"]
+        summary[label] = {**stats, "hit_ratio": round(stats["hits"] / lookups, 3) if lookups else 0.0}
+    return summary
+
+
+async def call_anthropic(prompt: str, image: str="", is_url: bool=False, on_text=None,
+                         max_tokens: int=8192, label: str="text", cache: bool=True) -> str:
+    """Call an Anthropic/Claude-style LLM endpoint.
+    `on_text` is called with every chunk of text as it is generated.
+    Identical calls are answered from the result cache unless `cache` is False.
+    Waits for a concurrency slot and for the tokens per minute budget before calling.
+    `label` groups the calls in llm_stats and cache_stats.
+    """
+    # File and SQLite reads go to a thread, they would stall the event loop for every connected user
+    image_bytes = await asyncio.to_thread(Path(image).read_bytes) if len(image) and not is_url else b""
+    cache_key = result_cache_key(LLM_MODEL, str(max_tokens), prompt, image if is_url else "", image_bytes)
+    if cache:
+        content = await asyncio.to_thread(cache_get, cache_key, label)
+        if content is not None:
+            if on_text:
+                on_text(content)
+            return content
 
     if len(image):
             if is_url:
@@ -102,7 +1346,7 @@ async def call_anthropic(prompt: str, image: str="", is_url: bool=False) -> str:
                             "source": {
                                     "type": "base64",
                                     "media_type": "image/jpeg",
-                                    "data": base64.b64encode(open(image, "rb").read()).decode('utf-8'),
+                                    "data": base64.b64encode(image_bytes).decode('utf-8'),
                             },
                         },
                         {
@@ -113,55 +1357,92 @@ async def call_anthropic(prompt: str, image: str="", is_url: bool=False) -> str:
     else:
         input = prompt
 
-    async with client.messages.stream(
-        model="claude-sonnet-4-5-20250929",
-        messages=[
-            {"role": "user", "content": input}
-        ],
-        max_tokens=8192,
-    ) as stream:
-        # Consume the stream without printing
-        async for text in stream.text_stream:
-            pass
-    
-    # Get the complete text after streaming is done
-    content = await stream.get_final_text()
-    final_message = await stream.get_final_message()
-    output_tokens = final_message.usage.output_tokens
-
-    logger.info(f"Used {output_tokens} output tokens.")
+    # Rough input estimate (4 characters per token, an image is about 1600 tokens),
+    # the output budget reserves max_tokens and gets back what was not used
+    queued_at = time.time()
+    input_tokens = await llm_input_budget.acquire(len(prompt) // 4 + (1600 if len(image) else 0))
+    output_tokens = await llm_output_budget.acquire(max_tokens)
+    try:
+        async with llm_slots:
+            started_at = time.time()
+            first_token_at = None
+            with span(f"llm_{label}"):
+                async with llm_client.messages.stream(
+                    model=LLM_MODEL,
+                    messages=[
+                        {"role": "user", "content": input}
+                    ],
+                    max_tokens=max_tokens,
+                ) as stream:
+                    # Consume the stream, handing the chunks to the caller if it wants them
+                    async for text in stream.text_stream:
+                        first_token_at = first_token_at or time.time()
+                        if on_text:
+                            on_text(text)
+
+                    # Get the complete text after streaming is done
+                    content = await stream.get_final_text()
+                    final_message = await stream.get_final_message()
+    except Exception:
+        llm_output_budget.release(output_tokens)
+        record_llm_call(label, calls=1, errors=1, queue_seconds=time.time() - queued_at)
+        raise
+
+    # Settle the reservations with the real usage, an underestimate is taken from the budget
+    usage = final_message.usage
+    llm_input_budget.release(input_tokens - usage.input_tokens)
+    llm_output_budget.release(output_tokens - usage.output_tokens)
+    finished_at = time.time()
+    record_llm_call(
+        label,
+        calls=1,
+        input_tokens=usage.input_tokens,
+        output_tokens=usage.output_tokens,
+        queue_seconds=started_at - queued_at,
+        first_token_seconds=(first_token_at or finished_at) - started_at,
+        seconds=finished_at - started_at,
+    )
+    llm_queue_seconds.observe(started_at - queued_at, purpose=label)
+    llm_first_token_seconds.observe((first_token_at or finished_at) - started_at, purpose=label)
+    llm_tokens.inc(usage.input_tokens, purpose=label, direction="input")
+    llm_tokens.inc(usage.output_tokens, purpose=label, direction="output")
+    if cache:
+        await asyncio.to_thread(cache_put, cache_key, content)
+    logger.info(f"LLM call {label}: {usage.input_tokens} input and {usage.output_tokens} output tokens, "
+                f"first token after {(first_token_at or finished_at) - started_at:.1f}s, "
+                f"{finished_at - started_at:.1f}s in total, {started_at - queued_at:.1f}s queued.")
     return content
 
 
-def upload_photo(file_path: str) -> str:
-    """Upload user photo to imgBB for temp storagecwith an expiration time.
+async def upload_photo(file_path: str) -> str:
+    """Upload user photo to imgBB for temp storage with an expiration time.
     Returns the url of the uploaded image.
     """
     image_url = ""
     if not os.path.exists(file_path):
-        print(f"Error: File {file_path} does not exist")
+        logger.error(f"Error: File {file_path} does not exist")
         return image_url
 
-    api_url="https://api.imgbb.com/1/upload"
+    api_url = IMGBB_API_URL
     parameters = {"expiration": 600, "key": img_service_key} # photo is deleted after 10 minutes
 
-    with open(file_path, 'rb') as f:
-        files = {'image': f}
-        response = httpx.post(api_url, files=files, params=parameters)
-        response.raise_for_status()
-        json_data = json.loads(response.content.decode('utf-8'))
-        image_url = json_data['data']['image']['url']
-        logger.info(f"Upload successful! Download url: {image_url}")
+    # Read in a thread, httpx would read the file object on the event loop
+    files = {'image': (os.path.basename(file_path), await asyncio.to_thread(Path(file_path).read_bytes))}
+    response = await http_client.post(api_url, files=files, params=parameters)
+    response.raise_for_status()
+    json_data = response.json()
+    image_url = json_data['data']['image']['url']
+    logger.info(f"Upload successful! Download url: {image_url}")
     return image_url
 
 
-def call_generate_image(face_image_url: str, prompt: str) -> str:
+async def call_generate_image(face_image_url: str, prompt: str) -> str:
     """Call a generative image API to produce an image of the person in the job role.
     Returns request ID of image.
     """
     return_val = ""
 
-    url = "https://api.wavespeed.ai/api/v3/bytedance/seedream-v4/edit"
+    url = f"{WAVESPEED_API_URL}/bytedance/seedream-v4/edit"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {gen_image_api_key}",
@@ -173,7 +1454,7 @@ def call_generate_image(face_image_url: str, prompt: str) -> str:
         "prompt": prompt,
         "size": "1024*1536" # Portrait orientation 2:3
     }
-    response = httpx.post(url, headers=headers, json=payload, timeout=60)
+    response = await http_client.post(url, headers=headers, json=payload)
     response.raise_for_status()
     result = response.json()["data"]
     request_id = result["id"]
@@ -182,26 +1463,31 @@ def call_generate_image(face_image_url: str, prompt: str) -> str:
     return return_val
 
 
-def poll_generated_result(request_id: str) -> str:
+async def poll_generated_result(request_id: str) -> str:
     """Poll for the result of the generated image/video from request id.
+    The poll interval backs off from POLL_INTERVAL up to POLL_MAX_INTERVAL seconds.
     Returns url or base64 string.
     """
-    url = f"https://api.wavespeed.ai/api/v3/predictions/{request_id}/result"
+    url = f"{WAVESPEED_API_URL}/predictions/{request_id}/result"
     headers = {"Authorization": f"Bearer {gen_image_api_key}"}
     return_val = ""
 
     # Poll for results
     begin = time.time()
-    status = "in progress"
+    interval = POLL_INTERVAL
+
+    while time.time() - begin < POLL_TIMEOUT:
+        try:
+            response = await http_client.get(url, headers=headers)
+        except httpx.TransportError as e:
+            # Connection hiccups are retried like a busy server
+            logger.warning(f"Polling {request_id} failed: {str(e)}")
+            response = None
 
-    while status != "completed":
-        response = httpx.get(url, headers=headers)
-        if response.status_code == 200:
+        if response is not None and response.status_code == 200:
             result_json = response.json()["data"]
             status = result_json["status"]
             if status == "completed":
-                end = time.time()
-                logger.info(f"Task completed in {end - begin} seconds.")
                 return_val = result_json["outputs"][0]
                 break
             elif status == "failed":
@@ -209,18 +1495,23 @@ def poll_generated_result(request_id: str) -> str:
                 break
             else:
                 logger.info(f"Task still processing. Status: {status}")
-        else:
+        elif response is not None and response.status_code not in RETRY_STATUS_CODES:
             logger.error(f"Error: {response.status_code}, {response.text}")
             break
-        time.sleep(1)
+        await asyncio.sleep(interval)
+        interval = min(interval * 1.5, POLL_MAX_INTERVAL)
+    else:
+        logger.error(f"Task {request_id} timed out after {POLL_TIMEOUT} seconds.")
+    # Time to complete, from the first poll right after the submission
+    record_span("seedream", begin, ok=bool(return_val))
     return return_val
 
 
-def download_generated_result(request_id: str, url: str) -> str:
-    """Download generated image/video from url.
-    Returns local path of saved image/video"""
-    saved_image_path = f"{GEN_FOLDER}/{request_id}.jpeg"
-    saved_video_path = f"{GEN_FOLDER}/{request_id}.mp4"
+async def download_generated_result(request_id: str, url: str) -> str:
+    """Download generated image/video from url into the artifact store.
+    Returns the key of the saved image/video"""
+    image_key = f"{request_id}.jpeg"
+    video_key = f"{request_id}.mp4"
     return_val = ""
 
     if "data:image/jpeg;base64" in url:
@@ -229,37 +1520,73 @@ def download_generated_result(request_id: str, url: str) -> str:
         content = url.split(',')
         img_bytes = base64.b64decode(content[1])
 
-        with open(saved_image_path, 'wb') as f:
+        staging_path = os.path.join(STAGING_FOLDER, image_key)
+        with open(staging_path, 'wb') as f:
             f.write(img_bytes)
-            return_val = saved_image_path
-            logger.info(f"Saved generated image to {saved_image_path}")
+        await asyncio.to_thread(artifact_store.put_file, staging_path, image_key)
+        return_val = image_key
+        logger.info(f"Saved generated image {image_key}")
 
     elif ".jpeg" in url:
-            response = httpx.get(url)
-            response.raise_for_status()
-            with open(saved_image_path, 'wb') as f:
-                f.write(response.content)
-                return_val = saved_image_path
-                logger.info(f"Saved generated image to {saved_image_path}")
+            await download_to_store(url, image_key)
+            return_val = image_key
+            logger.info(f"Saved generated image {image_key}")
 
     elif ".mp4" in url:
-            response = httpx.get(url)
-            response.raise_for_status()
-            with open(saved_video_path, 'wb') as f:
-                f.write(response.content)
-                return_val = saved_video_path
-                logger.info(f"Saved generated video to {saved_video_path}")
+            await download_to_store(url, video_key)
+            return_val = video_key
+            logger.info(f"Saved generated video {video_key}")
 
     else:
         logger.error(f"Error: download failed!")
     return return_val
 
 
+async def download_to_file(url: str, path: str, max_bytes: int | None = None):
+    """
+    Stream a remote file to disk, readers only ever see the complete file.
+    Beyond `max_bytes`, by its Content-Length or while it is received, the download fails.
+    """
+    tmp_path = f"{path}.{os.getpid()}.part"
+    try:
+        with span("download"):
+            async with http_client.stream("GET", url) as response:
+                response.raise_for_status()
+                length = response.headers.get("Content-Length", "")
+                if max_bytes is not None and length.isdigit() and int(length) > max_bytes:
+                    raise ValueError(f"file is larger than {max_bytes // 1024**2} MB")
+                size = 0
+                with open(tmp_path, 'wb') as f:
+                    async for chunk in response.aiter_bytes(64 * 1024):
+                        size += len(chunk)
+                        if max_bytes is not None and size > max_bytes:
+                            raise ValueError(f"file is larger than {max_bytes // 1024**2} MB")
+                        f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+async def download_to_store(url: str, key: str):
+    """Download a remote file to the staging folder, then move it into the artifact store."""
+    staging_path = os.path.join(STAGING_FOLDER, key)
+    await download_to_file(url, staging_path)
+    await asyncio.to_thread(artifact_store.put_file, staging_path, key)
+
+
+@functools.cache
+def hf_space_client() -> Client:
+    """Gradio client of the video Space, created once since it fetches the Space config."""
+    return Client(hf_space_url, token=hf_api_key)
+
+
 def call_generate_video(image_url: str, scene_prompt: str) -> Job:
     """Call video generation model
-    Returns local path to generated video file.
+    Returns the gradio job handle of the generated video.
     """
-    client = Client(hf_space_url, token=hf_api_key)
+    client = hf_space_client()
     job = client.submit(
         input_image=handle_file(image_url),
         prompt=scene_prompt,
@@ -275,287 +1602,1616 @@ def call_generate_video(image_url: str, scene_prompt: str) -> Job:
     return job
 
 
-def portrait_reload(id: str):
-    """Update the portrait image in output.html and trigger UI refresh"""
-    image_path = f"{GEN_FOLDER}/{id}.jpeg"
-    if os.path.exists(image_path):
-        logger.info(f"Found generated image for {id}, updating output.html")
-        # Open output.html and replace the image src using sync file operations
-        with open("output.html", "r+") as file:
-            html_content = file.read()
-            soup = BeautifulSoup(html_content, 'html.parser')
-        
-            # Find the portrait image element by ID and update it
-            portrait_img = soup.find('img', id='portrait-image')
-            if portrait_img:
-                portrait_img['src'] = image_path
-                logger.info(f"Updated image src to {image_path}")
-                file.seek(0)
-                file.write(str(soup))
-                file.truncate()
-                logger.info("Successfully updated output.html")
-                
-                # Return elements for immediate UI update
-                # Update the iframe src to force refresh with cache busting
-                timestamp = int(time.time())
-                
-                # Create updated iframe element
-                show_iframe = Iframe(
-                    src=f"/output_file?refresh={timestamp}",
-                    style="width:100%; height:80vh; border:0; display:block;",
-                    title="Generated biography",
-                    id="content-iframe",
-                    hx_swap_oob="true"
-                )
+## PORTRAIT CACHE ##
+# Generated portraits keyed by the client, the image prompt and the photo: a perceptual hash
+# finds the candidates, the digest of the normalized photo confirms it is the same one.
+# The cache keeps its own copy of every portrait in the artifact store, so evicting an
+# entry never breaks the page of a job and a job never breaks the cache.
+def photo_hash(path: str) -> int:
+    """64 bit difference hash of a photo, stable across re-encoding, resizing and metadata."""
+    with Image.open(path) as img:
+        pixels = list(ImageOps.exif_transpose(img).convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
 
-                # Remove the polling element since we're done
-                stop_polling = Div("", id="polling-placeholder", hx_swap_oob="true")
-                # Also hide the header spinner (out-of-band swap)
-                hide_header_spinner = Div("", id="title-spinner", hx_swap_oob="true")
 
-                # Start video generation after portrait image is downloaded
-                vid_task = BackgroundTask(video_tasks, id, image_path)
+def photo_digest(path: str) -> str:
+    """sha256 of the normalized photo, the same for the same photo submitted again."""
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
 
-                return show_iframe, stop_polling, hide_header_spinner, vid_task
-            else:
-                logger.warning("Portrait image element not found in output.html")
-                return Div("Portrait image element not found", id="polling-placeholder", hx_swap_oob="true")
-    else:
-        logger.info(f"Generated image for {id} not found yet, continuing to poll")
-        # Continue polling
-        portrait_poller = Div(
-            "🔄 Portrait generation in progress...",
-            id="polling-placeholder",
-            hx_post=f"/portrait_img/{id}",
-            hx_trigger="every 1s",
-            hx_swap="outerHTML",
-            style="background-color: #f0f8ff; padding: 10px; margin: 10px 0; border: 1px solid #ccc; border-radius: 5px;"
+
+def hash_distance(a: str, b: str) -> int:
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def link_file(src: str, dst: str):
+    """Atomically put a hard link of src at dst, a copy where the filesystem has no hard links."""
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def move_file(src: str, dst: str):
+    """Atomically move src to dst: a rename, or a copy and rename across filesystems."""
+    try:
+        os.replace(src, dst)
+    except OSError:
+        link_file(src, dst)
+        os.remove(src)
+
+
+def portrait_cache_get(client: str, image_prompt: str, hash_hex: str, digest: str) -> str | None:
+    """Store key of a portrait generated for this client from the same photo with the same prompt."""
+    prompt_key = result_cache_key(client, image_prompt)
+    with closing(cache_connect()) as con, con:
+        rows = con.execute("SELECT key, photo_hash, photo_digest FROM portraits WHERE prompt_key = ?", (prompt_key,)).fetchall()
+        candidates = sorted((hash_distance(hash_hex, row[1]), row[0]) for row in rows if row[2] == digest)
+        for distance, key in candidates:
+            if distance > PORTRAIT_HASH_DISTANCE:
+                break
+            if not artifact_store.exists(key):
+                # Evicted by the artifact store or removed by /assets/clear_all
+                con.execute("DELETE FROM portraits WHERE key = ?", (key,))
+                continue
+            con.execute("UPDATE portraits SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            count_cache_lookup("portrait", True)
+            return key
+    count_cache_lookup("portrait", False)
+    return None
+
+
+def portrait_cache_put(client: str, image_prompt: str, hash_hex: str, digest: str, image_key: str):
+    """Keep a generated portrait, then evict the least recently used beyond PORTRAIT_CACHE_MAX_BYTES."""
+    prompt_key = result_cache_key(client, image_prompt)
+    key = f"portrait-{digest[:16]}-{prompt_key[:16]}.jpeg"
+    artifact_store.copy(image_key, key)
+    now = time.time()
+    with closing(cache_connect()) as con, con:
+        con.execute("INSERT OR REPLACE INTO portraits (key, prompt_key, photo_hash, photo_digest, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, prompt_key, hash_hex, digest, artifact_store.index[key]["size"], now, now))
+        total = 0
+        evicted = []
+        for row in con.execute("SELECT key, size FROM portraits ORDER BY accessed_at DESC").fetchall():
+            total += row[1]
+            if total > PORTRAIT_CACHE_MAX_BYTES:
+                evicted.append(row[0])
+        con.executemany("DELETE FROM portraits WHERE key = ?", [(k,) for k in evicted])
+    for evicted_key in evicted:
+        artifact_store.remove(evicted_key)
+    if evicted:
+        logger.info(f"Evicted {len(evicted)} portraits from the cache")
+
+
+## VIDEO JOBS ##
+# Gradio jobs of the videos being generated, keyed by image id
+video_jobs: dict[str, dict] = {}
+hf_space_slots = asyncio.Semaphore(HF_SPACE_MAX_JOBS)
+
+
+def video_job_status(video_id: str) -> str:
+    """Status of a video in this process: queued, submitted, a gradio status code or empty."""
+    entry = video_jobs.get(video_id)
+    return entry["status"] if entry else ""
+
+
+async def generate_video(video_id: str, image_url: str, scene_prompt: str, on_status=None) -> str:
+    """
+    Generate the video of an image on the HF Space.
+    Waits for one of HF_SPACE_MAX_JOBS slots, then polls the gradio job without blocking the loop.
+    `on_status` is awaited whenever the status of the video changes.
+    Returns the key of the video in the artifact store.
+    """
+    if video_id in video_jobs:
+        raise RuntimeError(f"video {video_id} is already being generated")
+    entry = video_jobs[video_id] = {"job": None, "status": "queued"}
+    # Spans of the wait for a slot and the Space queue, then of the generation itself
+    queued_at, running_at, ok = time.time(), None, False
+    try:
+        async with hf_space_slots:
+            entry["job"] = job = await asyncio.to_thread(call_generate_video, image_url, scene_prompt)
+            entry["status"] = "submitted"
+            if on_status:
+                await on_status()
+            logger.info(f"Started video generation with id: {video_id}")
+
+            begin = time.time()
+            while not job.done():
+                if time.time() - begin > VIDEO_TIMEOUT:
+                    job.cancel()
+                    raise TimeoutError(f"video {video_id} timed out after {VIDEO_TIMEOUT} seconds")
+                status = job.status().code.name
+                if running_at is None and status in ("PROCESSING", "ITERATING", "PROGRESS"):
+                    running_at = time.time()
+                    record_span("hf_video_queue", queued_at, ok=True)
+                if status != entry["status"]:
+                    logger.info(f"video gen status of {video_id}: {status}")
+                    entry["status"] = status
+                    if on_status:
+                        await on_status()
+                if status == "CANCELLED":
+                    raise RuntimeError(f"video {video_id} was cancelled")
+                await asyncio.sleep(VIDEO_POLL_INTERVAL)
+            if running_at is None:
+                # Done between two polls, the queue span includes the generation
+                running_at = time.time()
+                record_span("hf_video_queue", queued_at, ok=True)
+
+            # The job is done, so result() returns without waiting
+            result_dict, _ = await asyncio.to_thread(job.result)
+            if not result_dict.get("video"):
+                raise RuntimeError(f"video {video_id} has no result file")
+
+        # Move the file downloaded by gradio into the artifact store
+        entry["status"] = "FINALIZING"
+        if on_status:
+            await on_status()
+        video_key = f"{video_id}.mp4"
+        await asyncio.to_thread(artifact_store.put_file, result_dict["video"], video_key)
+        entry["status"] = "FINISHED"
+        logger.info(f"Video generation of {video_id} completed")
+        ok = True
+        return video_key
+    finally:
+        video_jobs.pop(video_id, None)
+        if running_at is None:
+            record_span("hf_video_queue", queued_at, ok=False)
+        else:
+            record_span("hf_video_run", running_at, ok)
+
+
+## JOB ENGINE ##
+# A generation is one job record whose branches run concurrently, each branch runs its stages in order.
+# Every stage transition is persisted in SQLite, so jobs resume after a restart.
+BRANCHES = [
+    ["text"],
+    ["normalize", "upload", "image", "caption", "video_prompt", "video"],
+]
+STAGES = [stage for branch in BRANCHES for stage in branch]
+NEXT_STAGE = {stage: next_stage for branch in BRANCHES for stage, next_stage in zip(branch, branch[1:])}
+DONE = "done"
+
+# Size of the worker pool of each stage
+STAGE_WORKERS = {
+    "text": int(os.environ.get("TEXT_WORKERS", 16)),
+    "normalize": os.cpu_count() or 4,
+    "upload": 16,
+    "image": WAVESPEED_MAX_JOBS,
+    "caption": 16,
+    "video_prompt": 16,
+    "video": int(os.environ.get("VIDEO_WORKERS", 4)), # waits for HF_SPACE_MAX_JOBS slots
+}
+MAX_STAGE_ATTEMPTS = 3
+RETRY_DELAY = 5 # seconds, multiplied by the attempt number
+SSE_PING_INTERVAL = 15 # seconds between keep-alive comments of the progress stream
+
+# The biography is streamed to the browser from this file while the LLM writes it
+PARTIAL_HTML = "output.partial.html"
+BIOGRAPHY_TAIL_INTERVAL = 0.1 # seconds between reads of the growing biography
+
+JOBS_DB = os.path.join(JOBS_FOLDER, "jobs.db")
+
+# Worker processes (uvicorn --workers) share the job database. A stage is run by the worker that
+# queued it, the stages of a worker that stopped sending heartbeats are taken over by the others.
+WORKER_ID = f"{os.getpid()}-{secrets.token_hex(4)}"
+WORKER_HEARTBEAT_INTERVAL = 5 # seconds
+WORKER_TIMEOUT = 30 # seconds without a heartbeat before a worker counts as gone
+JOB_POLL_INTERVAL = 1.0 # seconds between checks for changes of a job made by other workers
+
+stage_queues: dict[str, asyncio.Queue] = {}
+engine_workers: list[asyncio.Task] = []
+job_events: dict[str, asyncio.Event] = {}
+live_workers: list[str] = [] # ids of the live workers, oldest first
+orphans_swept_at = 0.0 # when this worker last removed the orphan photos, as the leader
+
+
+class PermanentStageError(Exception):
+    """A stage failure that a retry would not fix, e.g. a photo that is not an image. It fails the job at once."""
+
+
+def db_connect() -> sqlite3.Connection:
+    con = sqlite3.connect(JOBS_DB, timeout=30)
+    con.row_factory = sqlite3.Row
+    return con
+
+
+@contextmanager
+def db_transaction():
+    """A transaction that takes the write lock up front, for read-modify-write of job records across workers."""
+    con = db_connect()
+    con.isolation_level = None
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        yield con
+        con.execute("COMMIT")
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+
+def init_jobs_db():
+    with closing(db_connect()) as con, con:
+        # Readers and the writer do not block each other, so workers can poll the jobs of others
+        con.execute("PRAGMA journal_mode = WAL")
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                results TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE TABLE IF NOT EXISTS stage_runs (
+                job_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                finished_at REAL NOT NULL,
+                ok INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS stage_runs_started ON stage_runs (started_at);
+            CREATE TABLE IF NOT EXISTS spans (
+                job_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                finished_at REAL NOT NULL,
+                ok INTEGER NOT NULL,
+                worker TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS spans_job ON spans (job_id);
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                text_mode TEXT NOT NULL,
+                message_batch TEXT,
+                worker TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS batch_records (
+                batch_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                job_id TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                PRIMARY KEY (batch_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                started_at REAL NOT NULL,
+                heartbeat REAL NOT NULL,
+                metrics TEXT NOT NULL DEFAULT '{}'
+            );
+        """)
+    # The first worker migrates, the others wait for the lock and find it done
+    with db_transaction() as con:
+        columns = [row["name"] for row in con.execute("PRAGMA table_info(jobs)")]
+        if "stages" not in columns:
+            migrate_linear_jobs(con)
+        if "metrics" not in [row["name"] for row in con.execute("PRAGMA table_info(workers)")]:
+            con.execute("ALTER TABLE workers ADD COLUMN metrics TEXT NOT NULL DEFAULT '{}'")
+        if con.execute("PRAGMA user_version").fetchone()[0] < 1:
+            migrate_asset_paths(con)
+            con.execute("PRAGMA user_version = 1")
+
+
+def migrate_linear_jobs(con: sqlite3.Connection):
+    """Jobs of the former single chain of stages: every stage before the current one is done."""
+    con.execute("ALTER TABLE jobs ADD COLUMN stages TEXT NOT NULL DEFAULT '{}'")
+    for row in con.execute("SELECT id, stage, status, attempts FROM jobs").fetchall():
+        position = STAGES.index(row["stage"]) if row["stage"] in STAGES else len(STAGES)
+        stages = {stage: {"status": DONE, "attempts": 0} for stage in STAGES[:position]}
+        if row["stage"] in STAGES:
+            stages[row["stage"]] = {"status": row["status"], "attempts": row["attempts"]}
+        con.execute("UPDATE jobs SET stages = ? WHERE id = ?", (json.dumps(stages), row["id"]))
+
+
+def migrate_asset_paths(con: sqlite3.Connection):
+    """Results of jobs from before the artifact store hold the paths of their assets, the store uses their file names."""
+    for row in con.execute("SELECT id, results FROM jobs").fetchall():
+        results = json.loads(row["results"])
+        for path_name, key_name in (("image_path", "image_key"), ("video_path", "video_key")):
+            if path_name in results:
+                results[key_name] = os.path.basename(results.pop(path_name))
+        con.execute("UPDATE jobs SET results = ? WHERE id = ?", (json.dumps(results), row["id"]))
+
+
+def first_stages() -> dict:
+    """The stages of a starting job: the first of every branch, owned by this worker."""
+    return {branch[0]: {"status": "pending", "attempts": 0, "worker": WORKER_ID} for branch in BRANCHES}
+
+
+def create_job(job_id: str, params: dict, queued: bool = False):
+    """
+    Insert a new job at the first stage of every branch, owned by this worker. Submitting the same id twice is a no-op.
+    A queued job has no stage yet, it waits in the admission queue of this worker.
+    """
+    now = time.time()
+    status, stages = ("queued", {}) if queued else ("pending", first_stages())
+    results = {"queue_worker": WORKER_ID} if queued else {}
+    with closing(db_connect()) as con, con:
+        con.execute(
+            "INSERT OR IGNORE INTO jobs (id, stage, status, params, results, stages, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, STAGES[0], status, json.dumps(params), json.dumps(results), json.dumps(stages), now, now),
         )
-        # Also trigger showing the header spinner via an out-of-band swap so
-        # the small spinner in the header becomes visible while polling.
-        show_header_spinner = Div(cls="spinner", id="title-spinner", style="display:inline", hx_swap_oob="true")
-        return portrait_poller, show_header_spinner
 
 
-def video_reload(vid: str):
-    """Update the video in output.html and trigger UI refresh"""
-    if os.path.exists(f"{GEN_FOLDER}/{vid}.mp4"):
-        logger.info(f"Found generated video for {vid}, updating output.html")
-        
-        # Open output.html and replace the video src using sync file operations
-        with open("output.html", "r+") as file:
-            html_content = file.read()
-            soup = BeautifulSoup(html_content, 'html.parser')
-        
-            # Find the video element by ID and update it, autoloop
-            video_tag = soup.find('video', id='portrait-video')
-            if video_tag:
-                video_tag['loop'] = ""
-                video_tag['src'] = f"{GEN_FOLDER}/{vid}.mp4"
-                
-                file.seek(0)
-                file.write(str(soup))
-                file.truncate()
-                logger.info("Successfully updated output.html")
-                
-                # Return elements for immediate UI update
-                # Update the iframe src to force refresh with cache busting
-                timestamp = int(time.time())
-                
-                # Create updated iframe element
-                show_iframe = Iframe(
-                    src=f"/output_file?refresh={timestamp}",
-                    style="width:100%; height:80vh; border:0; display:block;",
-                    title="Generated biography",
-                    id="content-iframe",
-                    hx_swap_oob="true"
-                )
+def start_branches(job: dict, stages: list[str]):
+    """Move a queued job to the first stage of these branches, owned by this worker. It leaves the queue with its last branch."""
+    job["stages"].update({stage: {"status": "pending", "attempts": 0, "worker": WORKER_ID} for stage in stages})
+    job["results"].pop("queue_position", None)
+    if all(branch[0] in job["stages"] for branch in BRANCHES):
+        job["results"].pop("queue_worker", None)
+    if job["status"] == "queued":
+        job["status"] = "pending"
+
+
+def start_queued_branches(job_id: str, stages: list[str]) -> bool:
+    """Start the admitted branches of a queued job. False if it left the queue meanwhile, e.g. failed."""
+    with db_transaction() as con:
+        job = read_job(con, job_id)
+        if job is None or "queue_worker" not in job["results"] or job["status"] not in ("queued", "pending", "running"):
+            return False
+        start_branches(job, stages)
+        write_job(con, job_id, status=job["status"], stages=job["stages"], results=job["results"])
+    return True
+
+
+def read_job(con: sqlite3.Connection, job_id: str) -> dict | None:
+    row = con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["results"] = json.loads(job["results"])
+    job["stages"] = json.loads(job["stages"])
+    return job
 
-                # Remove the polling element since we're done
-                stop_polling = Div("", id="video-placeholder", hx_swap_oob="true")
-                # Also hide the header spinner (out-of-band swap)
-                hide_header_spinner = Div("", id="title-spinner", hx_swap_oob="true")
 
-                return show_iframe, stop_polling, hide_header_spinner
-            else:
-                logger.warning("Video element not found in output.html")
-                return Div("Video element not found", id="video-placeholder", hx_swap_oob="true")
-    else:
-        logger.info(f"Generated video for {vid} not found yet, continuing to poll")
-        # Continue polling
-        video_poller = Div(
-            "🔄 Video generation in progress...",
-            id="video-placeholder",
-            hx_post=f"/video_status/{vid}",
-            hx_trigger="every 2s",
-            hx_swap="outerHTML",
-            style="background-color: #f0f8ff; padding: 10px; margin: 10px 0; border: 1px solid #ccc; border-radius: 5px;"
+def write_job(con: sqlite3.Connection, job_id: str, **fields):
+    for name in ("results", "stages"):
+        if name in fields:
+            fields[name] = json.dumps(fields[name])
+    fields["updated_at"] = time.time()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    con.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+
+def get_job(job_id: str) -> dict | None:
+    with closing(db_connect()) as con:
+        return read_job(con, job_id)
+
+
+def merge_job_results(job_id: str, **values):
+    """Persist intermediate results of a running stage, e.g. the id of a submitted request."""
+    with db_transaction() as con:
+        results = read_job(con, job_id)["results"]
+        results.update(values)
+        write_job(con, job_id, results=results)
+
+
+def record_stage_run(job_id: str, stage: str, started_at: float, ok: bool):
+    stages_in_flight.inc(-1, stage=stage)
+    stage_seconds.observe(time.time() - started_at, stage=stage, outcome="ok" if ok else "error")
+    with closing(db_connect()) as con, con:
+        con.execute(
+            "INSERT INTO stage_runs (job_id, stage, started_at, finished_at, ok) VALUES (?, ?, ?, ?, ?)",
+            (job_id, stage, started_at, time.time(), int(ok)),
         )
 
-        # Also trigger showing the header spinner via an out-of-band swap so
-        # the small spinner in the header becomes visible while polling.
-        show_header_spinner = Div(cls="spinner", id="title-spinner", style="display:inline", hx_swap_oob="true")
 
-        return video_poller, show_header_spinner
+def stage_status(job: dict, stage: str) -> str:
+    """pending, running, done or failed. Empty while the stage before it has not finished."""
+    return job["stages"].get(stage, {}).get("status", "")
+
+
+def owns_stage(job: dict | None, stage: str, status: str) -> bool:
+    """The stage has this status and belongs to this worker, i.e. was not taken over by another one."""
+    return job is not None and stage_status(job, stage) == status and job["stages"][stage].get("worker") == WORKER_ID
+
 
+def notify_job(job_id: str):
+    """Wake up everyone waiting for a change of this job in this worker."""
+    event = job_events.pop(job_id, None)
+    if event:
+        event.set()
 
-def start_portrait_generation(photo_path: str, image_prompt: str)-> tuple[str, BackgroundTask]:
+
+async def job_changes(job_id: str, timeout: float):
     """
-    Start portrait generation and return request_id immediately.
-    The actual image generation happens in background.
+    Yields the job record now, after every change and at least every `timeout` seconds.
+    Changes made by this worker wake it up at once, those of other workers are polled every JOB_POLL_INTERVAL.
     """
-    # Upload photo and start generation (these are quick)
-    photo_url = upload_photo(photo_path)
-    request_id = call_generate_image(photo_url, image_prompt)
-    
-    # Start the polling and download in background
-    btask = BackgroundTask(complete_portrait_generation, request_id=request_id)
-    return request_id, btask
+    last_update, last_yield = -1.0, time.monotonic()
+    while True:
+        # Register before reading so a transition in between is not missed
+        event = job_events.setdefault(job_id, asyncio.Event())
+        job = await asyncio.to_thread(get_job, job_id)
+        update = job and job["updated_at"]
+        if update != last_update or time.monotonic() - last_yield >= timeout:
+            last_update, last_yield = update, time.monotonic()
+            yield job
+        try:
+            await asyncio.wait_for(event.wait(), JOB_POLL_INTERVAL)
+        except TimeoutError:
+            pass
+
 
-def complete_portrait_generation(request_id: str):
+def enqueue_job(job_id: str, stage: str):
+    stage_queues[stage].put_nowait(job_id)
+
+
+def claim_stage(job_id: str, stage: str) -> dict | None:
+    """Mark a pending stage of this worker running. None for a stale queue entry."""
+    with db_transaction() as con:
+        job = read_job(con, job_id)
+        if job is None or job["status"] == "failed" or not owns_stage(job, stage, "pending"):
+            return None
+        # The `stage` column holds the stage that changed last
+        job["stages"][stage]["status"] = "running"
+        write_job(con, job_id, stage=stage, status="running", stages=job["stages"])
+    return job
+
+
+def fail_stage(job_id: str, stage: str, error: Exception) -> tuple[int, bool] | None:
+    """Count a failed attempt of a running stage. Returns the attempts and whether to retry, None if it was taken over."""
+    with db_transaction() as con:
+        # Read again, the other branches may have moved on meanwhile
+        job = read_job(con, job_id)
+        if not owns_stage(job, stage, "running"):
+            return None
+        attempts = job["stages"][stage]["attempts"] + 1
+        job["stages"][stage]["attempts"] = attempts
+        retry = attempts < MAX_STAGE_ATTEMPTS and not isinstance(error, PermanentStageError)
+        if retry:
+            job["stages"][stage]["status"] = "pending"
+            write_job(con, job_id, stage=stage, stages=job["stages"], error=str(error))
+        else:
+            # One failed branch fails the job, the other branches stop after their running stage
+            job["stages"][stage]["status"] = "failed"
+            write_job(con, job_id, stage=stage, stages=job["stages"], status="failed", error=str(error))
+    return attempts, retry
+
+
+def finish_stage(job_id: str, stage: str, new_results: dict) -> dict | None:
+    """Persist the results of a stage and move its branch to the next stage. None if the stage was taken over."""
+    with db_transaction() as con:
+        job = read_job(con, job_id)
+        if not owns_stage(job, stage, "running"):
+            return None
+        job["results"].update(new_results)
+        job["stages"][stage] = {"status": DONE, "attempts": 0}
+        next_stage = NEXT_STAGE.get(stage)
+        if next_stage and job["status"] != "failed":
+            job["stages"][next_stage] = {"status": "pending", "attempts": 0, "worker": WORKER_ID}
+        if job["status"] != "failed":
+            finished = all(stage_status(job, branch[-1]) == DONE for branch in BRANCHES)
+            job["status"] = DONE if finished else "running"
+            job["error"] = None
+        write_job(con, job_id, stage=stage, status=job["status"], stages=job["stages"], results=job["results"], error=job["error"])
+    return job
+
+
+async def run_stage(job_id: str, stage: str):
     """
-    Complete the portrait generation in background.
-    Polls for result and downloads when ready.
-    Triggers immediate UI update when generation is complete.
+    Run one stage of a job, persist the outcome and queue the next stage of its branch.
+    The transactions run in threads, they wait for the write lock while another worker holds it.
     """
+    current_job_id.set(job_id)
+    job = await asyncio.to_thread(claim_stage, job_id, stage)
+    if job is None:
+        return # stale queue entry
+    started_at = time.time()
+    stages_in_flight.inc(stage=stage)
     try:
-        download_url = poll_generated_result(request_id)
-        download_generated_result(request_id, download_url)
-        logger.info(f"Portrait generation completed for request_id: {request_id}")
+        new_results = await STAGE_HANDLERS[stage](job)
     except Exception as e:
-        logger.error(f"Background portrait generation failed for {request_id}: {str(e)}")
+        await asyncio.to_thread(record_stage_run, job_id, stage, started_at, False)
+        outcome = await asyncio.to_thread(fail_stage, job_id, stage, e)
+        if outcome is None:
+            logger.warning(f"Stage {stage} of job {job_id} was taken over by another worker")
+            return
+        attempts, retry = outcome
+        if retry:
+            logger.warning(f"Stage {stage} of job {job_id} failed (attempt {attempts}), retrying: {str(e)}")
+            asyncio.get_running_loop().call_later(RETRY_DELAY * attempts, enqueue_job, job_id, stage)
+        else:
+            logger.error(f"Stage {stage} of job {job_id} failed: {str(e)}")
+            remove_job_photo(job_id)
+        notify_job(job_id)
+        if not retry:
+            release_admission(job_id)
+            await pump_admission()
+        return
+
+    await asyncio.to_thread(record_stage_run, job_id, stage, started_at, True)
+    job = await asyncio.to_thread(finish_stage, job_id, stage, new_results)
+    if job is None:
+        logger.warning(f"Stage {stage} of job {job_id} was taken over by another worker")
+        return
+    next_stage = NEXT_STAGE.get(stage)
+    logger.info(f"Job {job_id} finished stage {stage} in {time.time() - started_at:.1f} seconds")
+    if stage == "image" or job["status"] == "failed":
+        remove_job_photo(job_id)
+    notify_job(job_id)
+    if next_stage and job["status"] != "failed":
+        enqueue_job(job_id, next_stage)
+    if job["status"] in (DONE, "failed"):
+        release_admission(job_id)
+    else:
+        release_admission(job_id, stage)
+    await pump_admission()
 
 
-async def start_video_generation_workflow(image_id: str, gen_image_path: str):
+async def stage_worker(stage: str):
+    queue = stage_queues[stage]
+    while True:
+        job_id = await queue.get()
+        try:
+            await run_stage(job_id, stage)
+        except Exception as e:
+            logger.error(f"Worker of stage {stage} failed on job {job_id}: {str(e)}")
+        finally:
+            queue.task_done()
+
+
+async def start_job_engine():
+    """Start the worker pools, register this worker and resume the jobs of workers that are gone, e.g. before a restart."""
+    init_jobs_db()
+    for stage in STAGES:
+        stage_queues[stage] = asyncio.Queue()
+        for _ in range(STAGE_WORKERS[stage]):
+            engine_workers.append(asyncio.create_task(stage_worker(stage)))
+
+    await check_workers()
+    engine_workers.append(asyncio.create_task(send_heartbeats()))
+
+
+def worker_heartbeat() -> list[str]:
     """
-    Start the complete video generation workflow in background.
-    This runs after the portrait image is ready.
+    Mark this worker alive, with a snapshot of its metrics, and forget the workers gone silent.
+    Returns the ids of the live workers, oldest first.
     """
-    global video_gen_job
+    now = time.time()
+    with closing(db_connect()) as con, con:
+        con.execute(
+            "INSERT INTO workers (id, pid, started_at, heartbeat, metrics) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat, metrics = excluded.metrics",
+            (WORKER_ID, os.getpid(), now, now, json.dumps(metrics_snapshot())),
+        )
+        con.execute("DELETE FROM workers WHERE heartbeat < ?", (now - WORKER_TIMEOUT,))
+        return [row["id"] for row in con.execute("SELECT id FROM workers ORDER BY started_at, id")]
+
+
+def adopt_orphaned_stages(workers: list[str]) -> list[tuple[str, str]]:
+    """Take over the pending and running stages of workers that are gone. Returns the (job id, stage) to queue."""
+    adopted = []
+    with db_transaction() as con:
+        for row in con.execute("SELECT id FROM jobs WHERE status IN ('pending', 'running') ORDER BY created_at").fetchall():
+            job = read_job(con, row["id"])
+            orphaned = [stage for stage in STAGES if stage_status(job, stage) in ("pending", "running")
+                        and job["stages"][stage].get("worker") not in workers]
+            for stage in orphaned:
+                job["stages"][stage].update(status="pending", worker=WORKER_ID)
+                adopted.append((job["id"], stage))
+            if orphaned:
+                write_job(con, job["id"], stages=job["stages"])
+        # The branches queued by a worker that is gone are admitted at once, like its resumed stages
+        for row in con.execute("SELECT id FROM jobs WHERE status IN ('queued', 'pending', 'running') ORDER BY created_at").fetchall():
+            job = read_job(con, row["id"])
+            if job["results"].get("queue_worker", WORKER_ID) in workers:
+                continue
+            queued = [branch[0] for branch in BRANCHES if branch[0] not in job["stages"]]
+            start_branches(job, queued)
+            write_job(con, job["id"], status=job["status"], stages=job["stages"], results=job["results"])
+            adopted += [(job["id"], stage) for stage in queued]
+    return adopted
+
+
+def is_leader() -> bool:
+    """The oldest live worker does the chores of all of them, like evicting the artifact store."""
+    return bool(live_workers) and live_workers[0] == WORKER_ID
+
+
+async def check_workers():
+    global live_workers, orphans_swept_at
+    live_workers = await asyncio.to_thread(worker_heartbeat)
+    adopted = await asyncio.to_thread(adopt_orphaned_stages, live_workers)
+    for job_id, stage in adopted:
+        enqueue_job(job_id, stage)
+    if adopted:
+        logger.info(f"Resumed {len(adopted)} stages of {len({job_id for job_id, _ in adopted})} unfinished jobs")
+    for batch_id in await asyncio.to_thread(adopt_orphaned_batches, live_workers):
+        logger.info(f"Resumed batch {batch_id}")
+        start_batch(batch_id)
+    await expire_admission_queue()
+    if is_leader() and time.time() - orphans_swept_at > ORPHAN_SWEEP_INTERVAL:
+        orphans_swept_at = time.time()
+        await asyncio.to_thread(remove_orphan_photos)
+
+
+async def send_heartbeats():
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            await check_workers()
+        except Exception as e:
+            logger.error(f"Heartbeat of worker {WORKER_ID} failed: {str(e)}")
+
+
+def remove_orphan_photos():
+    """Remove the photos of submissions that were never processed into a job."""
+    for job_id in os.listdir(JOBS_FOLDER):
+        path = job_file(job_id, PHOTO_FILE)
+        if is_valid_job_id(job_id) and os.path.exists(path) and time.time() - os.path.getmtime(path) > ORPHAN_PHOTO_TTL:
+            if get_job(job_id) is None:
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+async def stop_job_engine():
+    tasks = [*engine_workers, *batch_tasks.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    engine_workers.clear()
+    # The other workers take over the unfinished stages of this one at their next heartbeat
+    with closing(db_connect()) as con, con:
+        con.execute("DELETE FROM workers WHERE id = ?", (WORKER_ID,))
+
+
+def job_status_counts() -> dict:
+    with closing(db_connect()) as con:
+        return {row["status"]: row["count"] for row in con.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")}
+
+
+def stage_stats(since: float) -> dict:
+    """Runs, failures, latency and throughput per stage since a timestamp."""
+    with closing(db_connect()) as con:
+        rows = con.execute("""
+            SELECT stage, COUNT(*) AS runs, SUM(1 - ok) AS failures,
+                   AVG(finished_at - started_at) AS avg_seconds,
+                   MAX(finished_at - started_at) AS max_seconds
+            FROM stage_runs WHERE started_at >= ? GROUP BY stage
+        """, (since,)).fetchall()
+    minutes = max((time.time() - since) / 60, 1)
+    stats = {}
+    for row in rows:
+        stats[row["stage"]] = {
+            "runs": row["runs"],
+            "failures": row["failures"],
+            "avg_seconds": round(row["avg_seconds"], 2),
+            "max_seconds": round(row["max_seconds"], 2),
+            "per_minute": round((row["runs"] - row["failures"]) / minutes, 2),
+            "queued": stage_queues[row["stage"]].qsize() if row["stage"] in stage_queues else 0,
+        }
+    return stats
+
+
+# Stage handlers take the job record and return the results to persist
+async def run_text_stage(job: dict) -> dict:
+    """
+    Generate the biography and write it to the job's output.html.
+    While the LLM is writing, the cleaned chunks are appended to PARTIAL_HTML
+    which /output_file/{id} streams to the browser. It is removed once the stage
+    is over, whether it succeeded, failed or was cancelled.
+    """
+    params = job["params"]
+    llm_prompt, _ = prepare_prompt(params["name"], params["job"], params["place"])
+    cleaner = HtmlStreamCleaner()
+    partial_path = job_file(job["id"], PARTIAL_HTML)
     try:
-        # Generate caption for the image
-        caption = await call_anthropic(get_image_caption(), gen_image_path)
-        video_prompt = await call_anthropic(prepare_video_prompt(caption))
-        image_url = poll_generated_result(image_id)
-        # Call gen video API
-        video_gen_job = call_generate_video(image_url, video_prompt)
-        logger.info(f"Started video generation with id: {image_id}")        
-    except Exception as e:
-        logger.error(f"Video generation workflow failed for {gen_image_path}: {str(e)}")
+        with open(partial_path, "wb") as partial:
+            def on_text(text: str):
+                partial.write(cleaner.feed(text).encode())
+                partial.flush()
+            html_out = await call_anthropic(llm_prompt, on_text=on_text, max_tokens=BIOGRAPHY_MAX_TOKENS)
+            partial.write(cleaner.finish().encode())
+        write_job_file(job["id"], "output.html", cleanup_html_output(html_out))
+    finally:
+        # The streams that opened it read it to the end, the later ones send output.html
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+    return {}
 
 
-async def poll_video_generation_status(video_id: str):
-    while True:
-        status = video_gen_job.status()
-        logger.info(f"video gen status: {status.code.name}")
-        if status.code.name == "FINISHED":
-            complete_video_generation(video_id)
-            break
-        if status.code.name == "CANCELLED":
-            break
-        await asyncio.sleep(5)
+async def run_normalize_stage(job: dict) -> dict:
+    """Orient, downscale and strip the photo in place before it is hashed and uploaded."""
+    photo_path = job["params"]["photo_path"]
+    try:
+        await asyncio.to_thread(normalize_image, photo_path, photo_path, PHOTO_MAX_SIZE)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise PermanentStageError(f"the photo is not a supported image: {str(e)}") from e
+    logger.info(f"Normalized the photo of job {job['id']} to {os.path.getsize(photo_path)} bytes")
+    return {}
+
+
+async def run_upload_stage(job: dict) -> dict:
+    """Upload the photo, unless its client got a portrait of the same photo and prompt from the cache."""
+    params = job["params"]
+    hashes = {}
+    if params.get("client"): # jobs submitted before the cache was scoped to clients do not use it
+        try:
+            hashes = {"photo_hash": f"{await asyncio.to_thread(photo_hash, params['photo_path']):016x}",
+                      "photo_digest": await asyncio.to_thread(photo_digest, params["photo_path"])}
+        except Exception as e:
+            logger.warning(f"Could not hash the photo of job {job['id']}, skipping the portrait cache: {str(e)}")
+
+    cached_key = hashes and await asyncio.to_thread(portrait_cache_get, params["client"], params["image_prompt"],
+                                                    hashes["photo_hash"], hashes["photo_digest"])
+    if cached_key:
+        # The job gets its own copy, the image stage has nothing left to do
+        image_key = f"{job['id']}.jpeg"
+        await asyncio.to_thread(artifact_store.copy, cached_key, image_key)
+        logger.info(f"Reused cached portrait {cached_key} for job {job['id']}")
+        return {**hashes, "image_id": job["id"], "image_key": image_key}
+
+    if PHOTO_TRANSPORT != "imgbb":
+        return hashes # the image stage hands the photo over itself
+    with span("imgbb_upload"):
+        photo_url = await upload_photo(params["photo_path"])
+    if not photo_url:
+        raise RuntimeError("photo upload failed")
+    return {**hashes, "photo_url": photo_url}
+
+
+async def photo_reference(job: dict) -> str:
+    """The photo as WaveSpeed gets it, see PHOTO_TRANSPORT. Built at submission so a signed url is fresh."""
+    photo_path = job["params"]["photo_path"]
+    if PHOTO_TRANSPORT == "signed":
+        return signed_url(photo_path)
+    if PHOTO_TRANSPORT == "base64":
+        return await asyncio.to_thread(data_uri, photo_path)
+    return job["results"]["photo_url"]
+
+
+async def run_image_stage(job: dict) -> dict:
+    """Generate the portrait. A request submitted before a restart is polled again, not re-submitted."""
+    results = job["results"]
+    if results.get("image_key"):
+        return {} # served from the portrait cache by the upload stage
+    image_id = results.get("image_id")
+    if not image_id:
+        image_reference = await photo_reference(job)
+        with span("seedream_submit"):
+            image_id = await call_generate_image(image_reference, job["params"]["image_prompt"])
+        await asyncio.to_thread(merge_job_results, job["id"], image_id=image_id)
+
+    image_url = await poll_generated_result(image_id)
+    if not image_url:
+        # The prediction is lost, a retry has to submit a new one
+        await asyncio.to_thread(merge_job_results, job["id"], image_id=None)
+        raise RuntimeError(f"portrait generation {image_id} failed")
+    image_key = await download_generated_result(image_id, image_url)
+    if not image_key:
+        raise RuntimeError(f"download of portrait {image_id} failed")
+    if results.get("photo_digest"):
+        await asyncio.to_thread(portrait_cache_put, job["params"]["client"], job["params"]["image_prompt"],
+                                results["photo_hash"], results["photo_digest"], image_key)
+    return {"image_id": image_id, "image_url": image_url, "image_key": image_key}
+
+
+async def run_caption_stage(job: dict) -> dict:
+    """Caption a downscaled copy of the portrait, the full size only costs vision tokens."""
+    portrait_path, caption_path = job_file(job["id"], "portrait.jpeg"), job_file(job["id"], "caption.jpg")
+    try:
+        await asyncio.to_thread(artifact_store.fetch, job["results"]["image_key"], portrait_path)
+        await asyncio.to_thread(normalize_image, portrait_path, caption_path, CAPTION_MAX_SIZE)
+        caption = await call_anthropic(get_image_caption(), caption_path, max_tokens=1024, label="caption")
+    finally:
+        for path in (portrait_path, caption_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return {"caption": caption}
+
+
+async def run_video_prompt_stage(job: dict) -> dict:
+    video_prompt = await call_anthropic(prepare_video_prompt(job["results"]["caption"]), max_tokens=1024, label="video_prompt")
+    return {"video_prompt": video_prompt}
+
+
+async def run_video_stage(job: dict) -> dict:
+    results = job["results"]
+    video_id = results["image_id"]
+    # A cached portrait has no WaveSpeed URL, the Space fetches it from the artifact store or gradio uploads it
+    image_source = results.get("image_url") or artifact_store.source(results["image_key"])
+
+    async def on_status():
+        # Persisted, the progress stream of the job may be served by another worker
+        await asyncio.to_thread(merge_job_results, job["id"], video_status=video_job_status(video_id))
+        notify_job(job["id"])
+
+    video_key = await generate_video(video_id, image_source, results["video_prompt"], on_status=on_status)
+    return {"video_key": video_key}
+
+
+STAGE_HANDLERS = {
+    "text": run_text_stage,
+    "normalize": run_normalize_stage,
+    "upload": run_upload_stage,
+    "image": run_image_stage,
+    "caption": run_caption_stage,
+    "video_prompt": run_video_prompt_stage,
+    "video": run_video_stage,
+}
+
+
+## ADMISSION ##
+# A job is admitted branch by branch: a branch starts while every one of its stages has room, i.e. fewer than
+# its STAGE_CAPACITY of the admitted jobs are at that stage, running it or waiting for it. So a backlog in front of
+# the video stage holds up the portraits of new jobs, but not their biographies. Jobs beyond that wait in the
+# admission queue, as job records with the status "queued" and their position in the queue for the progress stream,
+# until their first branch starts; a job with a branch still waiting stays in the queue for it.
+# The queue holds a FIFO per client, the clients take turns, so one busy client does not hold up the others.
+STAGE_CAPACITY = {stage: max(int(STAGE_WORKERS[stage] * ADMISSION_STAGE_FACTOR), 1) for stage in STAGES}
+BUSY_MESSAGE = "Fauxpedia is very busy right now, please try again in a few minutes."
+
+admitted_jobs: dict[str, dict] = {} # job id -> the stage each of its started branches is at, and when it was admitted
+admission_queue: dict[str, deque] = {} # client -> its queued jobs, the clients in the order of their turns
+
+admission_queued = Metric("fauxpedia_admission_queued", "gauge", "Jobs waiting in the admission queue.")
+admission_admitted = Metric("fauxpedia_admission_admitted", "gauge", "Admitted jobs that are not finished.")
+admissions = Metric("fauxpedia_admissions_total", "counter", "Submissions by admission outcome.", ("outcome",))
+admission_wait = Metric("fauxpedia_admission_wait_seconds", "histogram", "Time of the admitted jobs in the admission queue.",
+                        (), LATENCY_BUCKETS)
 
 
-def complete_video_generation(video_id: str):
+def stage_load() -> Counter:
+    """Admitted jobs at every stage. Admitted jobs lost track of, e.g. taken over by another worker, expire."""
+    expired_before = time.time() - VIDEO_TIMEOUT - POLL_TIMEOUT
+    for job_id in [job_id for job_id, entry in admitted_jobs.items() if entry["admitted_at"] < expired_before]:
+        del admitted_jobs[job_id]
+    return Counter(stage for entry in admitted_jobs.values() for stage in entry["stages"])
+
+
+def branch_has_room(branch: list[str], load: Counter) -> bool:
+    return all(load[stage] < STAGE_CAPACITY[stage] for stage in branch)
+
+
+def admit(job_id: str, branch: list[str], load: Counter):
+    entry = admitted_jobs.setdefault(job_id, {"stages": set(), "admitted_at": time.time()})
+    entry["stages"].add(branch[0])
+    load[branch[0]] += 1
+
+
+def release_admission(job_id: str, stage: str = ""):
     """
-    Complete the video generation in background.
-    Returns file name of the video generated.
+    The admitted job has run `stage` and moves on to the next one of its branch.
+    If no stage is given the job is finished, its branches still in the queue are dropped.
     """
+    if not stage:
+        admitted_jobs.pop(job_id, None)
+        drop_queued_job(job_id)
+        return
+    entry = admitted_jobs.get(job_id)
+    if entry is not None:
+        entry["stages"].discard(stage)
+        if stage in NEXT_STAGE:
+            entry["stages"].add(NEXT_STAGE[stage])
+
+
+def admission_full(client: str) -> bool:
+    """A submission of this client would be shed now."""
+    load = stage_load()
+    if not admission_queue and all(branch_has_room(branch, load) for branch in BRANCHES):
+        return False
+    queued = sum(map(len, admission_queue.values()))
+    return queued >= ADMISSION_MAX_QUEUE or len(admission_queue.get(client, ())) >= ADMISSION_MAX_PER_CLIENT
+
+
+def queue_order() -> list[dict]:
+    """The queued jobs in the order of their admission: the clients in turn, each one in FIFO order."""
+    queues = list(admission_queue.values())
+    order = []
+    for rank in range(max(map(len, queues), default=0)):
+        order += [entries[rank] for entries in queues if len(entries) > rank]
+    return order
+
+
+def write_queue_positions(positions: dict[str, int]):
+    with db_transaction() as con:
+        for job_id, position in positions.items():
+            job = read_job(con, job_id)
+            if job is not None and job["status"] == "queued":
+                job["results"]["queue_position"] = position
+                write_job(con, job_id, results=job["results"])
+
+
+async def publish_queue_positions():
+    """Persist the positions that changed, the progress stream of a queued job may be served by another worker."""
+    changed = {}
+    for position, entry in enumerate(queue_order(), 1):
+        if entry["position"] != position:
+            entry["position"] = changed[entry["job_id"]] = position
+    if changed:
+        await asyncio.to_thread(write_queue_positions, changed)
+        for job_id in changed:
+            notify_job(job_id)
+
+
+async def request_admission(client: str, job_id: str, params: dict, sheddable: bool = True) -> int | None:
+    """
+    Submit a job if every stage has room for it, else queue it behind the jobs of the other clients.
+    Returns 0 if the job was started, its position if it was queued, None if it was shed.
+    Jobs that are not sheddable (those of batches) are always queued, and do not time out.
+    """
+    load = stage_load()
+    if not admission_queue and all(branch_has_room(branch, load) for branch in BRANCHES):
+        for branch in BRANCHES:
+            admit(job_id, branch, load)
+        await asyncio.to_thread(create_job, job_id, params)
+        for branch in BRANCHES:
+            enqueue_job(job_id, branch[0])
+        admissions.inc(outcome="admitted")
+        return 0
+    if sheddable and admission_full(client):
+        admissions.inc(outcome="shed")
+        logger.warning(f"Shed job {job_id} of client {client}, {sum(map(len, admission_queue.values()))} jobs are queued")
+        return None
+
+    await asyncio.to_thread(create_job, job_id, params, queued=True)
+    entry = {"job_id": job_id, "queued_at": time.time(), "sheddable": sheddable, "position": 0, "branches": list(BRANCHES)}
+    admission_queue.setdefault(client, deque()).append(entry)
+    admissions.inc(outcome="queued")
+    await publish_queue_positions()
+    await pump_admission()
+    return 0 if len(entry["branches"]) < len(BRANCHES) else entry["position"]
+
+
+async def pump_admission():
+    """Start the queued branches that have room, the jobs in the order of queue_order()."""
+    load = stage_load()
+    started = []
+    for entry in queue_order():
+        branches = [branch for branch in entry["branches"] if branch_has_room(branch, load)]
+        for branch in branches:
+            admit(entry["job_id"], branch, load)
+            entry["branches"].remove(branch)
+        if branches:
+            started.append((entry, branches))
+    # A client whose job is out of the queue goes to the back of the line
+    for client, entries in list(admission_queue.items()):
+        if any(not entry["branches"] for entry in entries):
+            kept = deque(entry for entry in entries if entry["branches"])
+            del admission_queue[client]
+            if kept:
+                admission_queue[client] = kept
+
+    for entry, branches in started:
+        job_id = entry["job_id"]
+        if not await asyncio.to_thread(start_queued_branches, job_id, [branch[0] for branch in branches]):
+            release_admission(job_id)
+            continue
+        if len(branches) + len(entry["branches"]) == len(BRANCHES):
+            # The first branch of the job started, it leaves the queue as far as its user is concerned
+            admission_wait.observe(time.time() - entry["queued_at"])
+            logger.info(f"Admitted job {job_id} after {time.time() - entry['queued_at']:.1f} seconds in the queue")
+        for branch in branches:
+            enqueue_job(job_id, branch[0])
+        notify_job(job_id)
+    await publish_queue_positions()
+
+
+def drop_queued_job(job_id: str):
+    """Forget the branches of a job still in the queue, e.g. because another branch of it failed."""
+    for client, entries in list(admission_queue.items()):
+        kept = deque(entry for entry in entries if entry["job_id"] != job_id)
+        if len(kept) == len(entries):
+            continue
+        del admission_queue[client]
+        if kept:
+            admission_queue[client] = kept
+
+
+def fail_queued_job(job_id: str, error: str):
+    with db_transaction() as con:
+        job = read_job(con, job_id)
+        if job is not None and job["status"] == "queued":
+            write_job(con, job_id, status="failed", error=error)
+
+
+async def expire_admission_queue():
+    """
+    Give up on the jobs queued for longer than ADMISSION_QUEUE_TIMEOUT, their users were told they are busy.
+    A job with a branch started, its biography say, waits for the others.
+    """
+    expired_before = time.time() - ADMISSION_QUEUE_TIMEOUT
+    expired = []
+    for client, entries in list(admission_queue.items()):
+        kept = deque(entry for entry in entries if not (entry["sheddable"] and entry["queued_at"] < expired_before
+                                                         and len(entry["branches"]) == len(BRANCHES)))
+        expired += [entry for entry in entries if entry not in kept]
+        if kept:
+            admission_queue[client] = kept
+        else:
+            del admission_queue[client]
+
+    for entry in expired:
+        await asyncio.to_thread(fail_queued_job, entry["job_id"], BUSY_MESSAGE)
+        remove_job_photo(entry["job_id"])
+        admissions.inc(outcome="expired")
+        notify_job(entry["job_id"])
+    if expired:
+        logger.warning(f"{len(expired)} jobs waited more than {ADMISSION_QUEUE_TIMEOUT} seconds in the queue, gave up")
+        await publish_queue_positions()
+    await pump_admission()
+
+
+def admission_stats() -> dict:
+    load = stage_load()
+    return {
+        "queued": sum(map(len, admission_queue.values())),
+        "clients": len(admission_queue),
+        "admitted": len(admitted_jobs),
+        "stages": {stage: {"admitted": load[stage], "capacity": STAGE_CAPACITY[stage]} for stage in STAGES},
+    }
+
+
+## BATCHES ##
+# A batch submits many records (name, job, place, photo) from a CSV or JSONL file, fed to the job engine
+# BATCH_MAX_JOBS at a time by the worker that owns the batch. With text_mode "batch" the biographies are
+# first written by one Anthropic Message Batch, at half the price and outside the per-minute limits,
+# into the result cache where the text stages of the jobs find them. "live" skips that wait.
+BATCH_FIELDS = ("name", "job", "place", "photo")
+BATCHES_FOLDER = os.path.join(JOBS_FOLDER, "batches") # photos attached to a batch, until their job is submitted
+
+batch_tasks: dict[str, asyncio.Task] = {}
+
+
+def parse_batch_records(data: bytes, filename: str) -> list[dict]:
+    """Records of a CSV file with a header line, or of a JSONL file. Raises ValueError if the file is malformed."""
+    text = data.decode("utf-8-sig")
+    if filename.lower().endswith(".csv") or not text.lstrip().startswith("{"):
+        rows = list(csv.DictReader(io.StringIO(text)))
+    else:
+        rows = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise ValueError(f"line {number}: {e.msg}")
+            if not isinstance(rows[-1], dict):
+                raise ValueError(f"line {number}: not a JSON object")
+    return [{field: str(row.get(field) or "").strip() for field in BATCH_FIELDS} for row in rows]
+
+
+def batch_record_error(record: dict, attached: set[str]) -> str | None:
+    missing = [field for field in BATCH_FIELDS if not record[field]]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    photo = record["photo"]
+    if not (photo.startswith(("http://", "https://", "data:image")) or photo in attached):
+        return f"photo {photo} is neither a URL nor an attached file"
+    return None
+
+
+def create_batch(batch_id: str, records: list[dict], text_mode: str):
+    """Insert a batch owned by this worker, its records wait for their turn in the job engine."""
+    now = time.time()
+    with closing(db_connect()) as con, con:
+        con.execute(
+            "INSERT INTO batches (id, status, text_mode, worker, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (batch_id, "writing" if text_mode == "batch" else "running", text_mode, WORKER_ID, now, now),
+        )
+        for position, record in enumerate(records):
+            params = {name: value for name, value in record.items() if name not in ("job_id", "error")}
+            con.execute(
+                "INSERT INTO batch_records (batch_id, position, job_id, params, status, error) VALUES (?, ?, ?, ?, ?, ?)",
+                (batch_id, position, record["job_id"], json.dumps(params), "failed" if record["error"] else "waiting", record["error"]),
+            )
+
+
+def get_batch(batch_id: str) -> dict | None:
+    with closing(db_connect()) as con:
+        row = con.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def update_batch(batch_id: str, **fields):
+    fields["updated_at"] = time.time()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    with closing(db_connect()) as con, con:
+        con.execute(f"UPDATE batches SET {columns} WHERE id = ?", (*fields.values(), batch_id))
+
+
+def fail_batch_record(batch_id: str, position: int, error: str):
+    with closing(db_connect()) as con, con:
+        con.execute("UPDATE batch_records SET status = 'failed', error = ? WHERE batch_id = ? AND position = ?",
+                    (error, batch_id, position))
+
+
+def batch_records(batch_id: str) -> list[dict]:
+    """
+    The records of a batch with the status of their job: waiting (for its turn), queued (for admission), pending,
+    running, done or failed.
+    `stage` is the stage of the job that changed last.
+    """
+    with closing(db_connect()) as con:
+        rows = con.execute("""
+            SELECT r.position, r.job_id, r.params, r.status, r.error,
+                   j.status AS job_status, j.stage, j.results, j.error AS job_error
+            FROM batch_records r LEFT JOIN jobs j ON j.id = r.job_id
+            WHERE r.batch_id = ? ORDER BY r.position
+        """, (batch_id,)).fetchall()
+    records = []
+    for row in rows:
+        record = json.loads(row["params"])
+        record.update(
+            position=row["position"],
+            job_id=row["job_id"],
+            status=row["job_status"] or row["status"],
+            stage=row["stage"],
+            error=row["job_error"] or row["error"],
+            results=json.loads(row["results"] or "{}"),
+        )
+        records.append(record)
+    return records
+
+
+def adopt_orphaned_batches(workers: list[str]) -> list[str]:
+    """Take over the unfinished batches of workers that are gone. Returns their ids."""
+    with db_transaction() as con:
+        rows = con.execute("SELECT id, worker FROM batches WHERE status IN ('writing', 'running')").fetchall()
+        orphaned = [row["id"] for row in rows if row["worker"] not in workers]
+        for batch_id in orphaned:
+            con.execute("UPDATE batches SET worker = ?, updated_at = ? WHERE id = ?", (WORKER_ID, time.time(), batch_id))
+    return orphaned
+
+
+def biography_cache_key(prompt: str) -> str:
+    """The result cache key of call_anthropic for a biography prompt, see run_text_stage."""
+    return result_cache_key(LLM_MODEL, str(BIOGRAPHY_MAX_TOKENS), prompt, "", b"")
+
+
+async def write_batch_biographies(batch: dict):
+    """
+    Write the biographies of a batch that are not cached yet with one Message Batch, and cache them.
+    A batch resumed after a restart polls the Message Batch it submitted before. The biographies of
+    failed or expired requests are written by the text stages of their jobs, like any other.
+    """
+    prompts = {} # cache key -> (custom id, prompt), identical records share one request
+    for record in await asyncio.to_thread(batch_records, batch["id"]):
+        if record["status"] == "waiting":
+            prompt, _ = prepare_prompt(record["name"], record["job"], record["place"])
+            prompts.setdefault(biography_cache_key(prompt), (record["job_id"], prompt))
+
+    message_batch_id = batch["message_batch"]
+    if not message_batch_id:
+        missing = [value for key, value in prompts.items() if await asyncio.to_thread(cache_get, key, "text_batch") is None]
+        if not missing:
+            return
+        message_batch = await llm_client.messages.batches.create(requests=[{
+            "custom_id": custom_id,
+            "params": {
+                "model": LLM_MODEL,
+                "max_tokens": BIOGRAPHY_MAX_TOKENS,
+                "messages": [{"role": "user", "content": prompt}],
+            },
+        } for custom_id, prompt in missing])
+        message_batch_id = message_batch.id
+        await asyncio.to_thread(update_batch, batch["id"], message_batch=message_batch_id)
+        logger.info(f"Submitted Message Batch {message_batch_id} of {len(missing)} biographies for batch {batch['id']}")
+
+    while (await llm_client.messages.batches.retrieve(message_batch_id)).processing_status != "ended":
+        await asyncio.sleep(MESSAGE_BATCH_POLL_INTERVAL)
+
+    keys = {custom_id: key for key, (custom_id, _) in prompts.items()}
+    written = failed = 0
+    async for entry in await llm_client.messages.batches.results(message_batch_id):
+        if entry.result.type != "succeeded" or entry.custom_id not in keys:
+            failed += 1
+            continue
+        message = entry.result.message
+        content = "".join(block.text for block in message.content if block.type == "text")
+        await asyncio.to_thread(cache_put, keys[entry.custom_id], content)
+        record_llm_call("text_batch", calls=1, input_tokens=message.usage.input_tokens, output_tokens=message.usage.output_tokens)
+        llm_tokens.inc(message.usage.input_tokens, purpose="text_batch", direction="input")
+        llm_tokens.inc(message.usage.output_tokens, purpose="text_batch", direction="output")
+        written += 1
+    logger.info(f"Message Batch {message_batch_id} wrote {written} biographies, {failed} failed and are written live")
+
+
+async def submit_batch_record(batch_id: str, record: dict):
+    """Put the photo of a record in the workspace of its job and submit the job, like /submit and /process do."""
+    job_id = record["job_id"]
+    current_job_id.set(job_id)
+    photo_path = job_file(job_id, PHOTO_FILE)
+    os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+    try:
+        if record.get("photo_file"):
+            await asyncio.to_thread(shutil.copyfile, record["photo_file"], photo_path)
+        else:
+            await download_to_file(record["photo"], photo_path, max_bytes=MAX_UPLOAD_BYTES)
+    except Exception as e:
+        logger.warning(f"Could not fetch the photo of record {record['position']} of batch {batch_id}: {str(e)}")
+        shutil.rmtree(os.path.dirname(photo_path), ignore_errors=True)
+        await asyncio.to_thread(fail_batch_record, batch_id, record["position"], f"photo could not be fetched: {str(e)}")
+        return
+
+    # The batch is one more client of the admission queue, its jobs wait their turn but are never shed
+    _, image_prompt = prepare_prompt(record["name"], record["job"], record["place"])
+    await request_admission(f"batch:{batch_id}", job_id, {
+        "client": f"batch:{batch_id}",
+        "name": record["name"],
+        "job": record["job"],
+        "place": record["place"],
+        "photo_path": photo_path,
+        "image_prompt": image_prompt,
+        "batch_id": batch_id,
+    }, sheddable=False)
+
+
+async def run_batch(batch_id: str):
+    """Write the biographies of a batch, then keep up to BATCH_MAX_JOBS of its jobs in the engine until all are finished."""
     try:
-        result_dict, _ = video_gen_job.result() # blocking call
-        vid_file_path = result_dict.get("video")
-        vid_file_name = os.path.basename(vid_file_path)
-        vid_str = video_id
-        os.system(f"cp {vid_file_path} {os.curdir}/{GEN_FOLDER}/")
-        os.system(f"mv {os.curdir}/{GEN_FOLDER}/{vid_file_name} {os.curdir}/{GEN_FOLDER}/{vid_str}.mp4")
-        logger.info(f"Video generation completed")
-    except TimeoutError:
-        logger.error("Background video generation timed out")
+        batch = await asyncio.to_thread(get_batch, batch_id)
+        if batch["status"] == "writing":
+            try:
+                await write_batch_biographies(batch)
+            except Exception as e:
+                logger.error(f"Message Batch of batch {batch_id} failed, its biographies are written live: {str(e)}")
+            await asyncio.to_thread(update_batch, batch_id, status="running")
+
+        while True:
+            batch = await asyncio.to_thread(get_batch, batch_id)
+            if batch["worker"] != WORKER_ID:
+                logger.warning(f"Batch {batch_id} was taken over by another worker")
+                return
+            records = await asyncio.to_thread(batch_records, batch_id)
+            waiting = [record for record in records if record["status"] == "waiting"]
+            in_flight = sum(record["status"] in ("queued", "pending", "running") for record in records)
+            if not waiting and not in_flight:
+                break
+            for record in waiting[:max(BATCH_MAX_JOBS - in_flight, 0)]:
+                await submit_batch_record(batch_id, record)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+        await asyncio.to_thread(update_batch, batch_id, status=DONE)
+        shutil.rmtree(os.path.join(BATCHES_FOLDER, batch_id), ignore_errors=True)
+        counts = {}
+        for record in records:
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        logger.info(f"Batch {batch_id} finished: {counts}")
     except Exception as e:
-        logger.error(f"Background video generation failed: {str(e)}")
+        # Taken over by another worker once this one is gone, see adopt_orphaned_batches
+        logger.error(f"Batch {batch_id} stopped: {str(e)}")
+    finally:
+        batch_tasks.pop(batch_id, None)
+
+
+def start_batch(batch_id: str):
+    if batch_id not in batch_tasks:
+        batch_tasks[batch_id] = asyncio.create_task(run_batch(batch_id))
+
+
+def batch_manifest(batch_id: str) -> dict:
+    """Status and generated artifacts of every record of a batch, with absolute URLs if PUBLIC_BASE_URL is set."""
+    batch = get_batch(batch_id)
+    records = batch_records(batch_id)
+    counts, entries = {}, []
+    for record in records:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+        results = record["results"]
+        image_key, video_key = results.get("image_key", ""), results.get("video_key", "")
+        entries.append({
+            "position": record["position"],
+            "name": record["name"],
+            "job": record["job"],
+            "place": record["place"],
+            "job_id": record["job_id"],
+            "status": record["status"],
+            "error": record["error"],
+            "page": f"{PUBLIC_BASE_URL}/output_file/{record['job_id']}" if record["status"] == DONE else None,
+            "portrait": f"{PUBLIC_BASE_URL}{asset_url(image_key)}" if artifact_store.exists(image_key) else None,
+            "video": f"{PUBLIC_BASE_URL}{asset_url(video_key)}" if artifact_store.exists(video_key) else None,
+        })
+    return {
+        "batch_id": batch_id,
+        "status": batch["status"],
+        "text_mode": batch["text_mode"],
+        "message_batch": batch["message_batch"],
+        "created_at": batch["created_at"],
+        "counts": counts,
+        "records": entries,
+    }
 
 
-async def video_tasks(id, image_path):
-    await start_video_generation_workflow(id, image_path)
-    await poll_video_generation_status(id)
+async def batch_status_stream(batch_id: str):
+    """
+    NDJSON lines of a batch: its status when it changes (and every SSE_PING_INTERVAL, to keep
+    the connection open), every record when its status or stage changes, and the manifest at the end.
+    """
+    states, last_status, last_sent = {}, None, 0.0
+    while True:
+        batch = await asyncio.to_thread(get_batch, batch_id)
+        if batch["status"] != last_status or time.monotonic() - last_sent >= SSE_PING_INTERVAL:
+            last_status, last_sent = batch["status"], time.monotonic()
+            yield json.dumps({"batch_id": batch_id, "status": batch["status"]}) + "\n"
+        for record in await asyncio.to_thread(batch_records, batch_id):
+            state = (record["status"], record["stage"])
+            if states.get(record["position"]) != state:
+                states[record["position"]] = state
+                yield json.dumps({
+                    "position": record["position"],
+                    "name": record["name"],
+                    "job_id": record["job_id"],
+                    "status": record["status"],
+                    "stage": record["stage"] if record["status"] in ("pending", "running") else None,
+                    "error": record["error"],
+                }) + "\n"
+        if batch["status"] == DONE:
+            yield json.dumps({"manifest": await asyncio.to_thread(batch_manifest, batch_id)}) + "\n"
+            return
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+## PROGRESS ##
+def render_job_page(job_id: str) -> str:
+    """The page of a job: its template with the generated assets in the slots, placeholders until they exist."""
+    with open(job_file(job_id), "r") as file:
+        template = file.read()
+    job = get_job(job_id)
+    results = job["results"] if job else {}
+    # Assets evicted from the artifact store are replaced by the placeholders again
+    image_key, video_key = results.get("image_key", ""), results.get("video_key", "")
+    portrait = asset_url(image_key) if artifact_store.exists(image_key) else PORTRAIT_PLACEHOLDER
+    video = asset_url(video_key) if artifact_store.exists(video_key) else VIDEO_PLACEHOLDER
+    return template.replace(PORTRAIT_SLOT, portrait, 1).replace(VIDEO_SLOT, video, 1)
+
+
+def progress_box(message: str):
+    return Div(
+        message,
+        style="background-color: #f0f8ff; padding: 10px; margin: 10px 0; border: 1px solid #ccc; border-radius: 5px;"
+    )
 
-## VIEW ##
 
-# Custom styling for the fixed button and placeholders
-# We use the Style tag, which FastHTML will place in the <head>
-style = Style("""
-    /* This styles the 'Start' button */
-    #start-btn {
-        position: fixed;
-        bottom: 20px;
-        left: 50%;
-        transform: translateX(-50%);
-        z-index: 1000;
-    }
-    /* Ensure Pico's dialog appears on top of other content */
-    dialog {
-        z-index: 2000;
-    }
-    /* Loading spinner styles */
-    .loading-container {
-        display: flex;
-        flex-direction: column;
-        align-items: center;
-        justify-content: center;
-        padding: 2rem;
-        text-align: center;
-    }
-    .header-flex {
-        display: flex;
-        align-items: center;
-        justify-content: center;
-        width: 100%;
-        margin-bottom: 2rem;
-        gap: 1rem;
-    }
-    .header-flex h1 {
-        margin: 0;
-        font-size: 2.2rem;
-        font-weight: 700;
-    }
-    #polling-placeholder {
-        min-width: 220px;
-        text-align: left;
-        align-self: flex-start;
-    }
-    #video-placeholder {
-        min-width: 220px;
-        text-align: left;
-        align-self: flex-start;
-    }
-    .spinner {
-        border: 4px solid #f3f3f3;
-        border-top: 4px solid #3498db;
-        border-radius: 50%;
-        width: 50px;
-        height: 50px;
-        animation: spin 1s linear infinite;
-        margin-bottom: 1rem;
-    }
-    @keyframes spin {
-        0% { transform: rotate(0deg); }
-        100% { transform: rotate(360deg); }
-    }
-""")
+def progress_view(job: dict | None, refresh: bool):
+    """
+    Progress of a job as pushed to the browser over SSE.
+    The status goes into the connected placeholder, everything else is swapped out-of-band.
+    """
+    if job is None or job["status"] == "failed":
+        if job is None:
+            message = "Job not found."
+        elif job["stages"]:
+            failed_stage = next((stage for stage in STAGES if stage_status(job, stage) == "failed"), job["stage"])
+            message = f"Generation failed at the {failed_stage} stage: {job['error']}"
+        else:
+            message = job["error"] # gave up in the admission queue
+        return (
+            progress_box(message),
+            Div("", id="video-placeholder", hx_swap_oob="true"),
+            Div("", id="title-spinner", hx_swap_oob="true"),
+        )
 
-# Initialize the app, passing in our custom styles
-app, rt = fast_app(hdrs=(style,))
+    results = job["results"]
+    elements = []
+    if job["status"] == "queued":
+        elements.append(progress_box(queue_message(results.get("queue_position"))))
+    elif not stage_status(job, "text"):
+        elements.append(progress_box("⏳ Fauxpedia is busy, your biography starts as soon as it is its turn."))
+    elif stage_status(job, "text") != DONE:
+        elements.append(progress_box("🔄 Writing your biography..."))
+    elif not stage_status(job, "normalize"):
+        elements.append(progress_box("⏳ Fauxpedia is busy, your portrait starts as soon as it is its turn."))
+    elif "image_key" not in results:
+        elements.append(progress_box("🔄 Portrait generation in progress..."))
+    elif "video_key" not in results:
+        status = results.get("video_status", "")
+        elements.append(Div(
+            progress_box(f"🔄 Video generation in progress... {status.lower().replace('_', ' ')}"),
+            id="video-placeholder",
+            hx_swap_oob="true"
+        ))
+    else:
+        elements.append(Div("", id="video-placeholder", hx_swap_oob="true"))
 
-@rt("/{fname:path}.{ext:static}")
-def static_files(fname: str, ext: str):
-    """Serve static files from the static directory."""
-    return FileResponse(f"static/{fname}.{ext}")
+    if job["status"] == DONE:
+        # Also hide the header spinner (out-of-band swap)
+        elements.append(Div("", id="title-spinner", hx_swap_oob="true"))
+    else:
+        elements.append(Div(cls="spinner", id="title-spinner", style="display:inline", hx_swap_oob="true"))
+
+    if refresh:
+        # Swapping in a new iframe reloads the page, its media are revalidated or cached for good
+        elements.append(Iframe(
+            src=f"/output_file/{job['id']}",
+            style="width:100%; height:80vh; border:0; display:block;",
+            title="Generated biography",
+            id="content-iframe",
+            hx_swap_oob="true"
+        ))
+    return tuple(elements)
+
+
+def queue_message(position: int | None) -> str:
+    return f"⏳ Fauxpedia is busy, you are number {position or '...'} in the queue. Your biography starts as soon as it is your turn."
+
+
+async def job_progress_stream(job_id: str, queued: bool = False):
+    """
+    Server-Sent Events of a job: one `progress` event per change, `close` once it is finished.
+    `queued` if the page of the job is not shown yet because it was queued.
+    """
+    assets, last_state = set(), None
+    async for job in job_changes(job_id, SSE_PING_INTERVAL):
+        state = job and job["updated_at"]
+        if job is not None and state == last_state:
+            # Nothing changed, the comment lets the server notice closed connections
+            yield ": ping\n\n"
+            continue
+        last_state = state
+        # Refresh the page whenever a new asset was put in it, but not while the biography streams into it.
+        # A job that leaves the admission queue gets its page, the biography streams into it.
+        written = job is not None and stage_status(job, "text") == DONE
+        new_assets = {key for key in ("image_key", "video_key") if job and key in job["results"]}
+        admitted = queued and job is not None and job["status"] in ("pending", "running")
+        queued = job is not None and job["status"] == "queued"
+        yield sse_message(progress_view(job, refresh=admitted or (written and bool(new_assets - assets))), event="progress")
+        if written:
+            assets = new_assets
+        if job is None or job["status"] in (DONE, "failed"):
+            yield sse_message(Span(), event="close")
+            return
+
+
+def same_file(file, path: str) -> bool:
+    """Whether path still names the open file."""
+    try:
+        return os.path.samestat(os.fstat(file.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+async def stream_biography(job_id: str):
+    """
+    Send the biography of a job while it is being generated, by following its PARTIAL_HTML
+    until the text stage has written output.html.
+    """
+    partial_path, final_path = job_file(job_id, PARTIAL_HTML), job_file(job_id)
+    partial = None
+    checked_at = 0.0 # the job record is read every JOB_POLL_INTERVAL while nothing new was written
+    try:
+        while True:
+            # Check before reading, everything was appended by the time the final page exists
+            finished = os.path.exists(final_path)
+            if partial is None and not finished:
+                try:
+                    partial = open(partial_path, "rb")
+                except FileNotFoundError:
+                    pass
+            if partial is not None:
+                chunk = partial.read()
+                if chunk:
+                    yield chunk
+                    continue
+                if not same_file(partial, partial_path):
+                    # The text stage is over and removed the file, or was retried and started another one
+                    return
+            if finished:
+                if partial is None:
+                    yield (await asyncio.to_thread(render_job_page, job_id)).encode()
+                return
+            if time.monotonic() - checked_at >= JOB_POLL_INTERVAL:
+                checked_at = time.monotonic()
+                job = await asyncio.to_thread(get_job, job_id)
+                # A text stage still in the admission queue has no status yet
+                if job is None or job["status"] == "failed" or stage_status(job, "text") not in ("", "pending", "running"):
+                    return
+            await asyncio.sleep(BIOGRAPHY_TAIL_INTERVAL)
+    finally:
+        if partial is not None:
+            partial.close()
+
+
+def job_progress(job_id: str, queue_position: int = 0):
+    """Placeholder that connects to the progress stream of a job and shows its status."""
+    return Div(
+        progress_box(queue_message(queue_position) if queue_position else "🔄 Writing your biography..."),
+        id="polling-placeholder",
+        hx_ext="sse",
+        sse_connect=f"/jobs/{job_id}/events" + ("?queued=1" if queue_position else ""),
+        sse_swap="progress",
+        sse_close="close",
+        hx_swap_oob="true"
+    )
+
+
+## VIEW ##
+
+def static_url(path: str) -> str:
+    """Versioned url of a static file, browsers cache it until the file changes."""
+    return f"/{path}?v={media_digest(path)}"
+
+
+# Initialize the app, passing in our custom styles (static/css/app.css) and the webcam capture
+# HTMX extension that swaps in the job progress pushed over Server-Sent Events
+sse_ext = Script(src="https://cdn.jsdelivr.net/npm/htmx-ext-sse@2.2.2/sse.js")
+# The defaults of htmx 2, except that the "busy" answers (503) of the admission control
+# and the refused uploads (413) are swapped in
+htmx_config = Meta(name="htmx-config", content=json.dumps({"responseHandling": [
+    {"code": "204", "swap": False},
+    {"code": "[23]..", "swap": True},
+    {"code": "413", "swap": True, "error": False},
+    {"code": "503", "swap": True, "error": False},
+    {"code": "[45]..", "swap": False, "error": True},
+    {"code": "...", "swap": False},
+]}))
+hdrs = (
+    htmx_config,
+    Link(rel="stylesheet", href=static_url("static/css/app.css")),
+    Link(rel="stylesheet", href=static_url("static/css/webcam.css")),
+    Script(src=static_url("static/js/webcam.js")),
+    sse_ext,
+)
+
+# The answer to a submission beyond SUBMIT_MAX_BYTES, sent before the rest of its photo is received
+upload_too_large = Response(
+    to_xml(Div(
+        H3("Error"),
+        P(f"The photo is larger than {MAX_UPLOAD_BYTES // 1024**2} MB. Please try again with a smaller one."),
+        cls="loading-container"
+    )),
+    status_code=413,
+    media_type="text/html; charset=utf-8",
+)
+upload_limit = Middleware(UploadLimit, paths=("/submit",), max_bytes=SUBMIT_MAX_BYTES, response=upload_too_large)
+app, rt = fast_app(hdrs=hdrs, secret_key=SESSION_SECRET, middleware=[upload_limit],
+                  on_startup=[start_loop_watch, init_cache_db, start_artifact_store, start_job_engine],
+                  on_shutdown=[stop_job_engine, stop_artifact_store, close_http_client, stop_loop_watch])
+
+@rt("/static/{fname:path}.{ext:static}")
+def static_files(request, fname: str, ext: str, v: str = ""):
+    """Serve static files from the static directory. Urls made by static_url() are immutable."""
+    path = f"static/{fname}.{ext}"
+    if not os.path.realpath(path).startswith(os.path.realpath("static") + os.sep) or not os.path.isfile(path):
+        return Response("Not found", 404)
+    digest = media_digest(path)
+    cache_control = f"public, max-age={MEDIA_MAX_AGE}, immutable" if v == digest else "no-cache"
+    return cached_file_response(request, path, f'"{digest}"', cache_control)
+
+# fast_app registered its catch-all static route first, static files have to reach ours before it
+app.router.routes.insert(0, app.router.routes.pop())
+
+# Pages that are the same for every visitor, rendered once into bytes (see prerender_pages)
+static_pages: dict[str, tuple[bytes, str]] = {}
+
+
+def static_page_response(request, name: str):
+    """A pre-rendered page, revalidated by its ETag."""
+    body, etag = static_pages[name]
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="text/html; charset=utf-8", headers=headers)
 
 @rt("/")
-def index():
+def index(request):
     """
     Main landing page route that displays the application interface.
     """
+    return static_page_response(request, "index")
+
+
+def index_page():
+    """The landing page, rendered once by prerender_pages."""
     start_btn = Button(
         "Start",
         id="start-btn",
@@ -596,7 +3252,7 @@ def index():
 
 
 @rt("/open_modal")
-def open_modal():
+def open_modal(request):
     """
     Route that serves the user input modal dialog with webcam and file upload options.
     
@@ -612,13 +3268,14 @@ def open_modal():
         - Escape key handler for modal dismissal
         - Auto-focus on the name input field
     """
+    return static_page_response(request, "modal")
+
+
+def modal_page():
+    """The modal dialog, rendered once by prerender_pages. The webcam CSS and JS are in the page head."""
     return DialogX(
         Article(
             H3("Enter Your Details"),
-            # Include CSS and JS for webcam functionality
-            Link(rel="stylesheet", href="/static/css/webcam.css"),
-            Script(src="/static/js/webcam.js"),
-            
             Form(
                 Input(name="name", placeholder="Name", required=True, autofocus=True),
                 Input(name="job", placeholder="Job", required=True),
@@ -678,6 +3335,20 @@ def open_modal():
     )
 
 
+def prerender_pages():
+    """Render the landing page (a full page, like FastHTML does) and the modal (an HTMX fragment) once."""
+    pages = {
+        "index": Html(Head(Title(app.title), *app.hdrs), Body(index_page(), *app.ftrs, **app.bodykw), **app.htmlkw),
+        "modal": modal_page(),
+    }
+    for name, page in pages.items():
+        body = to_xml(page).encode()
+        static_pages[name] = (body, f'"{hashlib.sha256(body).hexdigest()[:16]}"')
+
+
+prerender_pages()
+
+
 @rt("/dismiss_modal")
 def dismiss_modal():
     """
@@ -714,21 +3385,40 @@ def dismiss_modal():
     return clear_modal, hide_info, show_iframe
 
 
+def busy_response(*elements) -> Response:
+    """The answer to a submission shed by the admission control: 503 with Retry-After, swapped in by htmx (see htmx_config)."""
+    content = Div(
+        H3("Busy"),
+        P(BUSY_MESSAGE),
+        P("Try again by pressing the Start button."),
+        cls="loading-container"
+    )
+    hide_spinner = Div("", id="title-spinner", hx_swap_oob="true")
+    return Response(
+        "".join(to_xml(element) for element in (content, hide_spinner, *elements)),
+        status_code=503,
+        media_type="text/html; charset=utf-8",
+        headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+    )
+
+
 @rt("/submit")
-async def submit_form(name: str, job: str, place: str, photo: UploadFile = None, webcam_data: str = None):
+async def submit_form(session, name: str, job: str, place: str, photo: UploadFile = None, webcam_data: str = None):
     """
     Route that handles form submission and initiates biography generation.
     
     Receives user input from the modal form, handles both file uploads and webcam captures,
-    saves the photo to a temporary file, and immediately returns a loading spinner while 
+    streams the photo into the job workspace, and immediately returns a loading spinner while 
     triggering background processing.
     
     Args:
         name (str): Person's name for the biography
         job (str): Person's profession/job title
         place (str): Work environment or location
-        photo (UploadFile, optional): User's photo file for AI image generation
-        webcam_data (str, optional): Base64 encoded webcam capture data
+        photo (UploadFile, optional): User's photo file for AI image generation,
+            webcam captures are sent in it as a WebP or JPEG file
+        webcam_data (str, optional): Base64 encoded webcam capture data, from
+            browsers that cannot put the capture in the file input
     
     Returns:
         Multiple elements with out-of-band swaps:
@@ -736,47 +3426,47 @@ async def submit_form(name: str, job: str, place: str, photo: UploadFile = None,
         - Closed modal elements to dismiss the form
         - Clears modal placeholder
     """
-    temp_photo_path = None
-    
-    # Handle file upload
-    if photo and photo.size > 0:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_photo:
-            temp_photo.write(await photo.read())
-            temp_photo_path = temp_photo.name
-            logger.info(f"Saved uploaded photo to {temp_photo_path}")
-    
-    # Handle webcam capture
-    elif webcam_data:
-        import base64
-        
-        try:
-            # Remove data URL prefix if present
-            if webcam_data.startswith('data:image'):
-                webcam_data = webcam_data.split(',')[1]
-            
-            # Decode base64 and save to temp file
-            image_data = base64.b64decode(webcam_data)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_photo:
-                temp_photo.write(image_data)
-                temp_photo_path = temp_photo.name
-                logger.info(f"Saved webcam capture to {temp_photo_path}")
-        except Exception as e:
-            logger.error(f"Error processing webcam data: {str(e)}")
+    # Shed before the photo is written to the job workspace and decoded, when the admission queue has no
+    # room for this browser. The form, photo included, was already received: the session that names the
+    # browser is only known past the middleware, see UploadLimit for what is refused before the body is read.
+    client = session.setdefault("client_id", secrets.token_hex(8))
+    if admission_full(client):
+        return busy_response(Div(id="modal-info", hx_swap_oob="true"), Div(id="modal-placeholder", hx_swap_oob="true"))
+
+    # Every submission gets its own workspace, the photo is streamed to disk inside it
+    job_id = new_job_id()
+    photo_path = job_file(job_id, PHOTO_FILE)
+    os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+    try:
+        # Handle file upload
+        if photo and photo.size > 0:
+            await save_upload(photo, photo_path)
+            logger.info(f"Saved uploaded photo to {photo_path}")
+
+        # Handle webcam capture
+        elif webcam_data:
+            await asyncio.to_thread(save_base64_image, webcam_data, photo_path)
+            logger.info(f"Saved webcam capture to {photo_path}")
+
+        # Return error if no photo provided
+        else:
+            shutil.rmtree(os.path.dirname(photo_path), ignore_errors=True)
             return Div(
                 H3("Error"),
-                P("Failed to process webcam image. Please try again."),
+                P("Please provide a photo either by file upload or webcam capture."),
                 cls="loading-container"
             )
-    
-    # Return error if no photo provided
-    else:
+    except Exception as e:
+        logger.error(f"Error saving photo: {str(e)}")
+        shutil.rmtree(os.path.dirname(photo_path), ignore_errors=True)
         return Div(
             H3("Error"),
-            P("Please provide a photo either by file upload or webcam capture."),
+            P(f"Failed to process the photo: {str(e)}. Please try again."),
             cls="loading-container"
         )
-    
-    # Continue with existing processing if we have a photo
+
+    # Remember the latest job of this browser
+    session["job_id"] = job_id
 
     show_info = Div(
         style="display:block;",
@@ -790,10 +3480,10 @@ async def submit_form(name: str, job: str, place: str, photo: UploadFile = None,
         hx_post="/process",
         hx_trigger="load",
         hx_vals=json.dumps({
+            "job_id": job_id,
             "name": name,
             "job": job,
             "place": place,
-            "photo_path": temp_photo_path
         }),
         hx_target="#info",
         hx_swap="innerHTML"
@@ -809,53 +3499,71 @@ async def submit_form(name: str, job: str, place: str, photo: UploadFile = None,
 
 
 @rt("/process") 
-async def process_form(name: str, job: str, place: str, photo_path: str):
+async def process_form(session, job_id: str, name: str, job: str, place: str):
     """
     Route that performs the actual biography generation and AI image processing.
     
     Called automatically by HTMX after the loading spinner is displayed.
-    Orchestrates the complete workflow: LLM text generation, image upload,
-    AI image generation, and file updates.
+    Submits the job to the job engine, which runs the complete workflow:
+    LLM text generation, image upload, AI image generation, caption,
+    video prompt and video generation.
     
     Args:
+        job_id (str): Id of the job workspace created by /submit
         name (str): Person's name for the biography
         job (str): Person's profession/job title  
         place (str): Work environment or location
-        photo_path (str): Path to the temporary photo file
     
     Returns:
         On success: Updates to show iframe with generated content
+        When queued: The position in the admission queue, the iframe is shown once the job is admitted
+        When shed: The "busy" message with status 503
         On error: Error message with retry button
         
     Workflow:
-        1. Generate Wikipedia biography text using Anthropic LLM
-        2. Upload user photo to WaveSpeed AI service
-        3. Generate AI image based on user photo and job context
-        4. Update output.html with generated content and new image
-        5. Display results in iframe
+        1. Submit the job through the admission control, the engine writes
+           the biography and generates the portrait concurrently
+        2. Display the iframe right away, the biography streams into it
+           as the LLM writes it
+        3. Push the progress of the portrait and video of the job, which
+           the engine generates in the background (see STAGES)
     """
+    # The photo saved by /submit, the job removes it once the portrait is generated
+    photo_path = job_file(job_id, PHOTO_FILE) if is_valid_job_id(job_id) else ""
+    existing = await asyncio.to_thread(get_job, job_id) if photo_path else None
+    if not os.path.exists(photo_path) and existing is None:
+        return Response("Unknown job", 404)
     try:
-        # Call the LLM to generate the biography and image prompt
-        logger.info("Calling LLM to generate wiki...")
-        llm_prompt, image_prompt = prepare_prompt(name, job, place)
-        html_out = await call_anthropic(llm_prompt)
-        out = cleanup_html_output(html_out)
-        with open("output.html", "w") as f:
-            f.write(out)
-
-        # Start portrait image generation in background and get request_id
-        request_id, bck_task = start_portrait_generation(photo_path, image_prompt)
-        logger.info(f"Started portrait generation with request_id: {request_id}")
-
-        # Return updates to show the iframe immediately with the placeholder image
+        # Submit the job, the biography is streamed into the iframe as it is written
+        queue_position = (existing["results"].get("queue_position") or 1) if existing and existing["status"] == "queued" else 0
+        if existing is None:
+            logger.info(f"Submitting job {job_id} to generate wiki...")
+            _, image_prompt = prepare_prompt(name, job, place)
+            client = session.get("client_id") or job_id
+            queue_position = await request_admission(client, job_id, {
+                "client": client,
+                "name": name,
+                "job": job,
+                "place": place,
+                "photo_path": photo_path,
+                "image_prompt": image_prompt,
+            })
+            if queue_position is None:
+                shutil.rmtree(os.path.dirname(photo_path), ignore_errors=True)
+                return busy_response()
+        if queue_position:
+            # Waits for its turn, the progress stream shows the position and then the page
+            return job_progress(job_id, queue_position)
+
+        # Return updates to show the iframe immediately
         show_iframe = Iframe(
-            src="/output_file",
+            src=f"/output_file/{job_id}",
             style="width:100%; height:80vh; border:0; display:block;",
             title="Generated biography",
             id="content-iframe",
             hx_swap_oob="true"
         )
-        return show_iframe, portrait_reload(request_id), video_reload(request_id), bck_task
+        return show_iframe, job_progress(job_id)
 
     except Exception as e:
         logger.error(f"Error processing form: {str(e)}")
@@ -869,36 +3577,87 @@ async def process_form(name: str, job: str, place: str, photo_path: str):
         )
 
 
-@rt("/portrait_img/{id}")
-def get_portrait_img(id: str):
-    logger.info(f"Receive polling request for image id: {id}")
-    return portrait_reload(id)
+@rt("/jobs/{id}/events")
+async def job_events_stream(id: str, queued: bool = False):
+    """Push the progress of a job to the browser until it is finished."""
+    logger.info(f"Receive progress stream request for job: {id}")
+    if not is_valid_job_id(id):
+        return Response("Unknown job", 404)
+    return EventStream(job_progress_stream(id, queued))
+
 
+@rt("/signed")
+def get(path: str, expires: int, sig: str):
+    """Serve a local file to the model APIs through a url made by signed_url()."""
+    if not verify_signed_path(path, expires, sig) or not os.path.isfile(path):
+        return Response("Forbidden", 403)
+    return FileResponse(path, headers={"Cache-Control": "private, max-age=60"})
 
-@rt('/video_status/{id}')
-def video_status(id: str):
-    logger.info(f"Receive polling request for video id: {id}")
-    return video_reload(id)
+
+@rt("/media/{name}/{digest}")
+def media(request, name: str, digest: str):
+    """
+    Generated assets under content-hashed urls (see asset_url), cached by browsers and CDNs for good.
+    Videos support Range requests for seeking; the file is sent with pathsend where the server supports it.
+    Assets in object storage are redirected to a presigned url.
+    """
+    if not artifact_store.exists(name):
+        return Response("Not found", 404)
+    artifact_store.touch(name)
+    path = artifact_store.file_path(name)
+    if path is None:
+        return RedirectResponse(artifact_store.source(name), status_code=302,
+                                headers={"Cache-Control": f"private, max-age={SIGNED_URL_TTL // 2}"})
+    if not os.path.isfile(path):
+        artifact_store.forget(name)
+        return Response("Not found", 404)
+    if media_digest(path) != digest:
+        # The file changed since the url was made, send what there is without caching it
+        return FileResponse(path, headers={"Cache-Control": "no-cache"})
+    return cached_file_response(request, path, f'"{digest}"', f"public, max-age={MEDIA_MAX_AGE}, immutable")
 
 
 @rt("/output_file")
-def output_file():
+def latest_output_file(request, session):
+    """Serve the biography of the latest job submitted from this browser session."""
+    return output_file(request, session.get("job_id", ""))
+
+
+@rt("/output_file/{id}")
+def output_file(request, id: str):
     """
-    Route that serves the generated Wikipedia biography HTML file.
+    Route that serves the generated Wikipedia biography HTML file of a job.
     
-    Attempts to serve the output.html file containing the generated biography.
-    If the file doesn't exist (no content has been generated yet), returns
-    a helpful message and manages UI state.
+    Attempts to serve the output.html file of the job workspace containing
+    the generated biography. If the file doesn't exist (no content has been
+    generated yet), returns a helpful message and manages UI state.
     
     Returns:
-        On success: The generated HTML file (output.html)
+        On success: The generated HTML file (jobs/{id}/output.html), streamed
+        as it is written while the job is in its text stage
         On FileNotFoundError: 
         - Message indicating no content exists yet
         - Hides the iframe to prevent loading errors
         - Directs user to use the Start button
     """
     try:
-        return File("output.html")
+        if not is_valid_job_id(id):
+            raise FileNotFoundError(id)
+        if not os.path.exists(job_file(id)):
+            job = get_job(id)
+            if job is not None and job["status"] != "failed" and stage_status(job, "text") in ("", "pending", "running"):
+                # Still being written or waiting for its turn, send it as it is generated
+                return StreamingResponse(
+                    stream_biography(id),
+                    media_type="text/html; charset=utf-8",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
+        # Revalidated on every load, unchanged pages are not sent again
+        page = render_job_page(id)
+        headers = {"ETag": f'"{hashlib.sha256(page.encode()).hexdigest()[:16]}"', "Cache-Control": "no-cache"}
+        if etag_matches(request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        return Response(page, media_type="text/html; charset=utf-8", headers=headers)
     except FileNotFoundError:
         # If no content exists yet, show message in info display and keep iframe hidden
         show_message = Div(
@@ -928,23 +3687,16 @@ def post(request, session):
         return Response("Unauthorized", 401)
     
     try:
-        assets_path = os.path.join(os.getcwd(), GEN_FOLDER)
-        
-        if not os.path.exists(assets_path):
-            os.makedirs(assets_path)  # Recreate if it doesn't exist
-            return {"status": "success", "message": f"Created empty {GEN_FOLDER} directory"}
-        
-        # Clear all contents
-        for filename in os.listdir(assets_path):
-            file_path = os.path.join(assets_path, filename)
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
+        # Clear all stored assets
+        removed = artifact_store.clear()
 
-        # Clear the generated html wiki
-        os.system("rm -rf *.html")
+        # Clear the generated html wikis of every job, keep the job database
+        for entry in os.scandir(JOBS_FOLDER):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
 
-        logger.info(f"Successfully cleared {GEN_FOLDER} directory")
-        return {"status": "success", "message": f"Successfully cleared {GEN_FOLDER} directory"}
+        logger.info(f"Successfully cleared {removed} generated assets")
+        return {"status": "success", "message": f"Successfully cleared {removed} generated assets"}
         
     except Exception as e:
         logger.error(f"Error clearing assets: {str(e)}")
@@ -953,32 +3705,200 @@ def post(request, session):
 
 @rt("/assets/list_all")
 def get(request, session):
-    """List all files in the generated assets directory"""
+    """List all generated assets, from the index of the artifact store"""
     # Add simple authentication check
     api_key = request.headers.get("Authorization")
     if api_key != f"Bearer {llm_api_key}":  # Replace with your key
         return Response("Unauthorized", 401)
 
     try:
-        assets_path = os.path.join(os.getcwd(), GEN_FOLDER)
-        if not os.path.exists(assets_path):
-            return {"status": "error", "message": f"Directory {GEN_FOLDER} does not exist"}, 404
-
         files = []
-        for filename in os.listdir(assets_path):
-            file_path = os.path.join(assets_path, filename)
-            if os.path.isfile(file_path):
-                files.append({
-                    "name": filename,
-                    "size": os.path.getsize(file_path),
-                    "last_modified": dt.datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
-                })
-        logger.info(f"Sent list of files in {GEN_FOLDER} directory")
-        return {"status": "success", "files": files}
+        for key, entry in sorted(artifact_store.snapshot()):
+            files.append({
+                "name": key,
+                "size": entry["size"],
+                "last_modified": dt.datetime.fromtimestamp(entry["mtime"]).strftime('%Y-%m-%d %H:%M:%S')
+            })
+        logger.info(f"Sent list of {len(files)} generated assets")
+        return {"status": "success", "files": files, "store": artifact_store.stats()}
     except Exception as e:
         logger.error(f"Error listing assets: {str(e)}")
         return {"status": "error", "message": str(e)}, 500
 
+@rt("/jobs/stats")
+async def get(request, session, window: int = 3600):
+    """Per-stage throughput and latency of the job engine over the last `window` seconds"""
+    # Add simple authentication check
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":  # Replace with your key
+        return Response("Unauthorized", 401)
+
+    # Async, the in-memory stats are changed by the event loop and read on it
+    return {
+        "status": "success",
+        "jobs": await asyncio.to_thread(job_status_counts),
+        "stages": await asyncio.to_thread(stage_stats, time.time() - window),
+        "llm": llm_stats_summary(),
+        "cache": cache_stats_summary(),
+        "store": artifact_store.stats(),
+        "admission": admission_stats(),
+        # llm, cache, admission and queued are of the worker that answers, the rest is shared by all workers
+        "worker": WORKER_ID,
+        "workers": len(live_workers),
+    }
+
+@rt("/jobs/{id}/trace")
+def get(request, id: str):
+    """Timeline of a job: its stage runs and the external calls they made, in seconds since submission"""
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    job = get_job(id) if is_valid_job_id(id) else None
+    if job is None:
+        return Response("Not found", 404)
+
+    with closing(db_connect()) as con:
+        rows = con.execute("""
+            SELECT 'stage' AS kind, stage AS name, started_at, finished_at, ok, NULL AS worker FROM stage_runs WHERE job_id = ?
+            UNION ALL
+            SELECT 'call' AS kind, name, started_at, finished_at, ok, worker FROM spans WHERE job_id = ?
+            ORDER BY started_at
+        """, (id, id)).fetchall()
+    spans = [{
+        "kind": row["kind"],
+        "name": row["name"],
+        "start": round(row["started_at"] - job["created_at"], 3),
+        "seconds": round(row["finished_at"] - row["started_at"], 3),
+        "ok": bool(row["ok"]),
+        "worker": row["worker"],
+    } for row in rows]
+    return {"status": "success", "job_id": id, "job_status": job["status"], "spans": spans}
+
+@rt("/batches")
+async def post(request):
+    """
+    Submit a batch of records from a CSV or JSONL file (`records`) with the fields name, job, place and photo.
+    The photo of a record is a URL, a data URI or the file name of one of the `photos` attached to the request.
+    `text` is "batch" (the default, the biographies are written by a Message Batch first) or "live".
+    Streams the status of the records as NDJSON until the batch is finished, then its manifest.
+    """
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    form = await request.form(max_files=BATCH_MAX_RECORDS + 1)
+    upload = form.get("records")
+    if not isinstance(upload, UploadFile):
+        return Response("Missing records file", 400)
+    data = await upload.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        return Response(f"Records file is larger than {MAX_UPLOAD_BYTES // 1024**2} MB", 413)
+    try:
+        records = parse_batch_records(data, upload.filename or "")
+    except (ValueError, UnicodeDecodeError) as e:
+        return Response(f"Malformed records file: {str(e)}", 400)
+    if not records or len(records) > BATCH_MAX_RECORDS:
+        return Response(f"A batch has 1 to {BATCH_MAX_RECORDS} records", 400)
+    text_mode = form.get("text") or "batch"
+    if text_mode not in ("batch", "live"):
+        return Response("text is batch or live", 400)
+
+    # The photos are kept with the batch until their job is submitted, an attached one is saved once for all its records
+    batch_id = new_job_id()
+    folder = os.path.join(BATCHES_FOLDER, batch_id)
+    os.makedirs(folder, exist_ok=True)
+    attached = {photo.filename: photo for photo in form.getlist("photos") if isinstance(photo, UploadFile)}
+    saved = {}
+    for record in records:
+        record["job_id"] = new_job_id()
+        record["error"] = batch_record_error(record, set(attached))
+        photo = record["photo"]
+        try:
+            if record["error"] or photo.startswith(("http://", "https://")):
+                continue
+            if photo.startswith("data:image"):
+                record["photo_file"] = os.path.join(folder, f"{record['job_id']}.jpg")
+                await asyncio.to_thread(save_base64_image, photo, record["photo_file"])
+                record["photo"] = "data:image"
+            else:
+                if photo not in saved:
+                    saved[photo] = os.path.join(folder, f"photo-{len(saved)}")
+                    await save_upload(attached[photo], saved[photo])
+                record["photo_file"] = saved[photo]
+        except Exception as e:
+            record["error"] = f"photo could not be saved: {str(e)}"
+
+    await asyncio.to_thread(create_batch, batch_id, records, text_mode)
+    logger.info(f"Created batch {batch_id} of {len(records)} records, text {text_mode}")
+    start_batch(batch_id)
+    return StreamingResponse(
+        batch_status_stream(batch_id),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@rt("/batches/{id}/events")
+def get(request, id: str):
+    """Status of the records of a batch as NDJSON until it is finished, then its manifest, like the response of POST /batches"""
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    if not is_valid_job_id(id) or get_batch(id) is None:
+        return Response("Not found", 404)
+    return StreamingResponse(
+        batch_status_stream(id),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@rt("/batches/{id}/manifest")
+def get(request, id: str):
+    """Status and generated artifacts of every record of a batch"""
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    if not is_valid_job_id(id) or get_batch(id) is None:
+        return Response("Not found", 404)
+    return batch_manifest(id)
+
+@rt("/metrics")
+def get(request):
+    """Prometheus metrics of all workers"""
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    return Response(collect_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@rt("/debug/loop")
+def get(request):
+    """Event loop lag over the last minute and the last stalls caught by the watchdog, of the worker that answers"""
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    lags = sorted(recent_lags)
+    lag_at = lambda q: round(lags[min(int(q * len(lags)), len(lags) - 1)], 4) if lags else None
+    return {
+        "status": "success",
+        "worker": WORKER_ID,
+        "debug": LOOP_DEBUG,
+        "threshold": BLOCKING_THRESHOLD,
+        "lag": {"p50": lag_at(0.5), "p95": lag_at(0.95), "p99": lag_at(0.99), "max": lag_at(1), "samples": len(lags)},
+        "stalls": list(recent_stalls),
+    }
+
+@rt("/debug/profile")
+async def get(request, seconds: float = 5, threads: str = "loop"):
+    """
+    Sample the stacks of the worker that answers for `seconds`: of its event loop thread,
+    or of all its threads with threads=all. Returns folded stacks, one per line with its sample count.
+    """
+    api_key = request.headers.get("Authorization")
+    if api_key != f"Bearer {llm_api_key}":
+        return Response("Unauthorized", 401)
+    seconds = min(max(seconds, PROFILE_INTERVAL), PROFILE_MAX_SECONDS)
+    counts = await asyncio.to_thread(sample_profile, seconds, threads == "all")
+    folded = "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+    return Response(folded, media_type="text/plain; charset=utf-8")
+
 @rt("/health")
 def get(request, session):
     """Simple health check endpoint"""
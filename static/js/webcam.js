@@ -1,3 +1,7 @@
+// Longest side of a captured photo, the server downscales to this size anyway
+const CAPTURE_MAX_DIMENSION = 1536;
+const CAPTURE_QUALITY = 0.85;
+
 class WebcamCapture {
     constructor(videoElementId, canvasElementId) {
         this.video = document.getElementById(videoElementId);
@@ -20,10 +24,28 @@ class WebcamCapture {
 
     capturePhoto() {
         const context = this.canvas.getContext('2d');
-        this.canvas.width = this.video.videoWidth;
-        this.canvas.height = this.video.videoHeight;
-        context.drawImage(this.video, 0, 0);
-        return this.canvas.toDataURL('image/jpeg', 0.8);
+        const scale = Math.min(1, CAPTURE_MAX_DIMENSION / Math.max(this.video.videoWidth, this.video.videoHeight));
+        this.canvas.width = Math.round(this.video.videoWidth * scale);
+        this.canvas.height = Math.round(this.video.videoHeight * scale);
+        context.drawImage(this.video, 0, 0, this.canvas.width, this.canvas.height);
+    }
+
+    // The captured photo as a binary file, WebP where the browser can encode it
+    captureFile() {
+        return new Promise(resolve => {
+            this.canvas.toBlob(blob => {
+                if (!blob || blob.type !== 'image/webp') {
+                    // No WebP encoder (Safari), fall back to JPEG
+                    this.canvas.toBlob(jpeg => resolve(new File([jpeg], 'webcam.jpg', { type: 'image/jpeg' })), 'image/jpeg', CAPTURE_QUALITY);
+                    return;
+                }
+                resolve(new File([blob], 'webcam.webp', { type: 'image/webp' }));
+            }, 'image/webp', CAPTURE_QUALITY);
+        });
+    }
+
+    captureDataURL() {
+        return this.canvas.toDataURL('image/jpeg', CAPTURE_QUALITY);
     }
 
     stopCamera() {
@@ -44,6 +66,12 @@ function switchInputMethod() {
         document.getElementById('upload-section').style.display = 'block';
         document.getElementById('webcam-section').style.display = 'none';
         stopWebcam();
+        // Drop a capture that was put in the file input, but keep a file the user picked
+        const fileInput = document.getElementById('file-input');
+        if (fileInput.files.length && fileInput.files[0].name.startsWith('webcam.')) {
+            fileInput.value = '';
+        }
+        document.getElementById('webcam-data').value = '';
     } else if (webcamRadio.checked) {
         // Switch to webcam and start camera immediately
         document.getElementById('upload-section').style.display = 'none';
@@ -69,11 +97,18 @@ async function startWebcam() {
     }
 }
 
-function capturePhoto() {
+async function capturePhoto() {
     if (!window.webcamCapture) return;
     
-    const photoData = window.webcamCapture.capturePhoto();
-    document.getElementById('webcam-data').value = photoData;
+    window.webcamCapture.capturePhoto();
+    if (typeof DataTransfer === 'function') {
+        // Send the capture as a multipart file through the file input, not as a base64 string
+        const transfer = new DataTransfer();
+        transfer.items.add(await window.webcamCapture.captureFile());
+        document.getElementById('file-input').files = transfer.files;
+    } else {
+        document.getElementById('webcam-data').value = window.webcamCapture.captureDataURL();
+    }
     
     // Show captured photo
     document.getElementById('webcam-canvas').style.display = 'block';
@@ -88,6 +123,7 @@ function retakePhoto() {
     document.getElementById('retake-photo').style.display = 'none';
     document.getElementById('capture-photo').style.display = 'inline-block';
     document.getElementById('webcam-data').value = '';
+    document.getElementById('file-input').value = '';
 }
 
 function stopWebcam() {
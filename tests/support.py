@@ -0,0 +1,8 @@
+"""Imported by the tests before main: the app writes its folders, secrets and log to a temporary folder."""
+import os, sys, tempfile
+
+scratch = tempfile.TemporaryDirectory()
+os.environ["JOBS_FOLDER"] = os.path.join(scratch.name, "jobs")
+os.environ["GEN_FOLDER"] = os.path.join(scratch.name, "generated")
+os.environ["LOG_FILE"] = os.path.join(scratch.name, "main.log")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
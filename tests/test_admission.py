@@ -0,0 +1,82 @@
+import asyncio, os, tempfile, unittest
+from unittest import mock
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+class AdmissionTest(unittest.IsolatedAsyncioTestCase):
+    """Admission per branch, with the stage capacities of a 1-CPU host (normalize takes 2 jobs)."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        capacity = {**main.STAGE_CAPACITY, "text": 3, "normalize": 2, "video": 2}
+        for patcher in (
+            mock.patch.object(main, "JOBS_DB", os.path.join(folder.name, "jobs.db")),
+            mock.patch.dict(main.STAGE_CAPACITY, capacity),
+            mock.patch.dict(main.stage_queues, {stage: asyncio.Queue() for stage in main.STAGES}, clear=True),
+            mock.patch.dict(main.admitted_jobs, clear=True),
+            mock.patch.dict(main.admission_queue, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.init_jobs_db()
+
+    def params(self, job_id: str) -> dict:
+        return {"name": job_id, "job": "tester", "place": "Lyon", "photo_path": "", "image_prompt": ""}
+
+    def queued_jobs(self, stage: str) -> list[str]:
+        queue = main.stage_queues[stage]
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    async def test_jobs_flow_past_a_small_stage(self):
+        # Jobs that moved on from normalize leave room for new ones, the smallest capacity does not cap all jobs
+        for job_id in ("a", "b", "c"):
+            self.assertEqual(await main.request_admission("client", job_id, self.params(job_id)), 0)
+            main.release_admission(job_id, "normalize")
+        self.assertEqual(self.queued_jobs("text"), ["a", "b", "c"])
+        self.assertEqual(main.stage_load()["upload"], 3)
+
+    async def test_backlog_of_the_portrait_branch_admits_new_text_work(self):
+        # Two jobs wait for the video stage, the portrait branch has no room left but the text stage has
+        for job_id in ("a", "b"):
+            await main.request_admission("client", job_id, self.params(job_id))
+            for stage in main.BRANCHES[1][:-1]:
+                main.release_admission(job_id, stage)
+        for stage in ("text", "normalize"):
+            self.queued_jobs(stage)
+
+        self.assertEqual(await main.request_admission("other", "c", self.params("c")), 0)
+        self.assertEqual(self.queued_jobs("text"), ["c"])
+        self.assertEqual(self.queued_jobs("normalize"), [])
+        job = main.get_job("c")
+        self.assertEqual(job["status"], "pending")
+        self.assertEqual(main.stage_status(job, "text"), "pending")
+        self.assertEqual(main.stage_status(job, "normalize"), "")
+        self.assertEqual(main.admission_stats()["queued"], 1)
+
+        # Its portrait starts once a video is done, and the job leaves the queue
+        main.release_admission("a", "video")
+        await main.pump_admission()
+        self.assertEqual(self.queued_jobs("normalize"), ["c"])
+        job = main.get_job("c")
+        self.assertEqual(main.stage_status(job, "normalize"), "pending")
+        self.assertNotIn("queue_worker", job["results"])
+        self.assertEqual(main.admission_stats()["queued"], 0)
+
+    async def test_full_stages_queue_the_job(self):
+        # c gets its biography but waits for its portrait, d waits behind it for both
+        for job_id in ("a", "b", "c"):
+            self.assertEqual(await main.request_admission("client", job_id, self.params(job_id)), 0)
+        self.assertEqual(await main.request_admission("other", "d", self.params("d")), 2)
+        self.assertEqual(main.get_job("d")["status"], "queued")
+        self.assertEqual(main.get_job("d")["results"]["queue_position"], 2)
+
+        # A failed job drops its branches from the queue
+        main.release_admission("c")
+        self.assertEqual(main.admission_stats()["queued"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
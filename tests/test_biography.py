@@ -0,0 +1,76 @@
+import asyncio, os, tempfile, unittest
+from unittest import mock
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+BIOGRAPHY = "<!DOCTYPE html><html><p>Ada was born in Lyon.</p></html>"
+WRITTEN = BIOGRAPHY[:-len("</html>")] # what the LLM wrote when the stage ends
+STREAMED = WRITTEN[:-len("</html>") + 1] # the cleaner holds back what could be the start of </html>
+
+
+class BiographyStreamTest(unittest.IsolatedAsyncioTestCase):
+    """The text stage removes its partial biography however it ends, and the streams following it stop."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        patcher = mock.patch.object(main, "JOBS_FOLDER", folder.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.makedirs(main.job_file("job", ""))
+        self.job = {"id": "job", "params": {"name": "Ada", "job": "tester", "place": "Lyon"}}
+        self.written, self.answer = asyncio.Event(), asyncio.Future()
+
+    async def call_anthropic(self, prompt: str, on_text=None, **kwargs) -> str:
+        on_text(WRITTEN)
+        self.written.set()
+        return await self.answer
+
+    async def stream_while(self, end_stage) -> bytes:
+        """Follow the biography from its first chunk while the stage is ended by end_stage."""
+        with mock.patch.object(main, "call_anthropic", self.call_anthropic):
+            stage = asyncio.create_task(main.run_text_stage(self.job))
+            await self.written.wait()
+            stream = main.stream_biography("job")
+            received = await anext(stream)
+            end_stage(stage)
+            await asyncio.gather(stage, return_exceptions=True)
+            async for chunk in stream:
+                received += chunk
+        self.assertFalse(os.path.exists(main.job_file("job", main.PARTIAL_HTML)))
+        return received
+
+    async def test_failed_stage(self):
+        received = await asyncio.wait_for(self.stream_while(lambda stage: self.answer.set_exception(RuntimeError("down"))), 5)
+        self.assertEqual(received.decode(), STREAMED)
+        self.assertFalse(os.path.exists(main.job_file("job")))
+
+    async def test_cancelled_stage(self):
+        received = await asyncio.wait_for(self.stream_while(lambda stage: stage.cancel()), 5)
+        self.assertEqual(received.decode(), STREAMED)
+        self.assertFalse(os.path.exists(main.job_file("job")))
+
+    async def test_finished_stage(self):
+        await asyncio.wait_for(self.stream_while(lambda stage: self.answer.set_result(BIOGRAPHY)), 5)
+        self.assertTrue(os.path.exists(main.job_file("job")))
+
+    async def test_job_is_read_at_the_poll_interval(self):
+        # The stream waits for the LLM for a while, the file is tailed but the job record is rarely read
+        get_job = mock.Mock(return_value={"status": "running", "stages": {"text": {"status": "running"}}})
+        with mock.patch.object(main, "call_anthropic", self.call_anthropic), mock.patch.object(main, "get_job", get_job):
+            stage = asyncio.create_task(main.run_text_stage(self.job))
+            await self.written.wait()
+            stream = main.stream_biography("job")
+            await anext(stream)
+            waiting = asyncio.create_task(anext(stream))
+            await asyncio.sleep(main.JOB_POLL_INTERVAL * 1.5)
+            self.assertEqual(get_job.call_count, 2)
+            self.answer.set_result(BIOGRAPHY)
+            await stage
+            self.assertEqual((await waiting).decode(), WRITTEN[len(STREAMED):])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os, tempfile, unittest
+from unittest import mock
+
+import httpx
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+async def chunks(size: int):
+    for _ in range(size // 1024):
+        yield b"x" * 1024
+
+
+def serve(request: httpx.Request) -> httpx.Response:
+    """/sized/<bytes> sends its Content-Length, /chunked/<bytes> does not."""
+    kind, size = request.url.path.strip("/").split("/")
+    if kind == "sized":
+        return httpx.Response(200, content=b"x" * int(size))
+    return httpx.Response(200, content=chunks(int(size)))
+
+
+class DownloadLimitTest(unittest.IsolatedAsyncioTestCase):
+    """The photos of batch records are downloaded with the limit of the uploads."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        self.path = os.path.join(folder.name, main.PHOTO_FILE)
+        client = httpx.AsyncClient(transport=httpx.MockTransport(serve))
+        self.addAsyncCleanup(client.aclose)
+        patcher = mock.patch.object(main, "http_client", client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_photo_within_the_limit(self):
+        await main.download_to_file("http://photos/chunked/4096", self.path, max_bytes=4096)
+        self.assertEqual(os.path.getsize(self.path), 4096)
+
+    async def test_content_length_beyond_the_limit(self):
+        with self.assertRaises(ValueError):
+            await main.download_to_file("http://photos/sized/4097", self.path, max_bytes=4096)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    async def test_body_beyond_the_limit(self):
+        with self.assertRaises(ValueError):
+            await main.download_to_file("http://photos/chunked/8192", self.path, max_bytes=4096)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import asyncio, os, sqlite3, tempfile, threading, time, unittest
+from unittest import mock
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+class EngineWritesTest(unittest.IsolatedAsyncioTestCase):
+    """Another worker holds the write lock of the job database, the event loop of this one keeps running."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        for patcher in (
+            mock.patch.object(main, "JOBS_DB", os.path.join(folder.name, "jobs.db")),
+            mock.patch.dict(main.stage_queues, {stage: asyncio.Queue() for stage in main.STAGES}, clear=True),
+            mock.patch.dict(main.admitted_jobs, clear=True),
+            mock.patch.dict(main.admission_queue, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.init_jobs_db()
+        main.create_job("job", {"name": "Ada", "job": "tester", "place": "Lyon", "photo_path": "", "image_prompt": ""})
+
+    def hold_write_lock(self, seconds: float):
+        locked = threading.Event()
+
+        def hold():
+            con = sqlite3.connect(main.JOBS_DB, isolation_level=None)
+            con.execute("BEGIN IMMEDIATE")
+            locked.set()
+            time.sleep(seconds)
+            con.execute("ROLLBACK")
+            con.close()
+
+        threading.Thread(target=hold, daemon=True).start()
+        locked.wait()
+
+    async def max_lag_of(self, coroutine) -> float:
+        """The longest gap between two ticks of the event loop while the coroutine runs."""
+        lags = [0.0]
+
+        async def tick():
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(0.01)
+                lags.append(time.monotonic() - started - 0.01)
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0)
+        try:
+            await coroutine
+        finally:
+            ticker.cancel()
+        return max(lags)
+
+    async def test_stage_transactions_wait_off_the_loop(self):
+        async def run_text_stage(job: dict) -> dict:
+            self.hold_write_lock(0.5)
+            return {}
+
+        with mock.patch.dict(main.STAGE_HANDLERS, {"text": run_text_stage}):
+            lag = await self.max_lag_of(main.run_stage("job", "text"))
+        self.assertLess(lag, 0.2)
+        self.assertEqual(main.stage_status(main.get_job("job"), "text"), main.DONE)
+
+
+class OrphanPhotosTest(unittest.IsolatedAsyncioTestCase):
+    """The leader removes the photos of submissions that never became a job while it runs."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        for patcher in (
+            mock.patch.object(main, "JOBS_FOLDER", folder.name),
+            mock.patch.object(main, "JOBS_DB", os.path.join(folder.name, "jobs.db")),
+            mock.patch.object(main, "live_workers", []),
+            mock.patch.object(main, "orphans_swept_at", 0.0),
+            mock.patch.dict(main.admission_queue, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.init_jobs_db()
+
+    def submit_photo(self, age: float) -> str:
+        job_id = main.new_job_id()
+        path = main.job_file(job_id, main.PHOTO_FILE)
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as file:
+            file.write(b"photo")
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    async def test_expired_orphan_is_removed_at_a_later_heartbeat(self):
+        await main.check_workers()
+        expired, recent = self.submit_photo(main.ORPHAN_PHOTO_TTL + 1), self.submit_photo(0)
+        await main.check_workers()
+        self.assertTrue(os.path.exists(expired)) # the sweep is not due yet
+
+        main.orphans_swept_at -= main.ORPHAN_SWEEP_INTERVAL
+        await main.check_workers()
+        self.assertFalse(os.path.exists(os.path.dirname(expired)))
+        self.assertTrue(os.path.exists(recent))
+
+
+if __name__ == "__main__":
+    unittest.main()
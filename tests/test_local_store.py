@@ -0,0 +1,66 @@
+import os, tempfile, threading, time, unittest
+from unittest import mock
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+class LocalStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        self.store = main.LocalStore(os.path.join(folder.name, "store"))
+        os.makedirs(self.store.root)
+
+    def test_evict_while_the_loop_records(self):
+        # evict() runs in a worker thread while record() adds assets on the event loop
+        for i in range(1000):
+            self.store.record(f"old-{i}.jpeg", 1, 0)
+        thread = threading.Thread(target=lambda: [self.store.record(f"new-{i}.jpeg", 1, main.time.time())
+                                                  for i in range(200000)])
+        thread.start()
+        try:
+            while thread.is_alive():
+                self.store.evict()
+                self.store.total_bytes()
+        finally:
+            thread.join()
+        self.assertFalse(any(key.startswith("old-") for key, _ in self.store.snapshot()))
+        self.assertEqual(self.store.total_bytes(), 200000)
+
+    def put(self, store: main.LocalStore, key: str):
+        path = os.path.join(self.folder, "upload")
+        with open(path, "wb") as file:
+            file.write(b"x" * 600)
+        store.put_file(path, key)
+
+    def test_assets_served_by_another_worker_count_as_used(self):
+        with mock.patch.object(main, "CACHE_DB", os.path.join(self.folder, "cache.db")):
+            main.init_cache_db()
+            leader, other = self.store, main.LocalStore(self.store.root)
+            for store in (leader, other):
+                store.load()
+                store.publish({})
+            self.put(leader, "served-by-other.jpeg")
+            time.sleep(0.01)
+            self.put(leader, "served-by-leader.jpeg")
+
+            # Only the other worker serves the older asset afterwards (like /media), the leader evicts the one it served
+            time.sleep(0.01)
+            self.assertTrue(other.exists("served-by-other.jpeg"))
+            other.touch("served-by-other.jpeg")
+            other.sweep(leader=False)
+            with mock.patch.object(main, "STORE_MAX_BYTES", 1000):
+                self.assertEqual(leader.sweep(leader=True), 1)
+            self.assertEqual([key for key, _ in leader.snapshot()], ["served-by-other.jpeg"])
+
+            # The other worker takes the index of the leader without scanning the store
+            with mock.patch.object(main.LocalStore, "scan", side_effect=AssertionError("scanned")):
+                other.sweep(leader=False)
+            self.assertEqual([key for key, _ in other.snapshot()], ["served-by-other.jpeg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import os, tempfile, unittest
+
+from PIL import Image
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+class NormalizeStageTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.photo_path = os.path.join(folder.name, main.PHOTO_FILE)
+
+    def job(self) -> dict:
+        return {"id": "job", "params": {"photo_path": self.photo_path}}
+
+    async def test_heic_photo_becomes_a_jpeg(self):
+        Image.new("RGB", (2000, 1000), "red").save(self.photo_path, "HEIF")
+        await main.run_normalize_stage(self.job())
+        with Image.open(self.photo_path) as img:
+            self.assertEqual((img.format, img.size), ("JPEG", (main.PHOTO_MAX_SIZE, main.PHOTO_MAX_SIZE // 2)))
+
+    async def test_undecodable_photo_fails_for_good(self):
+        with open(self.photo_path, "wb") as file:
+            file.write(b"not an image")
+        with self.assertRaises(main.PermanentStageError):
+            await main.run_normalize_stage(self.job())
+
+
+if __name__ == "__main__":
+    unittest.main()
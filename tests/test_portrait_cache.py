@@ -0,0 +1,57 @@
+import os, tempfile, unittest
+from unittest import mock
+
+from PIL import Image, ImageDraw
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+class PortraitCacheTest(unittest.TestCase):
+    """Two webcam shots of a centred face on a plain background, of two different people."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        for patcher in (
+            mock.patch.object(main, "CACHE_DB", os.path.join(folder.name, "cache.db")),
+            mock.patch.object(main, "artifact_store", main.LocalStore(os.path.join(folder.name, "store"))),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.makedirs(main.artifact_store.root)
+        main.init_cache_db()
+
+    def photo(self, name: str, eyes: str) -> tuple[str, str]:
+        """The perceptual hash and digest of a face whose eyes have this colour."""
+        path = os.path.join(self.folder, name)
+        img = Image.new("RGB", (640, 480), "lightgrey")
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((220, 120, 420, 380), fill="peachpuff")
+        draw.ellipse((270, 200, 290, 215), fill=eyes)
+        draw.ellipse((350, 200, 370, 215), fill=eyes)
+        img.save(path, "JPEG")
+        return f"{main.photo_hash(path):016x}", main.photo_digest(path)
+
+    def put_portrait(self, client: str, hashes: tuple[str, str]):
+        path = os.path.join(self.folder, "portrait.jpeg")
+        Image.new("RGB", (64, 64), "blue").save(path, "JPEG")
+        main.artifact_store.put_file(path, "job.jpeg")
+        main.portrait_cache_put(client, "a tester in Lyon", *hashes, "job.jpeg")
+
+    def test_similar_photos_do_not_share_a_portrait(self):
+        first, second = self.photo("first.jpeg", "brown"), self.photo("second.jpeg", "blue")
+        self.assertLessEqual(main.hash_distance(first[0], second[0]), main.PORTRAIT_HASH_DISTANCE)
+        self.put_portrait("client", first)
+        self.assertIsNone(main.portrait_cache_get("client", "a tester in Lyon", *second))
+        self.assertIsNotNone(main.portrait_cache_get("client", "a tester in Lyon", *first))
+
+    def test_other_clients_do_not_get_the_portrait(self):
+        hashes = self.photo("photo.jpeg", "brown")
+        self.put_portrait("client", hashes)
+        self.assertIsNone(main.portrait_cache_get("other", "a tester in Lyon", *hashes))
+
+
+if __name__ == "__main__":
+    unittest.main()
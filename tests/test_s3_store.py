@@ -0,0 +1,91 @@
+import os, socket, hashlib, tempfile, threading, time, unittest
+from unittest import mock
+
+import httpx, uvicorn
+
+import support # before main, which writes to the folders it sets
+import benchmark, main
+
+
+class S3StoreTest(unittest.TestCase):
+    """S3Store against the fake S3 of the benchmark, which checks the signature of every request."""
+
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        cls.server = uvicorn.Server(uvicorn.Config(benchmark.fake_s3_app(), host="127.0.0.1", port=port,
+                                                 ws="none", log_level="warning"))
+        cls.thread = threading.Thread(target=cls.server.run, daemon=True)
+        cls.thread.start()
+        while not cls.server.started:
+            time.sleep(0.01)
+        cls.endpoint_url = f"http://127.0.0.1:{port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.should_exit = True
+        cls.thread.join()
+
+    def setUp(self):
+        benchmark.s3_objects.clear()
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.store = main.S3Store(self.endpoint_url, benchmark.S3_BUCKET, benchmark.S3_REGION,
+                                  benchmark.S3_ACCESS_KEY_ID, benchmark.S3_SECRET_ACCESS_KEY)
+        self.addCleanup(self.store.close)
+
+    def put(self, key: str, content: bytes):
+        path = os.path.join(self.folder.name, key)
+        with open(path, "wb") as file:
+            file.write(content)
+        self.store.put_file(path, key)
+
+    def test_put_copy_fetch_and_remove(self):
+        self.put("job.jpeg", b"portrait")
+        self.assertEqual(self.store.index["job.jpeg"]["size"], 8)
+        self.store.copy("job.jpeg", "other.jpeg")
+        path = os.path.join(self.folder.name, "fetched.jpeg")
+        self.store.fetch("other.jpeg", path)
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"portrait")
+        self.store.remove("job.jpeg")
+        self.assertNotIn(f"{benchmark.S3_BUCKET}/job.jpeg", benchmark.s3_objects)
+        self.assertFalse(self.store.lookup("job.jpeg"))
+        self.assertTrue(self.store.lookup("other.jpeg"))
+
+    def test_listing_pages(self):
+        for i in range(benchmark.S3_LIST_PAGE + 5):
+            benchmark.s3_objects[f"{benchmark.S3_BUCKET}/{i:04d}.jpeg"] = {
+                "content": b"x", "content_type": "image/jpeg", "etag": hashlib.md5(bytes([i])).hexdigest(), "mtime": time.time()}
+        self.store.load()
+        self.assertEqual(len(self.store.index), benchmark.S3_LIST_PAGE + 5)
+        self.assertEqual(self.store.digest("0003.jpeg"), hashlib.md5(bytes([3])).hexdigest()[:16])
+
+    def test_presigned_url(self):
+        self.put("video.mp4", b"video")
+        url = self.store.source("video.mp4")
+        self.assertEqual(httpx.get(url).content, b"video")
+        self.assertEqual(httpx.get(url.replace("X-Amz-Signature=", "X-Amz-Signature=0")).status_code, 403)
+        with mock.patch.object(main, "SIGNED_URL_TTL", -1):
+            self.assertEqual(httpx.get(self.store.source("video.mp4")).status_code, 403)
+
+    def test_wrong_secret_is_refused(self):
+        store = main.S3Store(self.endpoint_url, benchmark.S3_BUCKET, benchmark.S3_REGION, benchmark.S3_ACCESS_KEY_ID, "wrong")
+        self.addCleanup(store.close)
+        with self.assertRaises(httpx.HTTPStatusError):
+            store.request("GET", query={"list-type": "2"})
+
+    def test_eviction(self):
+        self.put("old.jpeg", b"o" * 600)
+        self.put("new.jpeg", b"n" * 600)
+        self.store.touch("new.jpeg")
+        with mock.patch.object(main, "STORE_MAX_BYTES", 1000):
+            self.assertEqual(self.store.evict(), 1)
+        self.store.load()
+        self.assertEqual(list(self.store.index), ["new.jpeg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os, unittest
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import support # before main, which writes to the folders it sets
+import main
+
+
+class UploadLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.forms = []
+
+        async def submit(request):
+            self.forms.append(await request.form())
+            return Response("ok")
+
+        limit = Middleware(main.UploadLimit, paths=("/submit",), max_bytes=1000, response=main.upload_too_large)
+        self.client = TestClient(Starlette(routes=[Route("/submit", submit, methods=["POST"])], middleware=[limit]))
+
+    def post(self, size: int, chunked: bool = False):
+        body = b"-" * size
+        # A generator is sent chunked, without a Content-Length
+        content = (body[i:i + 100] for i in range(0, size, 100)) if chunked else body
+        return self.client.post("/submit", content=content, headers={"Content-Type": "application/x-www-form-urlencoded"})
+
+    def test_small_body_reaches_the_route(self):
+        self.assertEqual(self.post(900).text, "ok")
+        self.assertEqual(len(self.forms), 1)
+
+    def test_large_content_length_is_refused_before_reading(self):
+        response = self.post(5000)
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("larger than", response.text)
+        self.assertEqual(self.forms, [])
+
+    def test_large_chunked_body_is_refused_while_received(self):
+        response = self.post(5000, chunked=True)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.forms, [])
+
+
+if __name__ == "__main__":
+    unittest.main()